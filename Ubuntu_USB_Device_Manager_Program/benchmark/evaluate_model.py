@@ -0,0 +1,401 @@
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import tempfile
+import tracemalloc
+from array import array
+
+PROGRAM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROGRAM_DIR)  # The benchmark runs in a scratch directory, keep the program importable
+
+from loguru import logger
+
+from benchmark.run_benchmark import percentile
+from benchmark.synthetic_history import synthetic_history
+from core.decision_journal import DecisionJournal, get_journal
+from core.decision_counters import DecisionCounters
+from ml_model.compact_model import CompactModel, ARTIFACT_FILE
+from ml_model.model import ModelPredictor, train_model
+from ml_model.online_model import OnlineModel
+from ml_model.policy_table import PolicyTable
+from ml_model.training_store import TrainingStore
+
+
+def traced_bytes(load) -> int:
+    """ Memory allocated by load() and still held by what it returns. """
+    tracemalloc.start()
+    loaded = load()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del loaded
+    return size
+
+
+class PipelineCandidate:
+    """ What the manager runs: policy table, online model and compact tree, through a ModelPredictor. """
+
+    name = 'pipeline'
+    incremental = True  # Learns between predictions, so every record is predicted on its own
+    auto_blocks = True
+
+    def __init__(self) -> None:
+        self.journal = get_journal()
+        self.store = TrainingStore()
+        self.online_model = OnlineModel(self.journal)
+        self.online_model.CHECKPOINT_EVERY = float('inf')  # The manager's checkpoints aren't what is measured
+        self.policy = PolicyTable()
+        self.predictor = ModelPredictor(self.online_model, self.policy, DecisionCounters())
+        self.trained = 0
+
+    def train(self, records: [{}], end: int) -> None:
+        self.journal.append(*records[self.trained:end])
+        self.trained = end
+        train_model(self.store)
+
+    def learn(self, device_info: {}, decision: str) -> None:
+        self.policy.record(device_info, decision)
+        self.online_model.learn(device_info, decision)
+
+    def predict(self, device_info: {}) -> '':
+        return self.predictor.predict(device_info)
+
+    def predict_batch(self, devices: [{}]) -> ['']:
+        return self.predictor.predict_batch(devices)
+
+    def size(self) -> {}:
+        """ The artifact the tree is loaded from, the online model's weights. The policy table isn't counted. """
+        if not os.path.exists(ARTIFACT_FILE):
+            return {'model_bytes': 0, 'resident_bytes': 0}
+        return {'model_bytes': os.path.getsize(ARTIFACT_FILE) + len(self.online_model.weights.tobytes()),
+                'resident_bytes': traced_bytes(lambda: CompactModel.load(ARTIFACT_FILE)) +
+                len(self.online_model.weights.tobytes())}
+
+
+class BatchCandidate:
+    """ A scikit-learn model retrained on the whole history so far, between chunks, with no other stage in front.
+    Predicts the class of every device, the manager would only act on 'allow' and ask about the rest. """
+
+    incremental = False
+    auto_blocks = False
+
+    def __init__(self) -> None:
+        self.model = None
+        self.labels = array('b')
+        self.trained = 0
+
+    def train(self, records: [{}], end: int) -> None:
+        self.extend(records[self.trained:end])
+        self.labels.extend(1 if record['decision'] == 'allow' else 0 for record in records[self.trained:end])
+        self.trained = end
+        self.fit()
+
+    def learn(self, device_info: {}, decision: str) -> None:
+        pass
+
+    def predict(self, device_info: {}) -> '':
+        return self.predict_batch([device_info])[0]
+
+    def predict_batch(self, devices: [{}]) -> ['']:
+        if self.model is None:
+            return [None] * len(devices)
+        return ['allow' if label == 1 else 'block' for label in self.model.predict(self.transform(devices))]
+
+    def y(self):
+        import numpy as np
+        return np.frombuffer(self.labels, dtype=np.int8)
+
+    def size(self) -> {}:
+        """ The pickled model with whatever it needs to encode a device. """
+        blob = pickle.dumps(self.state())
+        return {'model_bytes': len(blob), 'resident_bytes': traced_bytes(lambda: pickle.loads(blob))}
+
+
+class OrdinalTreeCandidate(BatchCandidate):
+    """ DecisionTreeClassifier over dictionary codes, one per feature, what train_model did with a LabelEncoder
+    per column. A value never seen in training gets -1. """
+
+    def __init__(self, name: str, features: ()) -> None:
+        super().__init__()
+        self.name = name
+        self.features = features
+        self.codes = [{} for _ in features]  # Value -> code, per feature
+        self.columns = [array('i') for _ in features]
+
+    def extend(self, records: [{}]) -> None:
+        for codes, column, feature in zip(self.codes, self.columns, self.features):
+            column.extend(codes.setdefault(record[feature], len(codes)) for record in records)
+
+    def fit(self) -> None:
+        import numpy as np
+        from sklearn.tree import DecisionTreeClassifier
+
+        X = np.stack([np.frombuffer(column, dtype=np.int32) for column in self.columns], axis=1)
+        self.model = DecisionTreeClassifier().fit(X, self.y())
+
+    def transform(self, devices: [{}]):
+        import numpy as np
+        return np.array([[codes.get(device_info[feature], -1) for codes, feature in zip(self.codes, self.features)]
+                         for device_info in devices], dtype=np.int32)
+
+    def state(self) -> ():
+        return self.model, self.codes
+
+
+class TargetEncodedTreeCandidate(BatchCandidate):
+    """ DecisionTreeClassifier over the smoothed allow rate of the device's vendor and vendor:product pair in the
+    history, and how often the pair was decided on. Unseen values get the overall allow rate. """
+
+    name = 'tree_target_encoded'
+    SMOOTHING = 10  # Decisions of prior weight in each rate
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.codes = ({}, {})  # vendor -> code, (vendor, product) -> code
+        self.columns = (array('i'), array('i'))
+        self.tables = None  # (smoothed allow rate, decisions) per code, for the vendors and the pairs
+        self.prior = None  # Overall allow rate, for values seen after the last training
+
+    @staticmethod
+    def _keys(device_info: {}) -> ():
+        return device_info['vendor_id'], (device_info['vendor_id'], device_info['product_id'])
+
+    def extend(self, records: [{}]) -> None:
+        for record in records:
+            for codes, column, key in zip(self.codes, self.columns, self._keys(record)):
+                column.append(codes.setdefault(key, len(codes)))
+
+    def fit(self) -> None:
+        import numpy as np
+        from sklearn.tree import DecisionTreeClassifier
+
+        y = self.y()
+        prior = y.mean()
+        self.tables = []
+        for codes, column in zip(self.codes, self.columns):
+            column = np.frombuffer(column, dtype=np.int32)
+            decisions = np.bincount(column, minlength=len(codes))
+            allows = np.bincount(column, weights=y, minlength=len(codes))
+            self.tables.append(((allows + self.SMOOTHING * prior) / (decisions + self.SMOOTHING), decisions))
+        self.prior = prior
+
+        (vendor_rates, _), (product_rates, product_decisions) = self.tables
+        vendors, products = (np.frombuffer(column, dtype=np.int32) for column in self.columns)
+        X = np.stack([vendor_rates[vendors], product_rates[products], product_decisions[products]], axis=1)
+        self.model = DecisionTreeClassifier(min_samples_leaf=5).fit(X, y)
+
+    def transform(self, devices: [{}]):
+        import numpy as np
+        (vendor_codes, product_codes), ((vendor_rates, _), (product_rates, product_decisions)) = self.codes, self.tables
+        rows = []
+        for device_info in devices:
+            vendor, product = self._keys(device_info)
+            vendor, product = vendor_codes.get(vendor), product_codes.get(product)
+            # Codes handed out after the last training have no rate yet either
+            rows.append((self.prior if vendor is None or vendor >= len(vendor_rates) else vendor_rates[vendor],
+                         self.prior if product is None or product >= len(product_rates) else product_rates[product],
+                         0 if product is None or product >= len(product_decisions) else product_decisions[product]))
+        return np.array(rows)
+
+    def state(self) -> ():
+        return self.model, self.codes, self.tables, self.prior
+
+
+class HashedLogisticCandidate(BatchCandidate):
+    """ LogisticRegression over hashed one-hot vendor, vendor:product and vendor:product:serial indicators, the
+    batch counterpart of the online model. Nothing to look up, unseen values just hash to untrained weights. """
+
+    name = 'logistic_hashed'
+    N_FEATURES = 2 ** 18
+
+    def __init__(self) -> None:
+        from sklearn.feature_extraction import FeatureHasher
+
+        super().__init__()
+        self.hasher = FeatureHasher(self.N_FEATURES, input_type='string', alternate_sign=False)
+        self.chunks = []  # Hashed rows of every chunk so far
+
+    def extend(self, records: [{}]) -> None:
+        if records:
+            self.chunks.append(self.transform(records))
+
+    def fit(self) -> None:
+        import scipy.sparse
+        from sklearn.linear_model import LogisticRegression
+
+        y = self.y()
+        if len(set(y.tolist())) < 2:
+            return  # A single class so far, nothing to separate
+        self.model = LogisticRegression(solver='liblinear').fit(scipy.sparse.vstack(self.chunks), y)
+
+    def transform(self, devices: [{}]):
+        return self.hasher.transform(
+            [(f"v={device_info['vendor_id']}", f"vp={device_info['vendor_id']}:{device_info['product_id']}",
+              f"vps={device_info['vendor_id']}:{device_info['product_id']}:{device_info['serial']}")
+             for device_info in devices])
+
+    def state(self) -> ():
+        return self.model
+
+
+CANDIDATES = {
+    'pipeline': PipelineCandidate,
+    'tree_ordinal': lambda: OrdinalTreeCandidate('tree_ordinal', ('vendor_id', 'product_id', 'serial')),
+    'tree_ordinal_no_serial': lambda: OrdinalTreeCandidate('tree_ordinal_no_serial', ('vendor_id', 'product_id')),
+    'tree_target_encoded': TargetEncodedTreeCandidate,
+    'logistic_hashed': HashedLogisticCandidate,
+}
+
+
+class Score:
+    """ Running counts of a candidate's predictions against the user's decisions. """
+
+    def __init__(self, auto_blocks: bool) -> None:
+        self.auto_blocks = auto_blocks
+        self.records = 0
+        self.decided = 0  # Predictions with a class
+        self.correct = 0
+        self.prompts = 0  # Records the manager would have asked the user about
+        self.blocks = 0  # Records the user blocked
+        self.false_allows = 0  # Auto-allowed, blocked by the user
+        self.false_blocks = 0  # Auto-blocked, allowed by the user
+
+    def add(self, prediction: '', decision: str) -> None:
+        self.records += 1
+        self.blocks += decision == 'block'
+        if prediction is not None:
+            self.decided += 1
+            self.correct += prediction == decision
+
+        if prediction == 'allow':
+            self.false_allows += decision == 'block'
+        elif prediction == 'block' and self.auto_blocks:
+            self.false_blocks += decision == 'allow'
+        else:
+            self.prompts += 1
+
+    def report(self) -> {}:
+        return {
+            'accuracy': self.correct / self.decided if self.decided else 0.0,
+            'decided_rate': self.decided / self.records if self.records else 0.0,
+            'prompt_rate': self.prompts / self.records if self.records else 0.0,
+            'false_allow_rate': self.false_allows / self.blocks if self.blocks else 0.0,
+            'false_blocks': self.false_blocks,
+        }
+
+
+def evaluate(candidate, records: [{}], retrain_every: int, latency_samples: int) -> {}:
+    """ Prequential replay: predict each chunk with the candidate trained on every record before it, then retrain. """
+    score = Score(candidate.auto_blocks)
+    single = []  # Seconds per single prediction
+    batches = []  # Seconds per chunk predicted in one batch
+    batch_rows = 0
+    training = []  # Seconds per retraining
+
+    for start in range(0, len(records), retrain_every):
+        chunk = records[start:start + retrain_every]
+
+        started = time.perf_counter()
+        predictions = candidate.predict_batch(chunk)
+        batches.append(time.perf_counter() - started)
+        batch_rows += len(chunk)
+
+        if candidate.incremental:
+            # The batch above predicted on the state before the chunk, only a latency figure
+            for device_info in chunk:
+                started = time.perf_counter()
+                prediction = candidate.predict(device_info)
+                single.append(time.perf_counter() - started)
+                score.add(prediction, device_info['decision'])
+                candidate.learn(device_info, device_info['decision'])
+        else:
+            for prediction, device_info in zip(predictions, chunk):
+                score.add(prediction, device_info['decision'])
+            for device_info in chunk[::max(1, len(chunk) // latency_samples)][:latency_samples]:
+                started = time.perf_counter()
+                candidate.predict(device_info)
+                single.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        candidate.train(records, start + len(chunk))
+        training.append(time.perf_counter() - started)
+
+    result = score.report()
+    result.update({
+        'prediction_latency_us': {'p50': percentile(single, 0.5) * 1e6, 'p95': percentile(single, 0.95) * 1e6,
+                                  'p99': percentile(single, 0.99) * 1e6},
+        'batch_latency_ms': {'p50': percentile(batches, 0.5) * 1000, 'max': max(batches, default=0) * 1000},
+        'batch_us_per_row': sum(batches) / batch_rows * 1e6 if batch_rows else 0.0,
+        'training_s': {'last': training[-1] if training else 0.0, 'total': sum(training)},
+    })
+    result.update(candidate.size())
+    return result
+
+
+def load_history(journal_path: str, store_directory: str = None) -> [{}]:
+    """ Every decision of a real history, oldest first: the training store's rows, if given, then the journal. """
+    journal = DecisionJournal(journal_path, legacy_path=None)
+    if store_directory is not None:
+        return [dict(device_info, decision=decision)
+                for device_info, decision in TrainingStore(store_directory).history(journal)]
+    return [record for record in journal.records() if 'decision' in record]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay a decision history in time order, predicting every decision "
+                                                 "from the ones before it, and compare the models")
+    parser.add_argument('--records', type=int, default=10000, help="Synthetic decisions to replay")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--vendors', type=int, default=200, help="Vendors in the synthetic history")
+    parser.add_argument('--journal', help="Replay this decision journal instead of a synthetic history")
+    parser.add_argument('--store', help="Training store directory holding the journal's compacted decisions")
+    parser.add_argument('--retrain-every', type=int,
+                        help="Decisions between retrainings, a tenth of the history by default")
+    parser.add_argument('--latency-samples', type=int, default=200,
+                        help="Single predictions timed per chunk for the batch models")
+    parser.add_argument('--candidates', nargs='+', choices=tuple(CANDIDATES), default=tuple(CANDIDATES))
+    parser.add_argument('--output', help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='CRITICAL')
+
+    if args.journal:
+        records = load_history(os.path.abspath(args.journal), args.store and os.path.abspath(args.store))
+        source = args.journal
+    else:
+        records = list(synthetic_history(args.records, args.seed, args.vendors))
+        source = f'synthetic, seed {args.seed}'
+    retrain_every = args.retrain_every or max(100, len(records) // 10)
+    output = args.output and os.path.abspath(args.output)
+    print(f"{len(records)} decisions ({source}), {sum(record['decision'] == 'block' for record in records)} blocks, "
+          f"retrained every {retrain_every}")
+
+    results = {}
+    for name in args.candidates:
+        # The pipeline reads and writes its files relative to the working directory, like the manager
+        with tempfile.TemporaryDirectory() as scratch:
+            os.chdir(scratch)
+            os.makedirs('data')
+            os.makedirs('ml_model')
+            result = results[name] = evaluate(CANDIDATES[name](), records, retrain_every, args.latency_samples)
+            os.chdir(PROGRAM_DIR)
+
+        latency = result['prediction_latency_us']
+        print(f"{name:24} accuracy {result['accuracy']:6.1%} of {result['decided_rate']:6.1%} decided  "
+              f"prompts {result['prompt_rate']:6.1%}  false allows {result['false_allow_rate']:6.1%}  "
+              f"predict p50 {latency['p50']:8.1f}us p99 {latency['p99']:8.1f}us  "
+              f"batch {result['batch_us_per_row']:7.2f}us/row  "
+              f"size {result['model_bytes'] / 1024:9.1f}KB ({result['resident_bytes'] / 1024:9.1f}KB resident)  "
+              f"trained in {result['training_s']['last']:6.2f}s")
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump({'records': len(records), 'source': source, 'retrain_every': retrain_every,
+                       'results': results}, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+import os
+import csv
+import time
+import random
+import itertools
+import threading
+from collections import deque
+
+from utils.monitor_filters import MONITOR_TAG
+
+VENDORS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                           'RaspberryPi4_USB_Gadget', 'vendors.csv')
+
+USB_ROOT = '/sys/devices/pci0000:00/0000:00:14.0/usb1'
+
+# udev's USEC_INITIALIZED, microseconds since boot when a device was first seen, one value per enumeration
+_initialized = itertools.count(5_000_000, 1_000)
+
+
+def load_identities(path: str = VENDORS_CSV) -> []:
+    """ Load (vendor_id, product_id) pairs from vendors.csv, formatted the way udev reports them (e.g. 046d). """
+    with open(path, 'r') as file:
+        rows = list(csv.reader(file, skipinitialspace=True))
+
+    return [(vendor.lower().replace('0x', ''), product.lower().replace('0x', '')) for vendor, product, *_ in rows[1:]]
+
+
+class FakeUdevDevice:
+    """ The parts of a pyudev.Device the manager reads. """
+    __slots__ = ('action', 'subsystem', 'device_type', 'sys_path', 'device_node', 'properties', 'tags')
+
+    def __init__(self, action: str, subsystem: str, device_type: str, sys_path: str, device_node: str,
+                 properties: {} = None, tags: () = ()) -> None:
+        self.action = action
+        self.subsystem = subsystem
+        self.device_type = device_type
+        self.sys_path = sys_path
+        self.device_node = device_node
+        self.properties = properties or {}
+        self.tags = tags
+
+    def get(self, key: str, default=None):
+        return self.properties.get(key, default)
+
+    def __repr__(self) -> str:
+        return f'FakeUdevDevice({self.action} {self.subsystem}/{self.device_type} {self.sys_path})'
+
+
+class SyntheticDevice:
+    """ A physical USB mass storage device plugged into a port, with its interface, disk and partitions. """
+
+    def __init__(self, port: int, identity: (), serial: str, bus_number: int, partitions: int = 1) -> None:
+        self.vendor_id, self.product_id = identity
+        self.serial = serial
+        self.sys_path = f'{USB_ROOT}/1-{port}'
+        self.device_node = f'/dev/bus/usb/001/{bus_number:03d}'
+        self.partitions = partitions
+        self.initialized = str(next(_initialized))
+
+        disk_name = f'sd{chr(ord("b") + port % 24)}'
+        self.interface_path = f'{self.sys_path}/1-{port}:1.0'
+        self.disk_path = f'{self.interface_path}/host{port}/target{port}:0:0/{port}:0:0:0/block/{disk_name}'
+        self.disk_node = f'/dev/{disk_name}'
+
+    def _devices(self, action: str, complete: bool = True) -> []:
+        usb_properties = {'ID_VENDOR_ID': self.vendor_id, 'ID_MODEL_ID': self.product_id,
+                          'ID_SERIAL_SHORT': self.serial} if complete else {}
+        usb_properties['USEC_INITIALIZED'] = self.initialized
+        disk_properties = {'ID_PART_TABLE_TYPE': 'dos'} if self.partitions else {'ID_FS_TYPE': 'vfat'}
+
+        # Like the kernel: the device and its interface are added, then bound to their drivers (usb, usb-storage),
+        # and unbound before they are removed. Interface events carry no vendor/product IDs, like the real ones.
+        # The block devices are tagged by the manager's udev rule
+        bind, unbind = ('bind', 'unbind') if action == 'add' else ('unbind', 'bind')
+        devices = [
+            FakeUdevDevice(action, 'usb', 'usb_device', self.sys_path, self.device_node, usb_properties),
+            FakeUdevDevice(action, 'usb', 'usb_interface', self.interface_path, None),
+            FakeUdevDevice(bind, 'usb', 'usb_interface', self.interface_path, None),
+            FakeUdevDevice(bind, 'usb', 'usb_device', self.sys_path, self.device_node, usb_properties),
+            FakeUdevDevice(action, 'block', 'disk', self.disk_path, self.disk_node, disk_properties, (MONITOR_TAG,)),
+        ]
+        for number in range(1, self.partitions + 1):
+            devices.append(FakeUdevDevice(action, 'block', 'partition', f'{self.disk_path}{number}',
+                                          f'{self.disk_node}{number}', {'ID_FS_TYPE': 'vfat'}, (MONITOR_TAG,)))
+        return devices
+
+    def add_events(self, complete: bool = True) -> []:
+        return self._devices('add', complete)
+
+    def remove_events(self) -> []:
+        return list(reversed(self._devices('remove')))
+
+
+class Scenario:
+    """ Builds scripted event streams out of synthetic devices. """
+
+    def __init__(self, identities: [], seed: int = 0) -> None:
+        self.identities = identities
+        self.random = random.Random(seed)
+        self._bus_number = 1
+
+    def _device(self, port: int, serial: str = None, reuse_node: bool = False) -> SyntheticDevice:
+        if not reuse_node:
+            self._bus_number = self._bus_number % 127 + 1
+        identity = self.random.choice(self.identities)
+        serial = serial or f'{self.random.getrandbits(48):012X}'
+        return SyntheticDevice(port, identity, serial, self._bus_number, partitions=self.random.choice((0, 1, 1, 2)))
+
+    def storm(self, count: int) -> []:
+        """ Add/remove storm: devices plugged and unplugged back to back on a few ports. """
+        events = []
+        for index in range(count):
+            device = self._device(port=1 + index % 4)
+            events += device.add_events() + device.remove_events()
+        return events
+
+    def hub(self, count: int, hub_size: int = 7) -> []:
+        """ Hubs of many devices enumerating at once, then all unplugged. """
+        events = []
+        for _ in range(max(1, count // hub_size)):
+            devices = [self._device(port=port) for port in range(1, hub_size + 1)]
+            for device in devices:
+                events += device.add_events()
+            for device in devices:
+                events += device.remove_events()
+        return events
+
+    def partial_info(self, count: int) -> []:
+        """ Devices whose first event lacks vendor/product IDs, followed by the complete one. """
+        events = []
+        for index in range(count):
+            device = self._device(port=1 + index % 4)
+            events += device.add_events(complete=False)[:2] + device.add_events() + device.remove_events()
+        return events
+
+    def duplicate_nodes(self, count: int) -> []:
+        """ Duplicate add events and device nodes reused by the kernel across re-plugs. """
+        events = []
+        for index in range(count):
+            device = self._device(port=1 + index % 4, reuse_node=index % 2 == 1)
+            events += device.add_events() + device.add_events()[:1] + device.remove_events()
+        return events
+
+    def reenumeration(self, count: int) -> []:
+        """ Devices swapped on a port so fast their remove events are lost: the next device's add arrives at the
+        same sysfs path while the previous one is still considered plugged in. """
+        events = []
+        for index in range(count):
+            device = self._device(port=1 + index % 4)
+            events += device.add_events()
+            if index >= count - 4:
+                events += device.remove_events()  # Unplug what is left at the end
+        return events
+
+    def flood(self, count: int) -> []:
+        """ A BadUSB gadget (RaspberryPi4_USB_Gadget/script.sh) reconnecting on one port as fast as it can,
+        with the next identity from vendors.csv every time. """
+        events = []
+        for index in range(count):
+            self._bus_number = self._bus_number % 127 + 1
+            device = SyntheticDevice(1, self.identities[index % len(self.identities)], f'{index:010d}',
+                                     self._bus_number)
+            events += device.add_events() + device.remove_events()
+        return events
+
+    def randomized(self, count: int) -> []:
+        """ A random interleaving of the other scenarios, but the flood. """
+        builders = (self.storm, self.hub, self.partial_info, self.duplicate_nodes, self.reenumeration)
+        events = []
+        while len(events) < count * 6:
+            events += self.random.choice(builders)(self.random.randint(1, 8))
+        return events
+
+
+SCENARIOS = ('storm', 'hub', 'partial_info', 'duplicate_nodes', 'reenumeration', 'randomized', 'flood')
+
+
+class FakeMonitor:
+    """ Stand-in for pyudev.Monitor replaying a scripted stream, with libudev's kernel-side filter semantics. """
+
+    def __init__(self, events: []) -> None:
+        self._events = events
+        self._subsystems = []  # (subsystem, device_type or None)
+        self._tags = []
+        self._pending = None
+        self._pipe = None  # Readable while there are events, for select()
+        self._exhausted = False
+        self.emitted = {}  # (sys_path, device_node) -> time the add event was handed out
+        self.plugged = {}  # sys_path -> time the latest add event there was handed out
+        self.count = 0
+        self.done = threading.Event()
+
+    def filter_by(self, subsystem: str, device_type: str = None) -> None:
+        self._subsystems.append((subsystem, device_type))
+
+    def filter_by_tag(self, tag: str) -> None:
+        self._tags.append(tag)
+
+    def _matches(self, device: FakeUdevDevice) -> bool:
+        if self._subsystems and not any(device.subsystem == subsystem and device_type in (None, device.device_type)
+                                        for subsystem, device_type in self._subsystems):
+            return False
+        return not self._tags or any(tag in device.tags for tag in self._tags)
+
+    def start(self) -> None:
+        if self._pending is None:
+            number_events(self._events)
+            self._pending = deque(device for device in self._events if self._matches(device))
+
+    def fileno(self) -> int:
+        if self._pipe is None:
+            self.start()
+            self._pipe = os.pipe()
+            os.write(self._pipe[1], b'.')  # Stays readable until the reader finds the stream exhausted
+        return self._pipe[0]
+
+    def poll(self, timeout: float = None) -> FakeUdevDevice:
+        self.start()
+        if not self._pending:
+            # Polled without select(), the reader is done once None is returned. With select() it only is on the
+            # next wakeup, after putting what the previous one read
+            if self._pipe is None or self._exhausted:
+                if self._pipe is not None:
+                    os.read(self._pipe[0], 1)
+                self.done.set()
+            self._exhausted = True
+            return None
+
+        device = self._pending.popleft()
+        self.count += 1
+        if device.action == 'add' and device.device_type == 'usb_device':
+            self.emitted[(device.sys_path, device.device_node)] = self.plugged[device.sys_path] = time.monotonic()
+        return device
+
+
+def number_events(events: []) -> None:
+    """ Number the events in order, like the kernel's SEQNUM, once. """
+    for seqnum, device in enumerate(events, 1):
+        if 'SEQNUM' in device.properties:
+            return
+        device.properties = dict(device.properties, SEQNUM=str(seqnum))
+
+
+class FakeNetlink:
+    """ The kernel's side of a scripted event stream, broadcast to every monitor subscribed to it. """
+
+    def __init__(self, events: []) -> None:
+        self.events = events
+        number_events(events)
+        self.monitors = []
+
+        # Physical plugs: every enumeration of a USB device has its own USEC_INITIALIZED
+        self.plugs = len({device.get('USEC_INITIALIZED') for device in events
+                          if device.action == 'add' and device.device_type == 'usb_device'})
+
+    def monitor(self) -> FakeMonitor:
+        monitor = FakeMonitor(self.events)
+        self.monitors.append(monitor)
+        return monitor
+
+    def wait(self) -> None:
+        """ Wait for every monitor to be drained. """
+        for monitor in self.monitors:
+            monitor.done.wait()
+
+    @property
+    def count(self) -> int:
+        """ Events delivered, i.e. reader wakeups. """
+        return sum(monitor.count for monitor in self.monitors)
+
+    def emitted(self, sys_path: str, device_node: str) -> float:
+        for monitor in self.monitors:
+            emitted = monitor.emitted.get((sys_path, device_node))
+            if emitted is not None:
+                return emitted
+        return None
+
+    def plugged(self, sys_path: str) -> float:
+        """ When the latest add event at a sysfs path was handed out. """
+        for monitor in self.monitors:
+            plugged = monitor.plugged.get(sys_path)
+            if plugged is not None:
+                return plugged
+        return None
+
+
+def build_fake_sysfs(root: str, events: []) -> str:
+    """ A sysfs tree in a directory with what the enforcement backends touch: an authorized attribute for every
+    USB device of the events, the root hub's authorized_default and its /sys/bus/usb/devices link. """
+    def path(sys_path: str) -> str:
+        return os.path.join(root, os.path.relpath(sys_path, '/sys'))
+
+    for sys_path in {device.sys_path for device in events if device.device_type == 'usb_device'}:
+        os.makedirs(path(sys_path), exist_ok=True)
+        with open(os.path.join(path(sys_path), 'authorized'), 'w') as file:
+            file.write('1\n')
+
+    os.makedirs(path(USB_ROOT), exist_ok=True)
+    with open(os.path.join(path(USB_ROOT), 'authorized_default'), 'w') as file:
+        file.write('-1\n')  # The kernel's default: authorize every device that isn't wireless
+    os.makedirs(os.path.join(root, 'bus', 'usb', 'devices'), exist_ok=True)
+    os.symlink(path(USB_ROOT), os.path.join(root, 'bus', 'usb', 'devices', os.path.basename(USB_ROOT)))
+    return root
+
+
+def read_authorized(root: str, events: []) -> {}:
+    """ The authorized attribute of every USB device in a fake sysfs tree, by sysfs path. """
+    authorized = {}
+    for sys_path in {device.sys_path for device in events if device.device_type == 'usb_device'}:
+        with open(os.path.join(root, os.path.relpath(sys_path, '/sys'), 'authorized'), 'r') as file:
+            authorized[sys_path] = file.read().strip()
+    return authorized
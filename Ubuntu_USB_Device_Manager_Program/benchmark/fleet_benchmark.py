@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import shutil
+import secrets
+import argparse
+import tempfile
+import threading
+
+PROGRAM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROGRAM_DIR)  # The benchmark runs in a scratch directory, keep the program importable
+
+from loguru import logger
+
+from benchmark.run_benchmark import run_scenario
+from core.decision_journal import DecisionJournal
+from fleet.auth import TOKEN_FILE
+from fleet.policy_client import FleetClient, FLEET_REQUESTS, FLEET_CONNECTIONS, FLEET_DECISIONS
+from fleet.policy_service import PolicyService, make_server
+from ml_model.compact_model import ARTIFACT_FILE
+from ml_model.policy_table import PolicyTable
+
+
+def run_host(name: str, events: int, history: int, seed: int, fleet_service: str = None, token: str = None,
+             model_path: str = None) -> {}:
+    """ Replay a scenario through a manager in a scratch directory, standalone or in fleet mode. The model the
+    host trained is copied to model_path if given. """
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        os.makedirs('data')
+        os.makedirs('ml_model')
+        if token is not None:
+            with open(TOKEN_FILE, 'w') as file:
+                file.write(token + '\n')
+        result = run_scenario(name, events, history, seed, 0.0, 0.0, storm_guard=False, fleet_service=fleet_service)
+        if model_path is not None:
+            shutil.copy(ARTIFACT_FILE, model_path)
+        os.chdir(PROGRAM_DIR)
+    return result
+
+
+def latest_decisions(journal: DecisionJournal, host: str = None) -> {}:
+    """ Last decision per exact device in the service's journal, optionally of a single host. """
+    decisions = {}
+    for record in journal.records():
+        if 'decision' in record and host in (None, record.get('host')):
+            decisions[(record['vendor_id'], record['product_id'], record.get('serial'))] = record
+    return decisions
+
+
+def agreement(policy: PolicyTable, decisions: {}) -> float:
+    """ Fraction of the devices the policy gives the fleet's last decision for. """
+    if not decisions:
+        return 0.0
+    return sum(policy.lookup(record) == record['decision'] for record in decisions.values()) / len(decisions)
+
+
+def counter(metric, *labels) -> float:
+    return metric.labels(*labels).value
+
+
+def timed_sync(client: FleetClient) -> ():
+    """ Sync once, returns (reachable, seconds, decisions folded in). """
+    decisions = counter(FLEET_DECISIONS)
+    started = time.monotonic()
+    online = client.sync()
+    return online, time.monotonic() - started, counter(FLEET_DECISIONS) - decisions
+
+
+def run(events: int, history: int, seed: int, delay: float) -> {}:
+    """ Host A decides on a scenario against a slow service, host B catches up on them and a later delta, then
+    the service goes away and B, and a freshly started C, keep working from their caches. """
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        # Host A alone, the decision latency fleet mode must not add to. Its model is the one the service publishes
+        model_path = os.path.join(scratch, 'model_artifact.json')
+        results['standalone'] = run_host('storm', events, history, seed, model_path=model_path)
+
+        service = PolicyService(DecisionJournal(os.path.join(scratch, 'service.jsonl'), legacy_path=None),
+                                artifact_path=model_path, train_interval=None, delay=delay)
+        token = secrets.token_hex(16)
+        server = make_server(service, token, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+
+        # Host A in fleet mode, every decision is sent to the slow service
+        results['fleet'] = run_host('storm', events, history, seed, fleet_service=url, token=token)
+        results['fleet']['service_version'] = service.journal.end_offset()
+
+        # Host B joins: everything A decided, then only what came after
+        b_dir = os.path.join(scratch, 'host-b')
+        os.makedirs(b_dir)
+
+        def host(token: str = token) -> FleetClient:
+            return FleetClient(url, token, PolicyTable(), os.path.join(b_dir, 'fleet_cache.json'),
+                               DecisionJournal(os.path.join(b_dir, 'fleet_decisions.jsonl'), legacy_path=None),
+                               os.path.join(b_dir, 'model_artifact.json'))
+
+        # A host without the token gets nothing
+        intruder = host('wrong')
+        intruder.load()
+        rejected = counter(FLEET_REQUESTS, 'push', '401'), counter(FLEET_REQUESTS, 'pull', '401')
+        intruder.record([dict(record, serial='intruder') for record in latest_decisions(service.journal).values()])
+        intruder_online, _, _ = timed_sync(intruder)
+        intruder.pool.close()
+        os.remove(os.path.join(b_dir, 'fleet_cache.json'))
+
+        connections = counter(FLEET_CONNECTIONS)
+        models = counter(FLEET_REQUESTS, 'model', '200'), counter(FLEET_REQUESTS, 'model', '304')
+        b = host()
+        b.load()
+        _, full_s, full = timed_sync(b)
+
+        later = [dict(record, serial=f'{index:04X}-later') for index, record in
+                 enumerate(list(latest_decisions(service.journal).values())[:events // 10])]
+        service.add_decisions('host-a', later)
+        _, delta_s, delta = timed_sync(b)
+
+        fleet_decisions = latest_decisions(service.journal)
+        results['fleet_sync'] = {
+            'service_delay_ms': delay * 1000,
+            'full_sync_decisions': full,
+            'full_sync_ms': full_s * 1000,
+            'delta_sync_decisions': delta,
+            'delta_sync_ms': delta_s * 1000,
+            'connections_opened': counter(FLEET_CONNECTIONS) - connections,
+            'model_downloads': counter(FLEET_REQUESTS, 'model', '200') - models[0],
+            'model_not_modified': counter(FLEET_REQUESTS, 'model', '304') - models[1],
+            'policy_agreement': agreement(b.policy, fleet_decisions),
+            'host_id': b.host,
+            'wrong_token_sync_ok': intruder_online,
+            'wrong_token_rejected': (counter(FLEET_REQUESTS, 'push', '401') - rejected[0]
+                                     + counter(FLEET_REQUESTS, 'pull', '401') - rejected[1]),
+            'wrong_token_decisions_accepted': sum(record.get('serial') == 'intruder'
+                                                  for record in service.journal.records()),
+        }
+
+        # The service goes away: B keeps deciding and queues, a restarted C starts from the cache alone
+        server.shutdown()
+        server.server_close()
+        b.pool.close()  # The kept-alive connections die with the service, their handler threads would still answer
+        online, offline_s, _ = timed_sync(b)
+        b.record(later[:1])
+        b.stop()
+
+        # The same host restarted: its id, version and queue come back from the cache alone
+        c = host()
+        started = time.monotonic()
+        c.load()
+        results['fleet_offline'] = {
+            'sync_ok': online,
+            'failed_sync_ms': offline_s * 1000,
+            'queued_decisions': len(b._outbox),
+            'host_b_policy_agreement': agreement(b.policy, fleet_decisions),
+            'restart_from_cache_ms': (time.monotonic() - started) * 1000,
+            'host_c_policy_agreement': agreement(c.policy, fleet_decisions),
+            'host_c_queued_decisions': len(c._outbox),
+            'host_c_kept_host_id': c.host == b.host,
+        }
+        c.journal.close()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run hosts in fleet mode against a local, slow, then unreachable "
+                                                 "policy service")
+    parser.add_argument('--events', type=int, default=200, help="Devices host A decides on")
+    parser.add_argument('--history', type=int, default=1000, help="Synthetic decisions to train on")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--delay', type=float, default=0.2, help="Seconds the service takes per response")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='CRITICAL')
+
+    results = run(args.events, args.history, args.seed, args.delay)
+    for name in ('standalone', 'fleet'):
+        latency = results[name]['decision_latency_ms']
+        print(f"{name:12} decisions {results[name]['decisions']:5d}  p50 {latency['p50']:7.2f}ms  "
+              f"p95 {latency['p95']:7.2f}ms  p99 {latency['p99']:7.2f}ms")
+    print(json.dumps({name: results[name] for name in ('fleet_sync', 'fleet_offline')}, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+PROGRAM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROGRAM_DIR)  # The benchmark runs in a scratch directory, keep the program importable
+
+from loguru import logger
+
+from benchmark.event_replay import (Scenario, FakeNetlink, FakeUdevDevice, load_identities, build_fake_sysfs,
+                                    read_authorized, SCENARIOS, USB_ROOT)
+from core.device_manager import USBDeviceManager
+from core.storm_guard import STORM_DROPPED_EVENTS, QUARANTINES
+from core.enforcement import ENFORCEMENT_BACKENDS
+from utils.monitor_filters import filter_monitors
+from ml_model.model import train_model
+from utils.root_process_launcher import RootProcessLauncher, FakeRootHelper
+
+BASELINE_FILE = os.path.join(PROGRAM_DIR, 'benchmark', 'baselines.json')  # Machine-specific, recorded locally
+REGRESSION_TOLERANCE = 0.25  # Relative slowdown reported as a regression
+
+
+def percentile(samples: [], fraction: float) -> float:
+    """ Nearest-rank percentile of the samples, 0 if there are none. """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def rss_kb() -> int:
+    """ Resident set size of this process, in KB. """
+    with open('/proc/self/status', 'r') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def write_history(identities: [], records: int, seed: int) -> None:
+    """ Write a synthetic decision journal and train the model on it, in the current directory. """
+    rng = random.Random(seed)
+    with open('data/usb_device_logs.jsonl', 'w') as file:
+        for index in range(records):
+            vendor_id, product_id = rng.choice(identities)
+            decision = 'allow' if rng.random() < 0.7 else 'block'
+            file.write(json.dumps({'vendor_id': vendor_id, 'product_id': product_id,
+                                   'serial': f'{rng.getrandbits(16):04X}', 'device_node': '/dev/bus/usb/001/001',
+                                   'decision': decision, 'timestamp': index}) + '\n')
+    with open('data/vendor_allow_counts.json', 'w') as file:
+        json.dump({}, file)
+
+    train_model()
+
+
+def run_scenario(name: str, events: int, history: int, seed: int, prompt_delay: float, prompt_window: float,
+                 storm_guard: bool = True, enforcement: str = 'udev', fleet_service: str = None) -> {}:
+    """ Replay one scenario through a manager wired to local fakes and measure it. """
+    identities = load_identities()
+    write_history(identities, history, seed)
+
+    decisions = []
+    dialogs = []
+
+    def fake_prompt(devices_info: [{}]) -> [()]:
+        dialogs.append(len(devices_info))
+        time.sleep(prompt_delay)
+        return [(('allow' if int(device_info['serial'], 16) % 3 else 'block'), False) for device_info in devices_info]
+
+    helper = FakeRootHelper()
+    manager = USBDeviceManager(root_process_launcher=RootProcessLauncher(helper=helper), prompt=fake_prompt,
+                               enforcement=enforcement, fleet_service=fleet_service)
+    manager.readiness.timeout = 1
+    manager.PROMPT_WINDOW = prompt_window
+    manager.blacklist.path = os.path.abspath('99-usb-blacklist.rules')
+    if name != 'flood' or not storm_guard:
+        manager.storm_guard = None
+
+    # The USB and block streams, with the manager's kernel-side filters
+    netlink = FakeNetlink(getattr(Scenario(identities, seed), name)(events))
+    usb_monitor, block_monitor = netlink.monitor(), netlink.monitor()
+    filter_monitors(usb_monitor, block_monitor, tagged=True)
+
+    sysfs_root = None
+    if enforcement == 'sysfs':
+        sysfs_root = manager.enforcer.sysfs_root = build_fake_sysfs(os.path.abspath('sys'), netlink.events)
+        manager.enforcer.authorized_default = True
+
+    # Time every device from the moment its add event left the monitor until it is authorized or deauthorized
+    enforced = []
+    on_enforced = manager.enforcer.on_enforced
+
+    def enforced_hook(sys_paths: []) -> None:
+        now = time.monotonic()
+        for sys_path in sys_paths:
+            plugged = netlink.plugged(sys_path)
+            if plugged is not None:
+                enforced.append(now - plugged)
+        on_enforced(sys_paths)
+
+    manager.enforcer.on_enforced = enforced_hook
+
+    # Time every decision from the moment its add event left the monitor
+    def decided(device) -> None:
+        emitted = netlink.emitted(device.sys_path, device.device_node)
+        if emitted is not None:
+            decisions.append(time.monotonic() - emitted)
+
+    allow_usb_devices, block_usb_device = manager.allow_usb_devices, manager.block_usb_device
+
+    def allow(devices) -> None:
+        for device in devices:
+            decided(device)
+        allow_usb_devices(devices)
+
+    def block(device) -> None:
+        decided(device)
+        block_usb_device(device)
+
+    manager.allow_usb_devices, manager.block_usb_device = allow, block
+
+    stop_prompts = threading.Event()
+    prompts = threading.Thread(target=manager._prompt_user, args=(stop_prompts,), daemon=True)
+
+    rss_before = rss_kb()
+    dropped_before, quarantines_before = STORM_DROPPED_EVENTS.labels().value, QUARANTINES.labels().value
+    cpu_before = time.process_time()
+    started = time.monotonic()
+
+    prompts.start()
+    manager.start_pipeline(usb_monitor, block_monitor)
+    netlink.wait()
+    manager.wait_idle()
+
+    elapsed = time.monotonic() - started
+    cpu = time.process_time() - cpu_before
+
+    stop_prompts.set()
+    prompts.join()
+    manager.stop_pipeline()  # Flushes the blacklist, the last blocks of the udev backend are enforced here
+
+    return {
+        'events': netlink.count,
+        'elapsed_s': elapsed,
+        'events_per_second': netlink.count / elapsed if elapsed else 0.0,
+        'cpu_s': cpu,
+        'cpu_ms_per_event': cpu / netlink.count * 1000 if netlink.count else 0.0,
+        # Reader wakeups per physical plug, with the kernel-side filters and with the subsystem-only ones they
+        # replaced, which let every event of the stream through
+        'wakeups_per_plug': netlink.count / netlink.plugs if netlink.plugs else 0.0,
+        'unfiltered_wakeups_per_plug': len(netlink.events) / netlink.plugs if netlink.plugs else 0.0,
+        'decisions': len(decisions),
+        'dialogs': len(dialogs),
+        'prompted_devices': sum(dialogs),
+        'decision_latency_ms': {'p50': percentile(decisions, 0.5) * 1000, 'p95': percentile(decisions, 0.95) * 1000,
+                                'p99': percentile(decisions, 0.99) * 1000, 'max': max(decisions, default=0) * 1000},
+        'enforcement': enforcement,
+        'enforced_devices': len(enforced),
+        'enforcement_latency_ms': {'p50': percentile(enforced, 0.5) * 1000, 'p95': percentile(enforced, 0.95) * 1000,
+                                   'max': max(enforced, default=0) * 1000},
+        'deauthorized_devices': sum(value == '0' for value in read_authorized(sysfs_root, netlink.events).values())
+        if sysfs_root else None,
+        'rss_growth_kb': rss_kb() - rss_before,
+        'root_helper_operations': len(helper.operations),
+        'mounted_filesystems': sum(operation['argv'][0] == 'mount' for operation in helper.operations),
+        'storm_dropped_events': STORM_DROPPED_EVENTS.labels().value - dropped_before,
+        'port_quarantines': QUARANTINES.labels().value - quarantines_before,
+        'tracked_devices': len(manager.device_states),
+        'device_state_bytes': manager.device_states.memory_bytes(),
+        'predictor': manager.predictor.stats(),
+        'stages': manager.stats.snapshot(),
+    }
+
+
+def run_coldplug(devices: int, history: int, seed: int) -> {}:
+    """ Start a manager with the devices already attached and measure the time to a fully enforced state. """
+    identities = load_identities()
+    write_history(identities, history, seed)
+
+    helper = FakeRootHelper()
+    manager = USBDeviceManager(root_process_launcher=RootProcessLauncher(helper=helper), prompt=None)
+    manager.blacklist.path = os.path.abspath('99-usb-blacklist.rules')
+
+    scenario = Scenario(identities, seed)
+    attached = [scenario._device(port=port) for port in range(1, devices + 1)]
+    events = [event for device in attached for event in device.add_events()]
+    manager.topology.seed(events)
+
+    # The root hub and an external hub are enumerated too, and never classified
+    hubs = [FakeUdevDevice('add', 'usb', 'usb_device', USB_ROOT, '/dev/bus/usb/001/001',
+                           {'ID_VENDOR_ID': '1d6b', 'ID_MODEL_ID': '0002', 'ID_USB_INTERFACES': ':090000:'}),
+            FakeUdevDevice('add', 'usb', 'usb_device', f'{USB_ROOT}/1-{devices + 1}', '/dev/bus/usb/001/128',
+                           {'ID_VENDOR_ID': '05e3', 'ID_MODEL_ID': '0610', 'ID_USB_INTERFACES': ':090001:090002:'})]
+
+    summary = manager.coldplug(hubs + [event for event in events if event.device_type == 'usb_device'])
+    manager.online_model.checkpoint()
+    return {'devices': summary['devices'], 'hubs': summary['hubs'], 'allowed': summary['allowed'],
+            'blocked': summary['blocked'], 'untouched': summary['untouched'], 'prompted': summary['prompted'],
+            'enforced_ms': summary['enforced_after_s'] * 1000, 'root_helper_operations': len(helper.operations),
+            'mounted_filesystems': sum(operation['argv'][0] == 'mount' for operation in helper.operations)}
+
+
+def compare(results: {}, baselines: {}) -> []:
+    """ Return a line for every metric that regressed against its baseline. """
+    regressions = []
+
+    coldplug, previous = results.pop('coldplug', None), baselines.get('coldplug')
+    if coldplug and previous and coldplug['enforced_ms'] > previous['enforced_ms'] * (1 + REGRESSION_TOLERANCE) \
+            and coldplug['enforced_ms'] - previous['enforced_ms'] > 1:
+        regressions.append(f"coldplug: enforced after {coldplug['enforced_ms']:.2f}ms, "
+                           f"baseline {previous['enforced_ms']:.2f}ms")
+
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+
+        if result['events_per_second'] < baseline['events_per_second'] * (1 - REGRESSION_TOLERANCE):
+            regressions.append(f"{name}: {result['events_per_second']:.0f} events/s, "
+                               f"baseline {baseline['events_per_second']:.0f}")
+
+        for key in ('p50', 'p95'):
+            current, previous = result['decision_latency_ms'][key], baseline['decision_latency_ms'][key]
+            if current > previous * (1 + REGRESSION_TOLERANCE) and current - previous > 1:
+                regressions.append(f"{name}: decision latency {key} {current:.2f}ms, baseline {previous:.2f}ms")
+
+        for stage, stats in result['stages'].items():
+            previous = baseline['stages'].get(stage)
+            if previous and stats['avg_ms'] > previous['avg_ms'] * (1 + REGRESSION_TOLERANCE) \
+                    and stats['avg_ms'] - previous['avg_ms'] > 0.1:
+                regressions.append(f"{name}: stage {stage} {stats['avg_ms']:.3f}ms, "
+                                   f"baseline {previous['avg_ms']:.3f}ms")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay synthetic udev event streams through USBDeviceManager")
+    parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='all')
+    parser.add_argument('--events', type=int, default=200, help="Devices per scenario")
+    parser.add_argument('--history', type=int, default=1000, help="Synthetic decisions to train on")
+    parser.add_argument('--coldplug', type=int, default=100, help="Devices attached before startup, 0 to skip")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--prompt-delay', type=float, default=0.0, help="Seconds the fake user takes per popup")
+    parser.add_argument('--prompt-window', type=float, default=0.0,
+                        help="Seconds unknown devices are collected for a single popup, the manager waits "
+                             f"{USBDeviceManager.PROMPT_WINDOW}s. 0 keeps it out of the latencies of an instant user")
+    parser.add_argument('--no-storm-guard', action='store_true',
+                        help="Run the flood without the storm guard, to see what it costs unprotected")
+    parser.add_argument('--enforcement', choices=ENFORCEMENT_BACKENDS + ('both',), default='both',
+                        help="Enforcement backend the scenarios run with, both reports them side by side")
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help="Store these results as the new baseline")
+    parser.add_argument('--verbose', action='store_true', help="Show the manager's warnings and errors")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING' if args.verbose else 'CRITICAL')
+
+    results = {}
+    backends = ENFORCEMENT_BACKENDS if args.enforcement == 'both' else (args.enforcement,)
+    for name in (SCENARIOS if args.scenario == 'all' else (args.scenario,)):
+        for enforcement in backends:
+            key = name if enforcement == 'udev' else f'{name}:{enforcement}'
+            with tempfile.TemporaryDirectory() as scratch:
+                os.chdir(scratch)
+                os.makedirs('data')
+                os.makedirs('ml_model')
+                results[key] = run_scenario(name, args.events, args.history, args.seed, args.prompt_delay,
+                                            args.prompt_window, not args.no_storm_guard, enforcement)
+                os.chdir(PROGRAM_DIR)
+
+            result = results[key]
+            latency = result['decision_latency_ms']
+            print(f"{key:22} {result['events']:7d} events {result['events_per_second']:9.0f} ev/s  "
+                  f"decisions {result['decisions']:5d}  dialogs {result['dialogs']:4d}  "
+                  f"mounts {result['mounted_filesystems']:4d}  p50 {latency['p50']:7.2f}ms  "
+                  f"p95 {latency['p95']:7.2f}ms  p99 {latency['p99']:7.2f}ms  rss +{result['rss_growth_kb']}KB  "
+                  f"cpu {result['cpu_ms_per_event']:.3f}ms/ev")
+            print(f"{'':22} {result['wakeups_per_plug']:.1f} wakeups per plug, "
+                  f"{result['unfiltered_wakeups_per_plug']:.1f} without the kernel-side filters")
+            latency = result['enforcement_latency_ms']
+            print(f"{'':22} {result['enforced_devices']} devices enforced by {enforcement}, event to enforced "
+                  f"p50 {latency['p50']:7.2f}ms  p95 {latency['p95']:7.2f}ms  max {latency['max']:7.2f}ms")
+            if result['port_quarantines']:
+                print(f"{'':22} {result['port_quarantines']} ports quarantined, "
+                      f"{result['storm_dropped_events']} events dropped")
+
+    if args.coldplug:
+        with tempfile.TemporaryDirectory() as scratch:
+            os.chdir(scratch)
+            os.makedirs('data')
+            os.makedirs('ml_model')
+            results['coldplug'] = run_coldplug(args.coldplug, args.history, args.seed)
+            os.chdir(PROGRAM_DIR)
+
+        result = results['coldplug']
+        print(f"{'coldplug':22} {result['devices']:7d} devices  hubs {result['hubs']:2d}  "
+              f"allowed {result['allowed']:4d}  blocked {result['blocked']:4d}  untouched {result['untouched']:4d}  "
+              f"prompted {result['prompted']:4d}  "
+              f"mounts {result['mounted_filesystems']:4d}  enforced after {result['enforced_ms']:7.2f}ms")
+
+    config = {'events': args.events, 'history': args.history, 'seed': args.seed, 'prompt_delay': args.prompt_delay,
+              'prompt_window': args.prompt_window, 'coldplug': args.coldplug, 'storm_guard': not args.no_storm_guard,
+              'enforcement': args.enforcement}
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump({'config': config, 'results': results}, file, indent=4)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    try:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        print("No baseline to compare against, run with --save-baseline on this machine to create one")
+        return
+
+    if baseline['config'] != config:
+        print(f"Baseline was recorded with {baseline['config']}, not comparing")
+        return
+
+    regressions = compare(results, baseline['results'])
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+
+PROGRAM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROGRAM_DIR)  # The benchmark runs in a scratch directory, keep the program importable
+
+# How the manager used to start, and how main.py starts it now
+MODES = ('sync_training', 'background_training')
+
+
+def child(mode: str, launched: float) -> None:
+    """ Start a manager the way main.py does, with a device plugged in right away, and report the timings
+    relative to the moment the parent launched this process. """
+    from loguru import logger
+    logger.remove()
+
+    from core.device_manager import USBDeviceManager
+    from ml_model import model
+    from utils.root_process_launcher import RootProcessLauncher, FakeRootHelper
+    from benchmark.event_replay import Scenario, FakeMonitor, load_identities
+    imported = time.time()
+
+    if mode == 'sync_training':
+        model.train_model()
+
+    manager = USBDeviceManager(root_process_launcher=RootProcessLauncher(helper=FakeRootHelper()),
+                               prompt=lambda devices_info: [('allow', False)] * len(devices_info))
+
+    training = model.start_background_training() if mode == 'background_training' else None
+
+    # Time the first add event from the moment the manager dispatched it
+    handled = threading.Event()
+    handle_add = manager._handle_add
+
+    def first_handled(device) -> None:
+        handle_add(device)
+        handled.set()
+    manager._handle_add = first_handled
+
+    device = Scenario(load_identities())._device(port=1)
+    ready = time.time()
+    manager.start_pipeline(FakeMonitor(device.add_events()))
+    handled.wait()
+    first_event = time.time()
+
+    if training is not None:
+        training.join()
+    trained = time.time()
+
+    print(json.dumps({'python_and_imports_s': imported - launched, 'ready_s': ready - launched,
+                      'first_event_handled_s': first_event - launched, 'model_trained_s': trained - launched,
+                      'sklearn_loaded_in_daemon': 'sklearn' in sys.modules}))
+
+
+def run(mode: str, history: int, seed: int) -> {}:
+    """ Run one startup in a fresh interpreter, in a scratch directory with a saved model. """
+    from loguru import logger
+    from benchmark.event_replay import load_identities
+    from benchmark.run_benchmark import write_history
+
+    with tempfile.TemporaryDirectory() as scratch:
+        os.makedirs(os.path.join(scratch, 'data'))
+        os.makedirs(os.path.join(scratch, 'ml_model'))
+
+        cwd = os.getcwd()
+        os.chdir(scratch)
+        logger.remove()
+        write_history(load_identities(), history, seed)  # Leaves the last saved model behind, like a restart
+        os.chdir(cwd)
+
+        launched = time.time()
+        completed = subprocess.run([sys.executable, '-m', 'benchmark.startup_benchmark', '--child', mode,
+                                    '--launched', repr(launched)], cwd=scratch, capture_output=True, text=True,
+                                   env=dict(os.environ, PYTHONPATH=PROGRAM_DIR), check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure the time from launching the manager to handling its "
+                                                 "first device")
+    parser.add_argument('--history', type=int, default=5000, help="Decisions in the journal at startup")
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--launched', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.launched)
+        return
+
+    for mode in MODES:
+        runs = sorted((run(mode, args.history, args.seed) for _ in range(args.runs)),
+                      key=lambda result: result['first_event_handled_s'])
+        median = runs[len(runs) // 2]
+        print(f"{mode:20} imports {median['python_and_imports_s'] * 1000:7.1f}ms  "
+              f"ready {median['ready_s'] * 1000:7.1f}ms  "
+              f"first event handled {median['first_event_handled_s'] * 1000:7.1f}ms  "
+              f"model trained {median['model_trained_s'] * 1000:7.1f}ms  "
+              f"sklearn in daemon: {median['sklearn_loaded_in_daemon']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import random
+import itertools
+import argparse
+
+PROGRAM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROGRAM_DIR)  # The benchmark runs in a scratch directory, keep the program importable
+
+from benchmark.event_replay import load_identities
+
+# Share of vendors the user trusts, is unsure about and distrusts, with the probability of allowing their devices
+VENDOR_KINDS = ((0.7, 0.95), (0.2, 0.5), (0.1, 0.05))
+
+
+def synthetic_history(records: int, seed: int = 0, vendors: int = 200, identities: [] = None,
+                      repeat: float = 0.6, stick: float = 0.97) -> {}:
+    """ Stream a synthetic decision history shaped like a real one, oldest first, in the journal's format. """
+    rng = random.Random(seed)
+    identities = identities if identities is not None else load_identities()
+
+    # Products per vendor, the real ones first
+    products = {}
+    for vendor_id, product_id in identities:
+        products.setdefault(vendor_id, []).append(product_id)
+    while len(products) < vendors:
+        products.setdefault(f'{rng.getrandbits(16):04x}', [])
+    for vendor_id, vendor_products in products.items():
+        while len(vendor_products) < 1 + int(rng.expovariate(1 / 4)):
+            vendor_products.append(f'{rng.getrandbits(16):04x}')
+
+    # Allow probability of each product, around its vendor's
+    allow_probability = {}
+    for vendor_id, vendor_products in products.items():
+        weight = rng.random()
+        for share, probability in VENDOR_KINDS:
+            if weight < share:
+                break
+            weight -= share
+        for product_id in vendor_products:
+            allow_probability[(vendor_id, product_id)] = min(1.0, max(0.0, probability + rng.gauss(0, 0.05)))
+
+    # A few vendors make most of the devices
+    vendor_ids = list(products)
+    vendor_weights = [1 / (rank + 1) for rank in range(len(vendor_ids))]
+    rng.shuffle(vendor_weights)
+    cumulative_weights = list(itertools.accumulate(vendor_weights))
+
+    devices = []  # (vendor, product, serial, last decision), in the order they were first seen
+    timestamp = 1.7e9
+    for _ in range(records):
+        timestamp += rng.expovariate(1 / 600)
+        if devices and rng.random() < repeat:
+            # Recently seen devices come back more often than old ones
+            index = len(devices) - 1 - min(int(rng.expovariate(1 / 50)), len(devices) - 1)
+            vendor_id, product_id, serial, decision = devices[index]
+            if rng.random() >= stick:
+                decision = 'block' if decision == 'allow' else 'allow'
+            devices[index] = (vendor_id, product_id, serial, decision)
+        else:
+            vendor_id = rng.choices(vendor_ids, cum_weights=cumulative_weights)[0]
+            product_id = rng.choice(products[vendor_id])
+            serial = f'{rng.getrandbits(48):012X}'
+            decision = 'allow' if rng.random() < allow_probability[(vendor_id, product_id)] else 'block'
+            devices.append((vendor_id, product_id, serial, decision))
+
+        yield {'vendor_id': vendor_id, 'product_id': product_id, 'serial': serial,
+               'device_node': '/dev/bus/usb/001/001', 'decision': decision, 'timestamp': timestamp}
+
+
+def write_synthetic_history(path: str, records: int, seed: int = 0, vendors: int = 200) -> None:
+    """ Write a synthetic history as a decision journal. """
+    with open(path, 'w') as file:
+        for record in synthetic_history(records, seed, vendors):
+            file.write(json.dumps(record) + '\n')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Write a synthetic decision history, in the decision journal's "
+                                                 "format")
+    parser.add_argument('output', help="Journal to write, e.g. data/usb_device_logs.jsonl in a scratch directory")
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--vendors', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_synthetic_history(args.output, args.records, args.seed, args.vendors)
+
+
+if __name__ == '__main__':
+    main()
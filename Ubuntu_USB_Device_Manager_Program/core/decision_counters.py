@@ -0,0 +1,106 @@
+import os
+import json
+import threading
+from loguru import logger
+
+COUNTERS_FILE = 'data/vendor_allow_counts.json'
+COUNTERS_FORMAT = 2  # The first format was a flat {vendor_id: auto-allow count}
+
+# What is counted: the user's decisions, and the auto-allow ticks that end up allowing a whole vendor
+DECISION_TYPES = ('allow', 'block', 'auto_allow')
+
+
+class DecisionCounters:
+    """ Decision counts per vendor and per (vendor, product), kept in memory and written behind as snapshots. """
+
+    FLUSH_INTERVAL = 5  # Seconds
+
+    def __init__(self, path: str = COUNTERS_FILE, flush_interval: float = FLUSH_INTERVAL) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self._counts = {decision: {} for decision in DECISION_TYPES}  # decision -> {vendor or vendor:product -> n}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # One snapshot written at a time
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self) -> None:
+        """ Load the last snapshot, in either format. """
+        try:
+            with open(self.path, 'r') as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError:
+            logger.error(f"Decision counters snapshot {self.path} is corrupted, starting from zero")
+            return
+
+        counts = snapshot['counts'] if snapshot.get('format') == COUNTERS_FORMAT else {'auto_allow': snapshot}
+        with self._lock:
+            for decision, decision_counts in counts.items():
+                self._counts.setdefault(decision, {}).update(decision_counts)
+
+    @staticmethod
+    def _product_key(vendor_id: str, product_id: str) -> str:
+        return f'{vendor_id}:{product_id}'
+
+    def increment(self, decision: str, vendor_id: str, product_id: str = None) -> int:
+        """ Count one more decision for the vendor, and for the (vendor, product) pair if given.
+        Returns the vendor's new count. """
+        with self._lock:
+            counts = self._counts.setdefault(decision, {})
+            vendor_count = counts[vendor_id] = counts.get(vendor_id, 0) + 1
+            if product_id is not None:
+                key = self._product_key(vendor_id, product_id)
+                counts[key] = counts.get(key, 0) + 1
+            self._dirty = True
+        return vendor_count
+
+    def get(self, decision: str, vendor_id: str, product_id: str = None) -> int:
+        """ The count of a decision for a vendor, or for a (vendor, product) pair. """
+        key = vendor_id if product_id is None else self._product_key(vendor_id, product_id)
+        return self._counts.get(decision, {}).get(key, 0)
+
+    def vendor_counts(self, decision: str) -> {}:
+        """ The per-vendor counts of a decision, e.g. the auto-allow ticks the policy table needs. """
+        with self._lock:
+            return {key: count for key, count in self._counts.get(decision, {}).items() if ':' not in key}
+
+    def flush(self) -> bool:
+        """ Write a snapshot if anything changed since the last one. Returns whether one was written. """
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return False
+                snapshot = {'format': COUNTERS_FORMAT,
+                            'counts': {decision: dict(counts) for decision, counts in self._counts.items()}}
+                self._dirty = False
+
+            temp_path = f'{self.path}.tmp'
+            try:
+                with open(temp_path, 'w') as file:
+                    json.dump(snapshot, file)
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                logger.error(f"Failed to write the decision counters to {self.path}: {e}")
+                with self._lock:
+                    self._dirty = True  # Try again on the next flush
+                return False
+            return True
+
+    def start(self) -> None:
+        """ Start writing snapshots in the background. """
+        self._thread = threading.Thread(target=self._run, name='decision-counters', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self) -> None:
+        """ Stop the background writer and leave the final counts behind. """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
@@ -0,0 +1,203 @@
+import os
+import json
+import mmap
+import threading
+from loguru import logger
+
+JOURNAL_FILE = 'data/usb_device_logs.jsonl'
+LEGACY_LOG_FILE = 'data/usb_device_logs.json'
+
+# First line of a rotated journal: the logical offset of its byte 0, so offsets handed out before a rotation
+# (e.g. the online model's checkpoint) stay valid after it. Fixed width, so it can be computed before it's written
+BASE_HEADER = b'{"journal_base": %20d}\n'
+BASE_HEADER_SIZE = len(BASE_HEADER % 0)
+ARCHIVES = 3  # Rotated-out parts kept next to the journal, as .1 (newest) to .3
+
+
+def _parse_header(header: bytes) -> ():
+    """ Return (logical offset of byte 0, byte where the records start) from the journal's first bytes. """
+    if header.startswith(b'{"journal_base"') and len(header) == BASE_HEADER_SIZE:
+        return json.loads(header)['journal_base'], BASE_HEADER_SIZE
+    return 0, 0
+
+
+class DecisionJournal:
+    """ Append-only, fsync'd journal of the user's decisions, one JSON object per line, with logical offsets. """
+
+    def __init__(self, path: str = JOURNAL_FILE, legacy_path: str = LEGACY_LOG_FILE) -> None:
+        self.path = path
+        self.legacy_path = legacy_path
+        self._file = None
+        self._base = 0  # Logical offset of the open journal's byte 0
+        self._lock = threading.Lock()
+        self._migrated = False
+
+    def migrate(self) -> None:
+        """ One-time migration of the legacy JSON array log into the journal, if it has one. """
+        if self._migrated:
+            return
+        self._migrated = True
+
+        if self.legacy_path is None or os.path.exists(self.path) or not os.path.exists(self.legacy_path):
+            return
+
+        try:
+            with open(self.legacy_path, 'r') as file:
+                records = json.load(file)
+        except json.JSONDecodeError:
+            logger.error(f"Legacy log {self.legacy_path} is corrupted, starting a new journal")
+            records = []
+
+        # Write the migrated journal next to the final one and swap it in atomically
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as file:
+            for record in records:
+                file.write(json.dumps(record) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+        # Keep the legacy file around, but out of the way
+        os.replace(self.legacy_path, f'{self.legacy_path}.migrated')
+        logger.info(f"Migrated {len(records)} records from {self.legacy_path} to {self.path}")
+
+    def _open(self) -> None:
+        """ Open the journal for appending, repairing a torn last line left by a crash. """
+        self.migrate()
+        self._file = open(self.path, 'a+b')
+
+        self._file.seek(0)
+        self._base, _ = _parse_header(self._file.read(BASE_HEADER_SIZE))
+
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() > 0:
+            self._file.seek(-1, os.SEEK_END)
+            if self._file.read(1) != b'\n':
+                self._file.write(b'\n')
+
+    def append(self, *records: {}) -> None:
+        """ Append records with a single fsync. Costs the same regardless of the journal's size. """
+        lines = b''.join((json.dumps(record) + '\n').encode() for record in records)
+
+        with self._lock:
+            if self._file is None:
+                self._open()
+            self._file.write(lines)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def records(self, offset: int = 0) -> {}:
+        """ Stream the journal's records, oldest first, starting at the given byte offset. """
+        for record, _ in self.records_with_offsets(offset):
+            yield record
+
+    def records_with_offsets(self, offset: int = 0) -> ():
+        """ Stream (record, offset just past the record) pairs, starting at the given byte offset. """
+        self.migrate()
+
+        try:
+            file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+
+        with file:
+            base, start = _parse_header(file.read(BASE_HEADER_SIZE))
+            position = offset - base
+            if position < start:
+                if offset > 0:
+                    logger.warning(f"Records of {self.path} before offset {base + start} were rotated out")
+                position = start
+
+            file.seek(position)
+            for line in file:
+                position += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line), base + position
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping torn record in {self.path} before offset {base + position}")
+
+    def end_offset(self) -> int:
+        """ Return the journal's current size in bytes, usable as a resume offset for records(). """
+        with self._lock:
+            if self._file is not None:
+                return self._base + self._file.tell()
+        try:
+            with open(self.path, 'rb') as file:
+                base, _ = _parse_header(file.read(BASE_HEADER_SIZE))
+                return base + os.fstat(file.fileno()).st_size
+        except FileNotFoundError:
+            return 0
+
+    def rotate(self, offset: int, keep_records: int = 0, archives: int = ARCHIVES) -> int:
+        """ Archive the records before the logical offset, but the last keep_records. Returns the bytes rotated out. """
+        self.migrate()
+
+        with self._lock:
+            try:
+                source = open(self.path, 'rb')
+            except FileNotFoundError:
+                return 0
+
+            with source:
+                size = os.fstat(source.fileno()).st_size
+                if size == 0:
+                    return 0
+
+                with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    base, start = _parse_header(data[:BASE_HEADER_SIZE])
+
+                    # Cut at the offset, or before the most recent records if they are to be kept
+                    keep_from = size
+                    for _ in range(keep_records):
+                        keep_from = data.rfind(b'\n', start, keep_from - 1) + 1
+                        if keep_from <= start:
+                            break
+                    cut = min(offset - base, keep_from)
+                    if cut <= start:
+                        return 0
+
+                    with memoryview(data) as view:
+                        if archives > 0:
+                            for index in range(archives, 1, -1):
+                                if os.path.exists(f'{self.path}.{index - 1}'):
+                                    os.replace(f'{self.path}.{index - 1}', f'{self.path}.{index}')
+                            with open(f'{self.path}.1', 'wb') as archive:
+                                archive.write(view[start:cut])
+
+                        # The tail keeps its logical offsets: the header accounts for the bytes cut off
+                        temp_path = f'{self.path}.tmp'
+                        with open(temp_path, 'wb') as file:
+                            file.write(BASE_HEADER % (base + cut - BASE_HEADER_SIZE))
+                            file.write(view[cut:])
+                            file.flush()
+                            os.fsync(file.fileno())
+
+            # Appends continue on the new file
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            os.replace(temp_path, self.path)
+
+        logger.info(f"Rotated {cut - start} bytes of decisions out of {self.path}")
+        return cut - start
+
+    def close(self) -> None:
+        """ Close the append handle. """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_default_journal = None
+
+
+def get_journal() -> DecisionJournal:
+    """ Return the process-wide decision journal. """
+    global _default_journal
+
+    if _default_journal is None:
+        _default_journal = DecisionJournal()
+    return _default_journal
@@ -1,149 +1,645 @@
-import subprocess
+import threading
+import itertools
+import functools
+import select
+import queue
 import pyudev
 import time
-import json
 from loguru import logger
 
 from core.usb_device import USBDevice
-from core.device_utils import get_block_device, get_lsblk_device, log_usb_device, update_udev_rules, mount_device, unmount_device
-from gui.usb_alert import show_usb_alert
-from ml_model.model import predict
+from core.device_utils import log_usb_devices, is_hub
+from core.mount_registry import MountRegistry
+from core.mount_engine import MountEngine
+from core.event_pipeline import StageStats, KeyedExecutor
+from core.partition_readiness import PartitionReadinessTracker
+from core.device_topology import DeviceTopology
+from core.device_state import DeviceStateTable, PENDING, ALLOWED, MOUNTED, BLOCKED
+from core.decision_journal import get_journal
+from core.decision_counters import DecisionCounters
+from core.enforcement import create_enforcer
+from core.storm_guard import StormGuard, STORM_DROPPED_PROMPTS, port_of, port_disable_path
+from fleet.auth import TOKEN_FILE, read_token
+from fleet.policy_client import FleetClient
+from ml_model.model import ModelPredictor
+from ml_model.online_model import OnlineModel
+from ml_model.policy_table import PolicyTable
+from ml_model.training_store import TrainingStore
 from utils.auto_mount_handler import enable_auto_mount, disable_auto_mount
+from utils.monitor_filters import HANDLED_ACTIONS, tag_usb_block_devices, untag_usb_block_devices, filter_monitors
 from utils.root_process_launcher import RootProcessLauncher
-
-LOG_FILE = 'data/usb_device_logs.json'
+from utils.udev_rule_set import UdevRuleSet, BLACKLIST_RULES_FILE
+from utils.metrics import REGISTRY, TextfileExporter, UnixSocketExporter
+
+MONITOR_EVENTS = REGISTRY.counter('usb_manager_monitor_events_total',
+                                  "Events read off the netlink sockets, each one a wakeup of the reader",
+                                  ('subsystem',))
+IGNORED_EVENTS = REGISTRY.counter('usb_manager_ignored_events_total',
+                                  "Events read with an action the manager doesn't handle", ('subsystem', 'action'))
+EVENTS = REGISTRY.counter('usb_manager_events_total', "udev events received", ('subsystem', 'action'))
+INCOMPLETE_EVENTS = REGISTRY.counter('usb_manager_incomplete_events_total',
+                                     "Add events skipped while waiting for the vendor/product IDs")
+DUPLICATES_SKIPPED = REGISTRY.counter('usb_manager_duplicates_skipped_total', "Add events for an already seen device")
+DEFERRED_EVENTS = REGISTRY.counter('usb_manager_deferred_events_total', "Events held back while the user decides")
+AUTO_ALLOWS = REGISTRY.counter('usb_manager_auto_allows_total', "Devices allowed by the model without a popup")
+AUTO_BLOCKS = REGISTRY.counter('usb_manager_auto_blocks_total', "Devices blocked by the policy table without a popup")
+PROMPTS = REGISTRY.counter('usb_manager_prompts_total', "Popups shown to the user")
+PROMPTED_DEVICES = REGISTRY.counter('usb_manager_prompted_devices_total', "Devices the user was asked about")
+DECISIONS = REGISTRY.counter('usb_manager_decisions_total', "Decisions made by the user", ('decision',))
+QUEUE_DEPTH = REGISTRY.gauge('usb_manager_queue_depth', "Items waiting in each pipeline queue", ('queue',))
+
+
+def show_usb_alerts(devices_info: [{}]) -> [()]:
+    """ Show the USB alert popup for one or more devices, GTK is only imported once a popup is actually needed. """
+    from gui.usb_alert import show_usb_alerts
+    return show_usb_alerts(devices_info)
 
 
 class USBDeviceManager:
     """ Manages the monitoring and blocking/allowing of USB devices. """
 
-    DEBOUNCE_TIME = 1
-
-    def __init__(self, sudo_password: str) -> None:
-        self.seen_devices = set()
-        self.root_process_launcher = RootProcessLauncher(sudo_password)
+    PRIVILEGED_WORKERS = 4  # Devices whose privileged work can run concurrently
+    PARTITION_TIMEOUT = 10  # Seconds to wait for an allowed device's partition
+    METRICS_TEXTFILE = 'data/usb_device_manager.prom'  # For node_exporter's textfile collector, None to disable
+    METRICS_SOCKET = 'data/metrics.sock'  # Prometheus text over HTTP on a Unix socket, None to disable
+    PROMPT_WINDOW = 0.3  # Seconds to wait for more unknown devices (e.g. the rest of a hub) before the popup
+    MAX_PROMPT_DEVICES = 16  # Devices shown in a single popup
+    DISABLE_QUARANTINED_PORTS = True  # Turn a port plugging devices in a loop off for its quarantine
+    ENFORCEMENT = 'udev'  # 'udev': blacklist rules and a re-trigger, 'sysfs': writes to the authorized attribute
+    AUTHORIZED_DEFAULT = False  # sysfs: new devices start unauthorized until they are allowed
+    COLDPLUG_PROMPT = False  # Ask about the unknown devices attached at startup, rather than leave them working
+    FLEET_SERVICE = None  # URL of the fleet policy service (e.g. 'https://policy:8650'), None for a standalone host
+    FLEET_TOKEN_FILE = TOKEN_FILE  # Secret the service authenticates hosts with
+    FLEET_CA_FILE = None  # CA certificate(s) of the service's HTTPS certificate, None for the system's
+
+    def __init__(self, sudo_password: str = None, root_process_launcher: RootProcessLauncher = None,
+                 prompt=show_usb_alerts, enforcement: str = None, fleet_service: str = None) -> None:
+        self.device_states = DeviceStateTable()  # Bounded state of every device being handled, see _device_key
+        self.root_process_launcher = root_process_launcher or RootProcessLauncher(sudo_password)
+        # Asks the user about a list of devices, returns a (decision, auto_allow) pair for each, None if undecided
+        self.prompt = prompt
+        self.blacklist = UdevRuleSet(self.root_process_launcher, BLACKLIST_RULES_FILE)
+
+        # Decisions the last training compacted into the columnar store are rotated out of the raw journal
+        self.training_store = TrainingStore()
+        self.training_store.rotate_journal(get_journal())
+
+        # Online model that learns from every decision, resumed from its last checkpoint
+        self.online_model = OnlineModel(get_journal())
+        self.online_model.resume(self.training_store)
+
+        # Explicit verdicts compiled from past decisions, consulted before any model
+        self.policy = PolicyTable()
+        self.policy.build(get_journal(), self.training_store)
+
+        # Fleet mode: the other hosts' decisions, from a local cache synced in the background, in a table of their
+        # own consulted after the local one, so a remote decision never overrides a local one
+        fleet_service = fleet_service or self.FLEET_SERVICE
+        self.fleet = None
+        if fleet_service:
+            try:
+                self.fleet = FleetClient(fleet_service, read_token(self.FLEET_TOKEN_FILE), cafile=self.FLEET_CA_FILE)
+            except (OSError, ValueError) as e:
+                logger.error(f"Fleet mode disabled, can't read the fleet token: {e}")
+        if self.fleet is not None:
+            self.fleet.load()
+            self.policy.fallback = self.fleet.policy
+
+        # Decision counts per vendor and product, kept in memory and written behind
+        self.counters = DecisionCounters()
+        self.counters.load()
+
+        # Keeps the model resident between events
+        self.predictor = ModelPredictor(self.online_model, self.policy, self.counters)
+        self.mount_registry = MountRegistry()  # Mounts we made, so removal is a lookup
+
+        # Staged pipeline: reader -> classifier -> privileged workers / GUI prompts
+        self.stats = StageStats()
+        self.events = queue.Queue()  # udev events and user decisions, consumed by the classifier
+        self.prompts = queue.Queue()  # Devices waiting for the user, consumed by the GUI stage
+        self.privileged = KeyedExecutor('privileged', self.PRIVILEGED_WORKERS, self.stats)
+        self._awaiting_decision = {}  # Device key -> events held back until the user's decision is applied
+        self._incomplete_since = {}  # Device key -> when its first event without vendor/product IDs arrived
+        self._classifier = None
+
+        # Live index of USB devices and their block devices, kept current from the monitor's events
+        self.topology = DeviceTopology()
+
+        # Completes mounts as soon as the allowed device's partition is added
+        self.readiness = PartitionReadinessTracker(self.topology, self.PARTITION_TIMEOUT)
+
+        # Mounts all the filesystems of the allowed devices, at collision-free mount points
+        self.mount_engine = MountEngine(self.root_process_launcher, self.mount_registry, self.topology)
+
+        # Applies the allow/block decisions to the devices, the udev rules or their sysfs authorized attribute
+        self.enforcer = create_enforcer(enforcement or self.ENFORCEMENT, self.root_process_launcher, self.blacklist,
+                                        self.topology, self.AUTHORIZED_DEFAULT, self._enforced)
+
+        # Rate limits plugs per physical port, a port plugging devices in a loop is quarantined, None to disable
+        self.storm_guard = StormGuard(on_quarantine=self._quarantine_port, on_release=self._release_port)
 
     def allow_usb_device(self, device: USBDevice) -> None:
         """ Logic to allow and automatically mount the USB device. """
-        logger.info(f"Allowing and mounting USB Device: {device.vendor_id} - {device.product_id}")
-        time.sleep(2)
-        # Get the block device (e.g., /dev/sdb1)
-        block_device = get_lsblk_device(device.device_node)
-
-        if not block_device:
-            logger.error(f"Unable to identify block device for {device.device_node}.")
-            return
-
-        mount_device(self.root_process_launcher, device, block_device)
+        self.allow_usb_devices([device])
+
+    def allow_usb_devices(self, devices: [USBDevice]) -> None:
+        """ Allow several devices. Those whose block device is already there are mounted together, in one batch,
+        the others as soon as their block device (e.g., /dev/sdb1) shows up, on their own worker. """
+        allowed = time.monotonic()
+        ready = []
+        collecting = True
+        lock = threading.Lock()
+
+        def block_device_ready(device: USBDevice, block_device: str) -> None:
+            self.stats.observe('block_device_discovery', time.monotonic() - allowed)
+            with lock:
+                if collecting:
+                    ready.append((device, block_device))
+                    return
+            self.privileged.submit(self._device_key(device), 'mount', self._mount_allowed_devices,
+                                   [(device, block_device)], allowed)
+
+        for device in devices:
+            logger.info(f"Allowing and mounting USB Device: {device.vendor_id} - {device.product_id}")
+            self.device_states.set_state(self._device_key(device), ALLOWED, device)
+            self.readiness.wait_for(device.sys_path,
+                                    lambda block_device, device=device: block_device_ready(device, block_device))
+
+        # Authorizing them (if they start unauthorized) is what makes their block devices show up
+        self.enforcer.allow(devices)
+
+        with lock:
+            collecting = False
+        if ready:
+            self._mount_allowed_devices(ready, allowed)
+
+    def _mount_allowed_devices(self, mounts: [()], allowed: float) -> None:
+        """ Mount every filesystem of allowed devices once their first block device is ready, given as
+        (device, block device) pairs. The block device is None when the wait timed out. """
+        mounted = {entry.sys_path for entry in self.mount_engine.mount(mounts)}
+        for device, _ in mounts:
+            if device.sys_path in mounted:
+                self.device_states.set_state(self._device_key(device), MOUNTED)
+                self.stats.observe('allow_to_mounted', time.monotonic() - allowed)
+            elif not self.mount_registry.entries_of(device.device_node, device.sys_path):
+                logger.error(f"Unable to identify block device for {device.device_node}.")
 
     def block_usb_device(self, device: USBDevice) -> None:
-        """ Block the USB device by unmounting and powering it off. """
+        """ Block the USB device by deauthorizing it. """
         logger.info(f"Blocking USB Device: {device.vendor_id} - {device.product_id}")
+        if self.enforcer.block(device):
+            self.device_states.set_state(self._device_key(device), BLOCKED)
+
+    def _enforced(self, sys_paths: []) -> None:
+        """ Called by the enforcement backend once devices are authorized or deauthorized as decided. """
+        now = time.monotonic()
+        for sys_path in sys_paths:
+            record = self.device_states.get(sys_path)
+            if record is not None:
+                self.stats.observe('event_to_enforced', now - record.added)
+
+    def block_usb_devices(self, devices: [USBDevice]) -> None:
+        """ Block several devices with a single rewrite of the blacklist and one trigger. """
+        for device in devices:
+            self.block_usb_device(device)
+        self.enforcer.flush()
+
+    def _quarantine_port(self, port: str) -> None:
+        """ Called by the storm guard when it quarantines a port. """
+        if self.DISABLE_QUARANTINED_PORTS:
+            self.privileged.submit(port, 'quarantine', self._set_port_disabled, port, True)
+
+    def _release_port(self, port: str) -> None:
+        """ Called by the storm guard when a port's quarantine ends. """
+        if self.DISABLE_QUARANTINED_PORTS:
+            self.privileged.submit(port, 'quarantine', self._set_port_disabled, port, False)
+
+    def _set_port_disabled(self, port: str, disabled: bool) -> None:
+        """ Turn a hub port off or back on through its sysfs disable attribute (Linux 4.20 and later). """
+        result = self.root_process_launcher.execute_with_input(f'tee {port_disable_path(port)}',
+                                                               '1' if disabled else '0', check=False)
+        if result.returncode != 0:
+            logger.error(f"Failed to turn port {port} {'off' if disabled else 'back on'}: {result.stderr}")
+        else:
+            logger.info(f"Port {port} turned {'off' if disabled else 'back on'}")
+
+    def _device_key(self, device) -> str:
+        """ Key that keeps all the work for one physical device in order. """
+        return device.sys_path or device.device_node
+
+    def _read_events(self, *monitors: pyudev.Monitor) -> None:
+        """ Reader stage: drain the netlink sockets into the event queue, in kernel order. """
+        if len(monitors) == 1:
+            for device in iter(monitors[0].poll, None):
+                self._read_event(device, time.monotonic())
+            return
 
-        block_device = get_block_device(device.device_node)
+        while True:
+            select.select(monitors, [], [])
+            devices = [device for monitor in monitors for device in iter(functools.partial(monitor.poll, 0), None)]
+            received = time.monotonic()
+            devices.sort(key=lambda device: int(device.get('SEQNUM') or 0))
+            for device in devices:
+                self._read_event(device, received)
+
+    def _read_event(self, device: pyudev.Device, received: float) -> None:
+        MONITOR_EVENTS.labels(device.subsystem).inc()
+        if device.action not in HANDLED_ACTIONS.get(device.subsystem, ()):
+            IGNORED_EVENTS.labels(device.subsystem, device.action).inc()  # bind, unbind...
+            return
+        self.events.put(('udev', device, received))
+
+    def _classify_events(self) -> None:
+        """ Classifier stage: dedupe events, run predictions and dispatch the resulting work. """
+        while True:
+            item = self.events.get()
+            if item is None:
+                self.events.task_done()
+                return
+
+            kind, payload, received = item
+            self.stats.observe('event_queue_wait', time.monotonic() - received)
+
+            try:
+                if kind == 'udev':
+                    self._handle_udev_event(payload)
+                elif kind == 'decisions':
+                    self._handle_decisions(payload)
+                elif kind == 'applied':
+                    self._release_deferred(payload)
+            except Exception:
+                logger.exception(f"Failed to handle {kind} event")
+            self.events.task_done()
+
+    def _handle_udev_event(self, device: pyudev.Device) -> None:
+        """ Handle a single udev event, deferring it while its device waits for the user. """
+        EVENTS.labels(device.subsystem, device.action).inc()
+
+        # A port over its plug rate costs a lookup per event, its removes still clean up what was handled
+        if self.storm_guard is not None and device.subsystem == 'usb' and device.action != 'remove':
+            port = port_of(device)
+            if device.action == 'add' and device.device_type == 'usb_device' and device.get('ID_VENDOR_ID'):
+                if not self.storm_guard.admit(port, time.monotonic()):
+                    return
+            elif self.storm_guard.quarantined(port):
+                return
+
+        node = self.topology.update(device)
+        if device.subsystem == 'block':
+            if node is not None and device.action == 'add' and not self.readiness.block_device_added(node):
+                # A partition of a device that is mounted already, e.g. the second one of a drive
+                record = self.device_states.get(node.usb_parent)
+                if record is not None and record.state in (ALLOWED, MOUNTED) and node.fs_type:
+                    self.privileged.submit(node.usb_parent, 'mount', self._mount_allowed_devices,
+                                           [(record.device, None)], time.monotonic())
+            return
 
-        if not block_device:
-            logger.error(f"Unable to identify block device for {device.device_node}.")
+        key = self._device_key(device)
+        if key in self._awaiting_decision:
+            DEFERRED_EVENTS.inc()
+            self._awaiting_decision[key].append(device)
             return
 
-        # The udev rule to block the USB device
-        blocking_command = f'ATTR{{idVendor}}=="{device.vendor_id}", ATTR{{idProduct}}=="' \
-                           f'{device.product_id}", ATTR{{authorized}}="0"'
+        if device.action == 'add':  # New USB device was plugged
+            self._handle_add(device)
+        elif device.action == 'remove':  # USB device was unplugged
+            self._handle_remove(device)
+
+    def _handle_add(self, device: pyudev.Device) -> None:
+        """ Predict a decision for a newly plugged device, or queue it for the user. """
+        # Fetch USB device information
+        vendor_id = device.get('ID_VENDOR_ID')
+        product_id = device.get('ID_MODEL_ID')
+        serial = device.get('ID_SERIAL_SHORT')
+        device_node = device.device_node
+        sys_path = device.sys_path
+
+        # If incomplete info, skip it and wait for the complete event
+        key = self._device_key(device)
+        if not vendor_id or not product_id:
+            INCOMPLETE_EVENTS.inc()
+            self._incomplete_since.setdefault(key, time.monotonic())
+            return
 
-        # Command to append the blocking rule to the udev file
-        echo_command = 'tee -a /etc/udev/rules.d/99-usb-blacklist.rules'
+        incomplete_since = self._incomplete_since.pop(key, None)
+        if incomplete_since is not None:
+            self.stats.observe('debounce', time.monotonic() - incomplete_since)
 
+        # Check if we've already processed this device (avoid duplicate popups). Keyed by sysfs path, the kernel
+        # hands a device node out again while the remove of its previous owner may still be held back
+        if self.device_states.add(key, device) is None:
+            DUPLICATES_SKIPPED.inc()
+            logger.error(f"Device {device_node} already processed, skipping...")
+            return
+
+        # Parse device info
+        usb_device = USBDevice(vendor_id, product_id, serial, device_node, sys_path)
+
+        # Check if the model predicts an automatic allow/block
+        started = time.monotonic()
+        prediction = self.predictor.predict(vars(usb_device))
+        self.stats.observe('predict', time.monotonic() - started)
+
+        if prediction == 'allow':
+            AUTO_ALLOWS.inc()
+            logger.info(f"Automatically allowing device: {usb_device.vendor_id}")
+            self.privileged.submit(self._device_key(usb_device), 'allow', self.allow_usb_device, usb_device)
+        elif prediction == 'block':
+            # Explicitly blocked before, no dialog
+            AUTO_BLOCKS.inc()
+            logger.info(f"Automatically blocking device: {usb_device.vendor_id}:{usb_device.product_id}")
+            self.privileged.submit(self._device_key(usb_device), 'block', self.block_usb_device, usb_device)
+        else:
+            # If the prediction is unknown, ask the user with popup, holding back this device's later events
+            self._awaiting_decision[key] = []
+            self.device_states.set_state(key, PENDING)
+            self.prompts.put((usb_device, time.monotonic()))
+
+    def _handle_remove(self, device: pyudev.Device) -> None:
+        """ Forget an unplugged device and unmount it. """
+        # Handle device removal
+        key = self._device_key(device)
+        self._incomplete_since.pop(key, None)
+        if self.device_states.remove(key, device) is not None:
+            self.readiness.cancel(device.sys_path)
+            logger.info(f"USB Device {device.device_node} removed.")
+
+            # Deleting the mount point of the device
+            self.privileged.submit(key, 'unmount', self.mount_engine.unmount, device)
+
+    def _handle_decisions(self, decisions: [()]) -> None:
+        """ Record the user's (device, decision, auto_allow) answers from one popup, then apply them together.
+        Devices left undecided are neither recorded nor enforced, they are asked about when plugged in again. """
+        keys = [self._device_key(usb_device) for usb_device, _, _ in decisions]
+        undecided = [usb_device for usb_device, user_choice, _ in decisions if user_choice is None]
+        if undecided:
+            logger.info(f"Left undecided: {', '.join(f'{d.vendor_id}:{d.product_id}' for d in undecided)}")
+            DECISIONS.labels('undecided').inc(len(undecided))
+            decisions = [decision for decision in decisions if decision[1] is not None]
+
+        # Log and take action based on user choice
+        if decisions:
+            records = log_usb_devices([(vars(usb_device), user_choice) for usb_device, user_choice, _ in decisions])
+            if self.fleet is not None:
+                self.fleet.record(records)  # Sent in the background, never waits for the service
+
+        # The whole popup at once, so no checkpoint covers journaled decisions that aren't learned yet
+        self.online_model.learn_batch([(vars(usb_device), user_choice) for usb_device, user_choice, _ in decisions])
+
+        allows = []
+        blocks = []
+        for usb_device, user_choice, auto_allow in decisions:
+            DECISIONS.labels(user_choice).inc()
+            self.counters.increment(user_choice, usb_device.vendor_id, usb_device.product_id)
+            self.policy.record(vars(usb_device), user_choice)
+
+            if user_choice == 'allow':
+                allows.append(usb_device)
+
+                # Update vendor allow count only if auto-allow checkbox is checked
+                if auto_allow:
+                    count = self.counters.increment('auto_allow', usb_device.vendor_id, usb_device.product_id)
+                    self.policy.update_vendor_allow_count(usb_device.vendor_id, count)
+            elif user_choice == 'block':
+                blocks.append(usb_device)
+
+        # One task for the whole popup, the devices' deferred events are released once it is done
+        self.privileged.submit(keys[0], 'apply_decisions', self._apply_decisions, allows, blocks, keys)
+
+    def _apply_decisions(self, allows: [USBDevice], blocks: [USBDevice], keys: []) -> None:
+        """ Privileged stage: apply a popup's decisions as one batch of privileged operations. """
         try:
-            # Running the blocking command with root privileges
-            self.root_process_launcher.execute_with_input(echo_command, blocking_command)
-            update_udev_rules(self.root_process_launcher)
-            logger.info(f"USB Device: {device.vendor_id} - {device.product_id} blocked successfully")
+            if blocks:
+                self.block_usb_devices(blocks)
+            if allows:
+                self.allow_usb_devices(allows)
+        finally:
+            self.events.put(('applied', keys, time.monotonic()))
+
+    def _release_deferred(self, keys: []) -> None:
+        """ Handle the events held back while the devices waited for the user. """
+        for key in keys:
+            for device in self._awaiting_decision.pop(key, []):
+                self._handle_udev_event(device)
+
+    def _prompt_user(self, stop: threading.Event = None) -> None:
+        """ GUI stage: show the popups one at a time, each for all the devices that queued up within a short
+        window, so a hub of unknown devices is a single popup. Runs on the main thread, as GTK requires. """
+        while stop is None or not stop.is_set():
+            try:
+                batch = [self.prompts.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+
+            deadline = time.monotonic() + self.PROMPT_WINDOW
+            while len(batch) < self.MAX_PROMPT_DEVICES:
+                try:
+                    batch.append(self.prompts.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            # Devices of a port quarantined while they waited aren't asked about, their held back events are
+            # released, and dropped as the port's
+            if self.storm_guard is not None:
+                dropped = [usb_device for usb_device, _ in batch if usb_device.sys_path in self.storm_guard]
+                if dropped:
+                    STORM_DROPPED_PROMPTS.inc(len(dropped))
+                    batch = [(usb_device, queued) for usb_device, queued in batch if usb_device not in dropped]
+                    self.events.put(('applied', [self._device_key(usb_device) for usb_device in dropped],
+                                     time.monotonic()))
+                    for _ in dropped:
+                        self.prompts.task_done()
+                    if not batch:
+                        continue
 
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to block the USB device: {e}")
+            started = time.monotonic()
+            for _, queued in batch:
+                self.stats.observe('prompt_queue_wait', started - queued)
+            PROMPTS.inc()
+            PROMPTED_DEVICES.inc(len(batch))
+
+            choices = self.prompt([vars(usb_device) for usb_device, _ in batch])
+            self.stats.observe('prompt', time.monotonic() - started)
+
+            decisions = [(usb_device, user_choice, auto_allow)
+                         for (usb_device, _), (user_choice, auto_allow) in zip(batch, choices)]
+            self.events.put(('decisions', decisions, time.monotonic()))
+            for _ in batch:
+                self.prompts.task_done()
+
+    def coldplug(self, devices: [], started: float = None) -> {}:
+        """ Classify and enforce every USB device already attached at startup, in batches. """
+        started = started or time.monotonic()
+
+        usb_devices = []
+        hubs = 0
+        for device in devices:
+            vendor_id = device.get('ID_VENDOR_ID')
+            product_id = device.get('ID_MODEL_ID')
+            if is_hub(device):
+                hubs += 1
+                continue
+
+            # A later add event for the same device is then skipped as a duplicate
+            if not vendor_id or not product_id or self.device_states.add(self._device_key(device), device) is None:
+                continue
+
+            usb_devices.append(USBDevice(vendor_id, product_id, device.get('ID_SERIAL_SHORT'), device.device_node,
+                                         device.sys_path))
+
+        predict_started = time.monotonic()
+        predictions = self.predictor.predict_batch([vars(usb_device) for usb_device in usb_devices])
+        self.stats.observe('coldplug_predict', time.monotonic() - predict_started)
+
+        mounts = []
+        summary = {'devices': len(usb_devices), 'hubs': hubs, 'allowed': 0, 'blocked': 0, 'prompted': 0,
+                   'untouched': 0}
+        for usb_device, prediction in zip(usb_devices, predictions):
+            if prediction == 'allow':
+                AUTO_ALLOWS.inc()
+                summary['allowed'] += 1
+
+                # Filesystems still mounted from before the restart are skipped by the mount engine
+                self.device_states.set_state(self._device_key(usb_device), ALLOWED, usb_device)
+                mounts.append((usb_device, None))
+            elif prediction == 'block':
+                AUTO_BLOCKS.inc()
+                summary['blocked'] += 1
+                self.block_usb_device(usb_device)
+            elif not self.COLDPLUG_PROMPT:
+                # Already working before the manager started, nothing is decided or recorded for it
+                summary['untouched'] += 1
+                self.device_states.set_state(self._device_key(usb_device), ALLOWED, usb_device)
+            else:
+                summary['prompted'] += 1
+                self._awaiting_decision[self._device_key(usb_device)] = []
+                self.device_states.set_state(self._device_key(usb_device), PENDING)
+                self.prompts.put((usb_device, time.monotonic()))
+
+        # One round trip for all the mounts, one rules file rewrite and trigger for all the blocks
+        if mounts:
+            self.mount_engine.mount(mounts)
+        if summary['blocked']:
+            self.enforcer.flush()
+
+        summary['enforced_after_s'] = time.monotonic() - started
+        self.stats.observe('coldplug', summary['enforced_after_s'])
+        logger.info(f"Coldplug: {summary['devices']} attached devices and {hubs} hubs, {summary['allowed']} allowed, "
+                    f"{summary['blocked']} blocked, {summary['untouched']} left as they were, "
+                    f"{summary['prompted']} waiting for the user, "
+                    f"enforced {summary['enforced_after_s']:.3f}s after startup")
+        return summary
+
+    def pipeline_stats(self) -> {}:
+        """ Current queue depths and per-stage latencies. """
+        return {
+            'queues': {'events': self.events.qsize(), 'prompts': self.prompts.qsize(),
+                       'privileged': self.privileged.depth()},
+            'stages': self.stats.snapshot(),
+        }
 
     def monitor_usb_devices(self) -> None:
         """ Monitor USB devices and handle them based on user input and model predictions. """
+        started = time.monotonic()
+
         # Create interface for interacting with udev subsystem
         context = pyudev.Context()
-        monitor = pyudev.Monitor.from_netlink(context)
-        monitor.filter_by(subsystem='usb')  # Filtering only the USB events
-
-        disable_auto_mount(self.root_process_launcher)
-
-        logger.info("Monitoring USB devices. Press Ctrl+C to stop.")
+        monitors = self.create_monitors(context)
+        for monitor in monitors:
+            monitor.start()  # Buffer events from now on, so none are lost while seeding the topology
 
-        try:
-            for device in iter(monitor.poll, None):
-                if device.action == 'add':  # New USB device was plugged
-                    # Fetch USB device information
-                    vendor_id = device.get('ID_VENDOR_ID')
-                    product_id = device.get('ID_MODEL_ID')
-                    serial = device.get('ID_SERIAL_SHORT')
-                    device_node = device.device_node
-
-                    # If incomplete info, debounce and wait for complete event
-                    if not vendor_id or not product_id:
-                        time.sleep(self.DEBOUNCE_TIME)
-                        continue
-
-                    # Check if we've already processed this device (avoid duplicate popups)
-                    if device_node in self.seen_devices:
-                        logger.error(f"Device {device_node} already processed, skipping...")
-                        continue
-
-                    # Add to seen_devices to prevent processing duplicates
-                    self.seen_devices.add(device_node)
-
-                    # Parse device info
-                    usb_device = USBDevice(vendor_id, product_id, serial, device_node)
-
-                    # Check if the model predicts an automatic allow/block
-                    prediction = predict(vars(usb_device))
-
-                    if prediction == 'allow':
-                        logger.info(f"Automatically allowing device: {usb_device.vendor_id}")
-                        self.allow_usb_device(usb_device)
-                    else:
-                        # If the prediction is unknown, ask the user with popup
-                        user_choice, auto_allow = show_usb_alert(vars(usb_device))
-
-                        # Log and take action based on user choice
-                        log_usb_device(vars(usb_device), user_choice)
+        # A single enumeration seeds the topology, the monitor's events keep it current
+        usb_devices = list(context.list_devices(subsystem='usb', DEVTYPE='usb_device'))
+        self.topology.seed(itertools.chain(usb_devices, context.list_devices(subsystem='block')))
 
-                        if user_choice == 'allow':
-                            self.allow_usb_device(usb_device)
-
-                            # Update vendor allow count only if auto-allow checkbox is checked
-                            if auto_allow:
-                                with open('data/vendor_allow_counts.json', 'r+') as f:
-                                    try:
-                                        vendor_allow_count = json.load(f)
-                                    except (FileNotFoundError, json.JSONDecodeError):
-                                        vendor_allow_count = {}
-
-                                    if vendor_id not in vendor_allow_count:
-                                        vendor_allow_count[vendor_id] = 0
-                                    vendor_allow_count[vendor_id] += 1
-
-                                    f.seek(0)
-                                    json.dump(vendor_allow_count, f)
+        disable_auto_mount(self.root_process_launcher)
 
-                        elif user_choice == 'block':
-                            self.block_usb_device(usb_device)
+        # Devices plugged in before the manager started never send an add event
+        self.coldplug(usb_devices, started)
 
-                        else:
-                            continue
-                elif device.action == 'remove': # USB device was unplugged
-                    # Handle device removal
-                    if device.device_node in self.seen_devices:
-                        self.seen_devices.remove(device.device_node)
-                        logger.info(f"USB Device {device.device_node} removed.")
+        logger.info("Monitoring USB devices. Press Ctrl+C to stop.")
 
-                        # Deleting the mount point of the device
-                        unmount_device(self.root_process_launcher, device)
+        self.start_pipeline(*monitors)
+        exporters = self.start_metrics_exporters()
 
+        try:
+            self._prompt_user()
         except KeyboardInterrupt:
+            # Let the in-flight work finish before restoring the system
+            self.stop_pipeline()
+            for exporter in exporters:
+                exporter.stop()
+
             # Return system to its original state
             enable_auto_mount(self.root_process_launcher)
+            untag_usb_block_devices(self.root_process_launcher)
+            self.root_process_launcher.close()
+            logger.info(f"Predictor cache stats: {self.predictor.stats()}")
+            logger.info(f"Pipeline stats: {self.pipeline_stats()}")
             logger.info("Stopping USB device monitoring.")
+
+    def create_monitors(self, context: pyudev.Context) -> ():
+        """ The USB stream (whole USB devices) and the block stream (to know when partitions are ready), each
+        on its own netlink socket, filtered in the kernel. """
+        tagged = tag_usb_block_devices(self.root_process_launcher)
+        usb_monitor = pyudev.Monitor.from_netlink(context)
+        block_monitor = pyudev.Monitor.from_netlink(context)
+        filter_monitors(usb_monitor, block_monitor, tagged)
+        return usb_monitor, block_monitor
+
+    def start_metrics_exporters(self) -> []:
+        """ Publish the metrics on the configured textfile and Unix socket, returning the running exporters. """
+        exporters = []
+        if self.METRICS_TEXTFILE:
+            exporters.append(TextfileExporter(self.METRICS_TEXTFILE))
+        if self.METRICS_SOCKET:
+            exporters.append(UnixSocketExporter(self.METRICS_SOCKET))
+
+        for exporter in list(exporters):
+            try:
+                exporter.start()
+            except OSError as e:
+                logger.error(f"Failed to start metrics exporter: {e}")
+                exporters.remove(exporter)
+        return exporters
+
+    def start_pipeline(self, *monitors: pyudev.Monitor) -> None:
+        """ Start the reader and classifier stages. A monitor can be anything with a pyudev-like poll(), and
+        fileno() when there are several. """
+        QUEUE_DEPTH.labels('events').set_function(self.events.qsize)
+        QUEUE_DEPTH.labels('prompts').set_function(self.prompts.qsize)
+        QUEUE_DEPTH.labels('privileged').set_function(self.privileged.depth)
+        self.device_states.publish()
+        self.enforcer.start()
+        if self.storm_guard is not None:
+            self.storm_guard.publish()
+        self.counters.start()
+        if self.fleet is not None:
+            self.fleet.start()
+
+        threading.Thread(target=self._read_events, args=monitors, name='udev-reader', daemon=True).start()
+        self._classifier = threading.Thread(target=self._classify_events, name='classifier', daemon=True)
+        self._classifier.start()
+
+    def wait_idle(self) -> None:
+        """ Block until every queued event, prompt and privileged task has been handled. """
+        while True:
+            self.events.join()
+            self.prompts.join()
+            self.privileged.join()
+            if not (self.events.unfinished_tasks or self.prompts.unfinished_tasks or self.privileged.pending()):
+                return
+
+    def stop_pipeline(self) -> None:
+        """ Let the in-flight work finish, then stop the classifier and the privileged workers. """
+        self.events.put(None)
+        self._classifier.join()
+        if self.storm_guard is not None:
+            self.storm_guard.stop()  # Turns the quarantined ports back on
+        self.privileged.shutdown()
+        self.enforcer.flush()
+        self.enforcer.stop()
+        self.counters.stop()
+        if self.fleet is not None:
+            self.fleet.stop()
+        self.online_model.checkpoint()
@@ -0,0 +1,171 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+from loguru import logger
+from utils.metrics import REGISTRY
+
+# Lifecycle of a device, from its first complete add event to its remove
+SEEN = 'seen'  # Classified, the decision is being applied
+PENDING = 'pending'  # Waiting for the user
+ALLOWED = 'allowed'
+MOUNTED = 'mounted'
+BLOCKED = 'blocked'
+REMOVED = 'removed'  # Kept for a while, so a late event of the unplugged device isn't taken for a new one
+STATES = (SEEN, PENDING, ALLOWED, MOUNTED, BLOCKED, REMOVED)
+
+# States of a device that is still plugged in and being taken care of, never evicted for their age
+LIVE_STATES = (SEEN, PENDING, ALLOWED, MOUNTED)
+
+TRACKED_DEVICES = REGISTRY.gauge('usb_manager_tracked_devices', "Devices in the device state table, by state",
+                                 ('state',))
+STATE_TABLE_BYTES = REGISTRY.gauge('usb_manager_device_state_bytes',
+                                   "Approximate memory used by the device state table")
+EVICTIONS = REGISTRY.counter('usb_manager_device_state_evictions_total', "Device records evicted from the state table",
+                             ('reason',))
+STALE_EVENTS = REGISTRY.counter('usb_manager_stale_events_total',
+                                "Add events older than what the state table already knows of the device")
+REENUMERATIONS = REGISTRY.counter('usb_manager_reenumerations_total',
+                                  "Devices re-enumerated at the same sysfs path without a remove event")
+
+
+class DeviceRecord:
+    """ What is known about one enumeration of a device. """
+    __slots__ = ('key', 'seqnum', 'initialized', 'state', 'added', 'updated', 'device')
+
+    def __init__(self, key: str, seqnum: int, initialized: str, now: float) -> None:
+        self.key = key
+        self.seqnum = seqnum  # udev SEQNUM of the latest event applied, events are numbered in kernel order
+        self.initialized = initialized  # udev USEC_INITIALIZED, the same for every event of one enumeration
+        self.state = SEEN
+        self.added = now  # When its add event was handled
+        self.updated = now
+        self.device = None  # The USBDevice, once allowed, so partitions showing up later can be mounted
+
+    def __repr__(self) -> str:
+        return f'DeviceRecord({self.key} {self.state} seqnum={self.seqnum})'
+
+
+class DeviceStateTable:
+    """ Bounded table of per-device state machines keyed by sysfs path, with TTL and capacity eviction. """
+
+    TTL = 600  # Seconds a removed or blocked device is remembered
+    MAX_DEVICES = 1024
+
+    def __init__(self, ttl: float = TTL, max_devices: int = MAX_DEVICES) -> None:
+        self.ttl = ttl
+        self.max_devices = max_devices
+        self._records = OrderedDict()  # key -> DeviceRecord, least recently updated first
+        self._counts = dict.fromkeys(STATES, 0)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _seqnum(device) -> int:
+        seqnum = device.get('SEQNUM')
+        return int(seqnum) if seqnum else None
+
+    def add(self, key: str, device) -> DeviceRecord:
+        """ Register the add event of a device, None if it is a duplicate or older than what is known already. """
+        seqnum = self._seqnum(device)
+        initialized = device.get('USEC_INITIALIZED')
+        now = time.monotonic()
+
+        with self._lock:
+            self._expire(now)
+            record = self._records.get(key)
+            if record is not None:
+                if seqnum is not None and record.seqnum is not None and seqnum <= record.seqnum:
+                    STALE_EVENTS.inc()
+                    return None
+
+                if record.state != REMOVED:
+                    if not initialized or initialized == record.initialized:
+                        return None  # The same enumeration, e.g. a repeated add event
+
+                    # Plugged again at the same port and its remove was missed
+                    REENUMERATIONS.inc()
+                    logger.warning(f"Device {key} re-enumerated without a remove event")
+
+                self._discard(record)
+
+            record = DeviceRecord(key, seqnum, initialized, now)
+            self._records[key] = record
+            self._counts[SEEN] += 1
+
+            while len(self._records) > self.max_devices:
+                EVICTIONS.labels('capacity').inc()
+                self._discard(next(iter(self._records.values())))
+            return record
+
+    def set_state(self, key: str, state: str, device=None) -> None:
+        """ Move a device to a new state. A removed or evicted device stays as it is. """
+        with self._lock:
+            record = self._records.get(key)
+            if record is None or record.state == REMOVED:
+                return
+            self._counts[record.state] -= 1
+            self._counts[state] += 1
+            record.state = state
+            record.updated = time.monotonic()
+            if device is not None:
+                record.device = device
+            self._records.move_to_end(key)
+
+    def remove(self, key: str, device) -> DeviceRecord:
+        """ Register the remove event of a device, returns its record, None if it wasn't being tracked. """
+        with self._lock:
+            record = self._records.get(key)
+            if record is None or record.state == REMOVED:
+                return None
+            self._counts[record.state] -= 1
+            self._counts[REMOVED] += 1
+            record.state = REMOVED
+            record.seqnum = self._seqnum(device) or record.seqnum
+            record.updated = time.monotonic()
+            record.device = None
+            self._records.move_to_end(key)
+            return record
+
+    def get(self, key: str) -> DeviceRecord:
+        return self._records.get(key)
+
+    def state_of(self, key: str) -> str:
+        record = self._records.get(key)
+        return record.state if record is not None else None
+
+    def _discard(self, record: DeviceRecord) -> None:
+        del self._records[record.key]
+        self._counts[record.state] -= 1
+
+    def _expire(self, now: float) -> None:
+        """ Evict the records past their TTL. Live devices at the front are only renewed, they are still there. """
+        for _ in range(len(self._records)):
+            record = next(iter(self._records.values()))
+            if now - record.updated < self.ttl:
+                return
+            if record.state in LIVE_STATES:
+                record.updated = now
+                self._records.move_to_end(record.key)
+            else:
+                EVICTIONS.labels('ttl').inc()
+                self._discard(record)
+
+    def count(self, state: str) -> int:
+        return self._counts[state]
+
+    def memory_bytes(self) -> int:
+        """ Approximate size of the table: the index and the records, not the strings they share with the events. """
+        return sys.getsizeof(self._records) + len(self._records) * sys.getsizeof(DeviceRecord('', 0, '', 0.0))
+
+    def publish(self) -> None:
+        """ Report the table's size in the metrics, computed when they are rendered. """
+        for state in STATES:
+            TRACKED_DEVICES.labels(state).set_function(lambda state=state: self._counts[state])
+        STATE_TABLE_BYTES.set_function(self.memory_bytes)
+
+    def __contains__(self, key: str) -> bool:
+        record = self._records.get(key)
+        return record is not None and record.state != REMOVED
+
+    def __len__(self) -> int:
+        return len(self._records)
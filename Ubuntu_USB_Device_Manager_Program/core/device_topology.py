@@ -0,0 +1,123 @@
+import threading
+
+
+class TopologyNode:
+    """ A USB device or a block device in the topology index. """
+    __slots__ = ('sys_path', 'subsystem', 'device_type', 'device_node', 'usb_parent', 'has_partition_table',
+                 'fs_type')
+
+    def __init__(self, sys_path: str, subsystem: str, device_type: str, device_node: str, usb_parent: str,
+                 has_partition_table: bool, fs_type: str = None) -> None:
+        self.sys_path = sys_path
+        self.subsystem = subsystem
+        self.device_type = device_type
+        self.device_node = device_node
+        self.usb_parent = usb_parent  # sysfs path of the USB device a block device belongs to
+        self.has_partition_table = has_partition_table
+        self.fs_type = fs_type  # Filesystem found by udev's blkid (vfat, exfat, ntfs, ext4...), None if none
+
+    def __repr__(self) -> str:
+        return f'TopologyNode({self.subsystem}/{self.device_type} {self.device_node} at {self.sys_path})'
+
+
+class DeviceTopology:
+    """ In-memory index of USB devices and their block devices, keyed by sysfs path. """
+
+    def __init__(self) -> None:
+        self._nodes = {}  # sysfs path -> TopologyNode
+        self._usb_by_device_node = {}  # /dev/bus/usb/... -> sysfs path
+        self._block_devices = {}  # USB sysfs path -> {block sysfs path}
+        self._lock = threading.Lock()
+
+    def seed(self, devices) -> None:
+        """ Index the devices of an enumeration. USB devices must come before their block devices. """
+        for device in devices:
+            self.add(device)
+
+    def update(self, device) -> TopologyNode:
+        """ Apply a udev event. Returns the affected node, None if it isn't tracked. """
+        if device.action == 'remove':
+            return self.remove(device.sys_path)
+        return self.add(device)
+
+    def add(self, device) -> TopologyNode:
+        """ Index a USB device or a block device below a known USB device. """
+        if device.subsystem == 'usb' and device.device_type == 'usb_device':
+            node = TopologyNode(device.sys_path, 'usb', 'usb_device', device.device_node, None, False)
+            with self._lock:
+                self._nodes[node.sys_path] = node
+                if node.device_node:
+                    self._usb_by_device_node[node.device_node] = node.sys_path
+                self._block_devices.setdefault(node.sys_path, set())
+            return node
+
+        if device.subsystem == 'block':
+            with self._lock:
+                usb_parent = self._find_usb_parent(device.sys_path)
+                if usb_parent is None:
+                    return None  # Not a USB block device
+
+                node = TopologyNode(device.sys_path, 'block', device.device_type, device.device_node, usb_parent,
+                                    bool(device.get('ID_PART_TABLE_TYPE')), device.get('ID_FS_TYPE'))
+                self._nodes[node.sys_path] = node
+                self._block_devices[usb_parent].add(node.sys_path)
+            return node
+
+        return None
+
+    def _find_usb_parent(self, sys_path: str) -> str:
+        """ Walk up the sysfs path (bounded by its depth, not by the number of devices) to a known USB device. """
+        while '/' in sys_path:
+            sys_path = sys_path.rsplit('/', 1)[0]
+            node = self._nodes.get(sys_path)
+            if node is not None:
+                return node.sys_path if node.subsystem == 'usb' else node.usb_parent
+        return None
+
+    def remove(self, sys_path: str) -> TopologyNode:
+        """ Forget a device, and the block devices of a USB device. """
+        with self._lock:
+            node = self._nodes.pop(sys_path, None)
+            if node is None:
+                return None
+
+            if node.subsystem == 'usb':
+                if self._usb_by_device_node.get(node.device_node) == sys_path:
+                    del self._usb_by_device_node[node.device_node]
+                for block_sys_path in self._block_devices.pop(sys_path, ()):
+                    self._nodes.pop(block_sys_path, None)
+            else:
+                self._block_devices.get(node.usb_parent, set()).discard(sys_path)
+            return node
+
+    def get(self, sys_path: str) -> TopologyNode:
+        return self._nodes.get(sys_path)
+
+    def usb_device_by_node(self, device_node: str) -> TopologyNode:
+        """ Find a USB device by its /dev/bus/usb/... node. """
+        return self._nodes.get(self._usb_by_device_node.get(device_node))
+
+    def block_devices_of(self, usb_sys_path: str) -> [TopologyNode]:
+        """ The block devices (disks and partitions) of a USB device. """
+        with self._lock:
+            return [self._nodes[path] for path in self._block_devices.get(usb_sys_path, ())]
+
+    def partitions_of(self, usb_sys_path: str) -> [TopologyNode]:
+        """ The partitions of a USB device, sorted by device node. """
+        return sorted((node for node in self.block_devices_of(usb_sys_path) if node.device_type == 'partition'),
+                      key=lambda node: node.device_node)
+
+    def filesystems_of(self, usb_sys_path: str) -> [TopologyNode]:
+        """ The block devices of a USB device that hold a filesystem: its partitions, or the whole disk when it
+        has no partition table. Sorted by device node. """
+        return sorted((node for node in self.block_devices_of(usb_sys_path)
+                       if node.fs_type and not (node.device_type == 'disk' and node.has_partition_table)),
+                      key=lambda node: node.device_node)
+
+    def usb_parent_of(self, block_sys_path: str) -> TopologyNode:
+        """ The USB device a block device belongs to. """
+        node = self._nodes.get(block_sys_path)
+        return self._nodes.get(node.usb_parent) if node is not None and node.usb_parent else None
+
+    def __len__(self) -> int:
+        return len(self._nodes)
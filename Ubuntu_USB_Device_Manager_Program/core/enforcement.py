@@ -0,0 +1,157 @@
+import os
+import glob
+from loguru import logger
+from core.usb_device import USBDevice
+from core.device_topology import DeviceTopology
+from utils.root_process_launcher import RootProcessLauncher
+from utils.udev_rule_set import UdevRuleSet
+
+SYSFS_ROOT = '/sys'
+ENFORCEMENT_BACKENDS = ('udev', 'sysfs')
+
+
+def blocking_rule(device: USBDevice) -> str:
+    """ The udev rule that deauthorizes every device with the same vendor and product IDs. """
+    return f'ATTR{{idVendor}}=="{device.vendor_id}", ATTR{{idProduct}}=="{device.product_id}", ATTR{{authorized}}="0"'
+
+
+class UdevRuleEnforcer:
+    """ Enforces the decisions through the blacklist rules file and a scoped re-trigger. """
+
+    name = 'udev'
+
+    def __init__(self, blacklist: UdevRuleSet, topology: DeviceTopology, on_enforced=None) -> None:
+        self.blacklist = blacklist
+        self.topology = topology
+        self.on_enforced = on_enforced
+        self.blacklist.on_applied = self._enforced
+
+    def _enforced(self, sys_paths: []) -> None:
+        if self.on_enforced is not None and sys_paths:
+            self.on_enforced(sys_paths)
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def allow(self, devices: [USBDevice]) -> None:
+        self._enforced([device.sys_path for device in devices])
+
+    def block(self, device: USBDevice) -> bool:
+        """ Add the device's rule, the file is rewritten and only this device re-triggered shortly after. """
+        # A device unplugged while the user decided still gets its rule, only the re-trigger is skipped
+        present = self.topology.get(device.sys_path) is not None
+        new = self.blacklist.add(blocking_rule(device), device.sys_path if present else None)
+
+        if not present:
+            logger.warning(f"USB Device: {device.vendor_id} - {device.product_id} was unplugged, "
+                           f"blacklisted without re-triggering it")
+        elif new:
+            logger.info(f"USB Device: {device.vendor_id} - {device.product_id} blocked successfully")
+        else:
+            logger.info(f"USB Device: {device.vendor_id} - {device.product_id} already blacklisted, re-triggering it")
+        return present
+
+    def flush(self) -> None:
+        self.blacklist.flush()
+
+
+class SysfsAuthorizedEnforcer:
+    """ Enforces the decisions by writing the devices' sysfs authorized attribute. """
+
+    name = 'sysfs'
+
+    def __init__(self, root_process_launcher: RootProcessLauncher, blacklist: UdevRuleSet,
+                 authorized_default: bool = False, sysfs_root: str = SYSFS_ROOT, on_enforced=None) -> None:
+        self.root_process_launcher = root_process_launcher
+        self.blacklist = blacklist
+        self.authorized_default = authorized_default
+        self.sysfs_root = sysfs_root
+        self.on_enforced = on_enforced
+        self._direct = True  # Until a write is refused, then everything goes through the root helper
+        self._hub_defaults = {}  # authorized_default file -> its value before start()
+
+    def _path(self, sys_path: str, attribute: str) -> str:
+        """ A device's attribute, rebased on sysfs_root (device sysfs paths start with /sys). """
+        return os.path.join(self.sysfs_root, os.path.relpath(sys_path, SYSFS_ROOT), attribute)
+
+    def _write(self, values: [()]) -> []:
+        """ Write (file, value) pairs, returns the files that couldn't be written. """
+        failed = []
+        remaining = list(values)
+        while self._direct and remaining:
+            path, value = remaining[0]
+            try:
+                with open(path, 'w') as file:
+                    file.write(value)
+            except PermissionError:
+                self._direct = False
+                break
+            except OSError as e:
+                logger.error(f"Failed to write {value} to {path}: {e}")
+                failed.append(path)
+            remaining.pop(0)
+
+        if remaining:
+            results = self.root_process_launcher.execute_batch([(f'tee {path}', value) for path, value in remaining],
+                                                               check=False, stop_on_error=False)
+            for (path, value), result in zip(remaining, results):
+                if result.returncode != 0:
+                    logger.error(f"Failed to write {value} to {path}: {result.stderr}")
+                    failed.append(path)
+        return failed
+
+    def _enforced(self, devices: [USBDevice], failed: []) -> None:
+        sys_paths = [device.sys_path for device in devices if self._path(device.sys_path, 'authorized') not in failed]
+        if self.on_enforced is not None and sys_paths:
+            self.on_enforced(sys_paths)
+
+    def start(self) -> None:
+        """ Make new devices start unauthorized, if configured. """
+        if not self.authorized_default:
+            return
+
+        for path in glob.glob(os.path.join(self.sysfs_root, 'bus', 'usb', 'devices', 'usb*', 'authorized_default')):
+            with open(path, 'r') as file:
+                self._hub_defaults[path] = file.read().strip()
+        failed = self._write([(path, '0') for path in self._hub_defaults])
+        logger.info(f"New USB devices start unauthorized on {len(self._hub_defaults) - len(failed)} buses")
+
+    def stop(self) -> None:
+        """ Restore the root hubs' authorized_default. """
+        if self._hub_defaults:
+            self._write(list(self._hub_defaults.items()))
+            self._hub_defaults.clear()
+
+    def allow(self, devices: [USBDevice]) -> None:
+        """ Authorize the devices, only needed when they start unauthorized. """
+        failed = []
+        if self.authorized_default:
+            failed = self._write([(self._path(device.sys_path, 'authorized'), '1') for device in devices])
+        self._enforced(devices, failed)
+
+    def block(self, device: USBDevice) -> bool:
+        """ Deauthorize the device now, the rule persists the block, even for a device unplugged meanwhile. """
+        self.blacklist.add(blocking_rule(device))
+        failed = self._write([(self._path(device.sys_path, 'authorized'), '0')])
+        if failed:
+            return False
+
+        logger.info(f"USB Device: {device.vendor_id} - {device.product_id} blocked successfully")
+        self._enforced([device], failed)
+        return True
+
+    def flush(self) -> None:
+        self.blacklist.flush()
+
+
+def create_enforcer(backend: str, root_process_launcher: RootProcessLauncher, blacklist: UdevRuleSet,
+                    topology: DeviceTopology, authorized_default: bool = False, on_enforced=None):
+    """ The enforcement backend by name, one of ENFORCEMENT_BACKENDS. """
+    if backend == 'udev':
+        return UdevRuleEnforcer(blacklist, topology, on_enforced)
+    if backend == 'sysfs':
+        return SysfsAuthorizedEnforcer(root_process_launcher, blacklist, authorized_default, on_enforced=on_enforced)
+    raise ValueError(f"Unknown enforcement backend {backend}, expected one of {ENFORCEMENT_BACKENDS}")
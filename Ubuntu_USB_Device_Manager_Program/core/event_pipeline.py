@@ -0,0 +1,85 @@
+import queue
+import threading
+import time
+from loguru import logger
+from utils.metrics import REGISTRY
+
+STAGE_SECONDS = REGISTRY.histogram('usb_manager_stage_seconds', "Latency of each stage of the USB decision path",
+                                   ('stage',))
+
+
+class StageStats:
+    """ Per-stage latency accumulators, cheap enough to update on every event.
+    Every sample also lands in the usb_manager_stage_seconds histogram of the metrics endpoint. """
+
+    def __init__(self) -> None:
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """ Record one latency sample for the stage. """
+        STAGE_SECONDS.labels(stage).observe(seconds)
+        with self._lock:
+            count, total, maximum = self._stages.get(stage, (0, 0.0, 0.0))
+            self._stages[stage] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def snapshot(self) -> {}:
+        """ Return {stage: {'count', 'avg_ms', 'max_ms'}}. """
+        with self._lock:
+            return {stage: {'count': count, 'avg_ms': total / count * 1000, 'max_ms': maximum * 1000}
+                    for stage, (count, total, maximum) in self._stages.items()}
+
+
+class KeyedExecutor:
+    """ Pool of worker threads where all tasks submitted with the same key run on the same worker,
+    so they execute in submission order, while tasks for different keys run concurrently. """
+
+    def __init__(self, name: str, workers: int, stats: StageStats) -> None:
+        self.name = name
+        self.stats = stats
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = [threading.Thread(target=self._work, args=(task_queue,), name=f'{name}-{index}', daemon=True)
+                         for index, task_queue in enumerate(self._queues)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key: str, stage: str, function, *args) -> None:
+        """ Queue function(*args) behind every earlier task with the same key. """
+        self._queues[hash(key) % len(self._queues)].put((stage, function, args, time.monotonic()))
+
+    def depth(self) -> int:
+        """ Number of tasks waiting across all workers. """
+        return sum(task_queue.qsize() for task_queue in self._queues)
+
+    def pending(self) -> int:
+        """ Number of tasks submitted but not finished yet. """
+        return sum(task_queue.unfinished_tasks for task_queue in self._queues)
+
+    def join(self) -> None:
+        """ Block until every submitted task has finished. """
+        for task_queue in self._queues:
+            task_queue.join()
+
+    def _work(self, task_queue: queue.Queue) -> None:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                task_queue.task_done()
+                return
+
+            stage, function, args, submitted = task
+            started = time.monotonic()
+            self.stats.observe(f'{self.name}_wait', started - submitted)
+            try:
+                function(*args)
+            except Exception:
+                logger.exception(f"{stage} failed")
+            self.stats.observe(stage, time.monotonic() - started)
+            task_queue.task_done()
+
+    def shutdown(self, timeout: float = None) -> None:
+        """ Let the workers drain their queues, then stop them. """
+        for task_queue in self._queues:
+            task_queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
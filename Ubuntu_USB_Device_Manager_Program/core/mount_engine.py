@@ -0,0 +1,141 @@
+import os
+import re
+import time
+import getpass
+from loguru import logger
+from utils.root_process_launcher import RootProcessLauncher
+from core.usb_device import USBDevice
+from core.mount_registry import MountRegistry, MountEntry, mounted_points
+from core.device_topology import DeviceTopology, TopologyNode
+
+# Mount options per filesystem type (udev's ID_FS_TYPE), None applies to every other filesystem.
+# noatime spares the stick a metadata write on every read. FAT, exFAT and NTFS have no owners, the files are
+# given to the user the manager runs as ({uid}, {gid}) so nothing needs sudo to be read or written.
+MOUNT_OPTIONS = {
+    None: ['noatime', 'nodev', 'nosuid'],
+    'vfat': ['noatime', 'nodev', 'nosuid', 'uid={uid}', 'gid={gid}', 'dmask=022', 'fmask=133', 'shortname=mixed',
+             'utf8'],
+    'exfat': ['noatime', 'nodev', 'nosuid', 'uid={uid}', 'gid={gid}', 'dmask=022', 'fmask=133'],
+    'ntfs': ['noatime', 'nodev', 'nosuid', 'uid={uid}', 'gid={gid}', 'big_writes'],  # ntfs-3g
+    'ntfs3': ['noatime', 'nodev', 'nosuid', 'uid={uid}', 'gid={gid}'],
+    'ext4': ['noatime', 'nodev', 'nosuid', 'commit=30'],
+}
+
+
+class MountEngine:
+    """ Mounts every filesystem of an allowed USB device at its own mount point, and unmounts them. """
+
+    def __init__(self, root_process_launcher: RootProcessLauncher, mount_registry: MountRegistry,
+                 topology: DeviceTopology, mount_options: {} = None) -> None:
+        self.root_process_launcher = root_process_launcher
+        self.mount_registry = mount_registry
+        self.topology = topology
+        self.mount_options = mount_options or MOUNT_OPTIONS
+
+        # Resolved once, instead of spawning whoami on every mount
+        self.media_directory = os.path.join('/media', getpass.getuser())
+        self._owner = {'uid': os.getuid(), 'gid': os.getgid()}
+
+    def options_for(self, fs_type: str) -> str:
+        """ The -o argument of mount for a filesystem type. """
+        options = self.mount_options.get(fs_type, self.mount_options.get(None, []))
+        return ','.join(option.format(**self._owner) for option in options)
+
+    def _mount_point(self, device: USBDevice, node: TopologyNode, filesystems: int, taken: set) -> str:
+        """ /media/<user>/<serial> for a single filesystem, /media/<user>/<serial>-<sdb1> for each of several,
+        with a counter appended if that is still taken (e.g. two sticks without a serial). """
+        name = device.serial if device.serial and device.serial != 'Unknown' \
+            else f'{device.vendor_id}-{device.product_id}'
+        name = re.sub(r'[^\w.-]', '_', name)  # The mount point is a single path component, with no spaces
+        partition_name = f'{name}-{os.path.basename(node.device_node)}'
+
+        mount_point = os.path.join(self.media_directory, name if filesystems == 1 else partition_name)
+        if mount_point in taken:
+            mount_point = os.path.join(self.media_directory, partition_name)
+
+        base = mount_point
+        counter = 2
+        while mount_point in taken:
+            mount_point = f'{base}-{counter}'
+            counter += 1
+
+        taken.add(mount_point)
+        return mount_point
+
+    def mount(self, devices: [()]) -> [MountEntry]:
+        """ Mount the filesystems of (device, block device) pairs that aren't mounted yet. Returns the new mounts. """
+        taken = self.mount_registry.mount_points() | (mounted_points() or set())
+
+        mounts = []  # (device, block device, fs type, mount point)
+        for device, block_device in devices:
+            filesystems = self.topology.filesystems_of(device.sys_path)
+            if not filesystems and block_device:
+                filesystems = [TopologyNode(None, 'block', None, block_device, device.sys_path, False)]
+
+            for node in filesystems:
+                if self.mount_registry.by_block_device(node.device_node) is not None:
+                    continue  # Mounted already, e.g. before a partition that showed up later
+                mount_point = self._mount_point(device, node, len(filesystems), taken)
+                mounts.append((device, node.device_node, node.fs_type, mount_point))
+
+        if not mounts:
+            return []
+
+        # Create all the mount points in one go, then mount the filesystems concurrently
+        created = self.root_process_launcher.execute(
+            f"mkdir -p {' '.join(mount_point for _, _, _, mount_point in mounts)}", check=False)
+        if created.returncode != 0:
+            logger.error(f"Failed to create the mount points: {created.stderr}")
+            return []
+
+        commands = []
+        for _, block_device, fs_type, mount_point in mounts:
+            options = self.options_for(fs_type)
+            commands.append(f'mount -o {options} {block_device} {mount_point}' if options
+                            else f'mount {block_device} {mount_point}')
+        results = self.root_process_launcher.execute_batch(commands, check=False, parallel=True)
+
+        entries = []
+        for (device, block_device, _, mount_point), result in zip(mounts, results):
+            if result.returncode != 0:
+                logger.error(f"Failed to mount {block_device}: {result.command} returned {result.returncode} "
+                             f"{result.stderr}")
+                continue
+
+            logger.info(f"USB Device: {device.vendor_id} - {device.product_id} {block_device} mounted successfully "
+                        f"at {mount_point}")
+            entries.append(MountEntry(device.device_node, device.sys_path, block_device, mount_point,
+                                      device.serial, device.vendor_id, device.product_id, time.time()))
+
+        # Remember the mounts so removal doesn't have to search for them
+        if entries:
+            self.mount_registry.add(*entries)
+        return entries
+
+    def unmount(self, device: USBDevice) -> None:
+        """ Unmount every filesystem of a removed device in parallel, then delete their mount points. """
+        # Look the mounts up by the device's sysfs path, its device node may have been another device's
+        entries = self.mount_registry.pop(device.device_node, device.sys_path)
+        if not entries:
+            logger.error(f"Failed to find the USB device: {device.device_node} mount point")
+            return
+
+        results = self.root_process_launcher.execute_batch([f'umount {entry.mount_point}' for entry in entries],
+                                                           check=False, parallel=True)
+
+        # The device is gone, a filesystem still busy is detached lazily rather than left behind
+        busy = [entry for entry, result in zip(entries, results) if result.returncode != 0]
+        if busy:
+            results = self.root_process_launcher.execute_batch([f'umount -l {entry.mount_point}' for entry in busy],
+                                                               check=False, parallel=True)
+            for entry, result in zip(busy, results):
+                if result.returncode != 0:
+                    logger.error(f"Failed to unmount {entry.mount_point}: {result.stderr}")
+                    entries.remove(entry)
+
+        # rmdir only removes the directories that are empty, i.e. really unmounted
+        if entries:
+            self.root_process_launcher.execute_batch([f"rmdir {' '.join(entry.mount_point for entry in entries)}"],
+                                                     check=False)
+            logger.info(f"USB Device: {entries[0].vendor_id} - {entries[0].product_id} unmounted successfully from "
+                        f"{', '.join(entry.mount_point for entry in entries)}, mount points removed.")
@@ -0,0 +1,133 @@
+import os
+import json
+import threading
+from dataclasses import dataclass, asdict
+from loguru import logger
+
+REGISTRY_FILE = 'data/mount_registry.json'
+PROC_MOUNTS = '/proc/self/mounts'
+
+
+@dataclass
+class MountEntry:
+    """ A block device mounted on behalf of a USB device. """
+    device_node: str
+    sys_path: str
+    block_device: str
+    mount_point: str
+    serial: str
+    vendor_id: str
+    product_id: str
+    mounted_at: float
+
+
+class MountRegistry:
+    """ Live, persisted registry of the mounts we made, a USB device can have several. """
+
+    def __init__(self, path: str = REGISTRY_FILE) -> None:
+        self.path = path
+        self._by_mount_point = {}
+        self._by_block_device = {}
+        self._by_node = {}  # USB device node -> {mount point}
+        self._by_sys_path = {}  # USB sysfs path -> {mount point}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        """ Load the snapshot, dropping entries that are no longer mounted. """
+        try:
+            with open(self.path, 'r') as file:
+                entries = [MountEntry(**entry) for entry in json.load(file)]
+        except FileNotFoundError:
+            return
+        except (json.JSONDecodeError, TypeError):
+            logger.error(f"Mount registry snapshot {self.path} is corrupted, ignoring it")
+            return
+
+        mounted = mounted_points()
+        for entry in entries:
+            if mounted is None or entry.mount_point in mounted:
+                self._index(entry)
+
+        logger.info(f"Restored {len(self._by_mount_point)} mounts from {self.path}")
+
+    def _index(self, entry: MountEntry) -> None:
+        """ Add the entry to every index. A reused device node can point at the mounts of two devices for a while,
+        lookups go by sysfs path whenever it is known. """
+        self._by_mount_point[entry.mount_point] = entry
+        self._by_block_device[entry.block_device] = entry
+        self._by_node.setdefault(entry.device_node, set()).add(entry.mount_point)
+        if entry.sys_path:
+            self._by_sys_path.setdefault(entry.sys_path, set()).add(entry.mount_point)
+
+    def _unindex(self, entry: MountEntry) -> None:
+        """ Remove the entry from every index. """
+        self._by_mount_point.pop(entry.mount_point, None)
+        if self._by_block_device.get(entry.block_device) is entry:
+            del self._by_block_device[entry.block_device]
+        for index, key in ((self._by_node, entry.device_node), (self._by_sys_path, entry.sys_path)):
+            mount_points = index.get(key)
+            if mount_points is not None:
+                mount_points.discard(entry.mount_point)
+                if not mount_points:
+                    del index[key]
+
+    def _save(self) -> None:
+        """ Write the snapshot atomically through a temp file and a rename. """
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump([asdict(entry) for entry in self._by_mount_point.values()], file)
+        os.replace(temp_path, self.path)
+
+    def add(self, *entries: MountEntry) -> None:
+        """ Register new mounts, with a single write of the snapshot. """
+        with self._lock:
+            for entry in entries:
+                self._index(entry)
+            self._save()
+
+    def entries_of(self, device_node: str = None, sys_path: str = None) -> [MountEntry]:
+        """ The mounts of a USB device, found by sysfs path, or by device node only when the path isn't known. """
+        with self._lock:
+            # The kernel reuses device nodes, another device's mounts may be recorded under this one's node
+            if sys_path:
+                mount_points = self._by_sys_path.get(sys_path)
+            else:
+                mount_points = self._by_node.get(device_node) if device_node else None
+            return [self._by_mount_point[mount_point] for mount_point in sorted(mount_points or ())]
+
+    def by_block_device(self, block_device: str) -> MountEntry:
+        """ The mount of a block device (e.g., /dev/sdb1), None if we didn't mount it. """
+        return self._by_block_device.get(block_device)
+
+    def mount_points(self) -> set:
+        """ Every mount point in use by our mounts. """
+        with self._lock:
+            return set(self._by_mount_point)
+
+    def pop(self, device_node: str = None, sys_path: str = None) -> [MountEntry]:
+        """ Remove and return the mounts of a USB device, by sysfs path, or by device node without one. """
+        entries = self.entries_of(device_node, sys_path)
+        if entries:
+            self.remove(*entries)
+        return entries
+
+    def remove(self, *entries: MountEntry) -> None:
+        """ Forget mounts, with a single write of the snapshot. """
+        with self._lock:
+            for entry in entries:
+                self._unindex(entry)
+            self._save()
+
+    def __len__(self) -> int:
+        return len(self._by_mount_point)
+
+
+def mounted_points() -> set:
+    """ Return the set of currently mounted mount points, or None if they can't be read. """
+    try:
+        with open(PROC_MOUNTS, 'r') as file:
+            # Spaces in mount points are escaped as \040 in the mounts table
+            return {line.split()[1].replace('\\040', ' ') for line in file if line.strip()}
+    except OSError:
+        return None
@@ -0,0 +1,68 @@
+import threading
+import time
+from loguru import logger
+from core.device_topology import DeviceTopology, TopologyNode
+
+
+class PartitionReadinessTracker:
+    """ Waits for the block device of an allowed USB device to show up, driven by block events. """
+
+    TIMEOUT = 10  # Seconds to wait for a partition before giving up
+
+    def __init__(self, topology: DeviceTopology, timeout: float = TIMEOUT) -> None:
+        self.topology = topology
+        self.timeout = timeout
+        self._waiting = {}  # USB sysfs path -> (callback, timer, started, fallback disk node)
+        self._lock = threading.Lock()
+
+    def wait_for(self, sys_path: str, callback) -> None:
+        """ Call callback(block_device_node) once the device is ready, or callback(None) on timeout. """
+        timer = threading.Timer(self.timeout, self._expire, args=(sys_path,))
+        timer.daemon = True
+
+        with self._lock:
+            self._waiting[sys_path] = (callback, timer, time.monotonic(), None)
+        timer.start()
+
+        # The partition may have appeared before the device was allowed
+        present = sorted(self.topology.block_devices_of(sys_path),
+                         key=lambda node: (node.device_type != 'disk', node.device_node))
+        for node in present:
+            self.block_device_added(node)
+
+    def cancel(self, sys_path: str) -> None:
+        """ Stop waiting for a device, e.g. because it was removed. """
+        with self._lock:
+            waiting = self._waiting.pop(sys_path, None)
+        if waiting is not None:
+            waiting[1].cancel()
+
+    def block_device_added(self, node: TopologyNode) -> bool:
+        """ Feed a block device that was just added to the topology. Returns whether a device was waiting for it. """
+        with self._lock:
+            if node.usb_parent not in self._waiting:
+                return False
+
+            if node.device_type == 'disk' and node.has_partition_table:
+                # Partitions will follow, keep the disk in case they never do
+                callback, timer, started, _ = self._waiting[node.usb_parent]
+                self._waiting[node.usb_parent] = (callback, timer, started, node.device_node)
+                return True
+
+            callback, timer, started, _ = self._waiting.pop(node.usb_parent)
+
+        timer.cancel()
+        logger.info(f"Block device {node.device_node} ready after {time.monotonic() - started:.3f}s")
+        callback(node.device_node)
+        return True
+
+    def _expire(self, sys_path: str) -> None:
+        with self._lock:
+            waiting = self._waiting.pop(sys_path, None)
+        if waiting is None:
+            return
+
+        callback, _, _, fallback = waiting
+        if fallback is None:
+            logger.error(f"No block device appeared for {sys_path} within {self.timeout}s")
+        callback(fallback)
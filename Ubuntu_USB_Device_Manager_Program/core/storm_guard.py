@@ -0,0 +1,130 @@
+import os
+import threading
+from loguru import logger
+from utils.metrics import REGISTRY
+
+STORM_DROPPED_EVENTS = REGISTRY.counter('usb_manager_storm_dropped_events_total',
+                                        "udev events of a quarantined port dropped without being handled")
+STORM_DROPPED_PROMPTS = REGISTRY.counter('usb_manager_storm_dropped_prompts_total',
+                                         "Popups withdrawn because their device's port was quarantined")
+QUARANTINES = REGISTRY.counter('usb_manager_port_quarantines_total',
+                               "Ports quarantined for plugging devices faster than the storm guard allows")
+QUARANTINED_PORTS = REGISTRY.gauge('usb_manager_quarantined_ports', "Ports currently quarantined")
+
+
+def port_of(device) -> str:
+    """ The physical port an event comes from: the sysfs path of its USB device, which stays the same whatever
+    device is plugged in (e.g. .../usb1/1-2 for both 1-2 and its interface 1-2:1.0). """
+    if device.device_type == 'usb_interface':
+        return os.path.dirname(device.sys_path)
+    return device.sys_path
+
+
+def port_disable_path(port: str) -> str:
+    """ The kernel's disable attribute of the hub port behind a device's sysfs path. """
+    hub_path, name = os.path.split(port)
+    if '.' in name:
+        hub, number = name.rsplit('.', 1)
+        interface, port_name = f'{hub}:1.0', f'{hub}-port{number}'
+    else:
+        bus, number = name.split('-', 1)
+        interface, port_name = f'{bus}-0:1.0', f'usb{bus}-port{number}'
+    return os.path.join(hub_path, interface, port_name, 'disable')
+
+
+class TokenBucket:
+    """ Allowance of add events of one port. """
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens: float, now: float) -> None:
+        self.tokens = tokens
+        self.updated = now
+
+
+class StormGuard:
+    """ Per-port token buckets over the add events, quarantining a port that plugs devices in a loop. """
+
+    RATE = 0.2  # Plugs per second a port sustains, one every 5 seconds
+    BURST = 5  # Plugs in a row before the rate applies
+    QUARANTINE = 60  # Seconds
+
+    def __init__(self, rate: float = RATE, burst: int = BURST, quarantine: float = QUARANTINE,
+                 on_quarantine=None, on_release=None) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.quarantine = quarantine
+        self.on_quarantine = on_quarantine  # Called with the port, e.g. to turn it off
+        self.on_release = on_release
+        self._buckets = {}  # port -> TokenBucket, there are only so many physical ports
+        self._quarantined = {}  # port -> monotonic time its quarantine ends
+        self._timers = {}  # port -> threading.Timer that ends its quarantine
+        self._lock = threading.Lock()
+
+    def admit(self, port: str, now: float) -> bool:
+        """ Take a token for a plug on the port. False if the port is quarantined, or is now for running out. """
+        if port in self._quarantined:
+            STORM_DROPPED_EVENTS.inc()
+            return False
+
+        bucket = self._buckets.get(port)
+        if bucket is None:
+            bucket = self._buckets[port] = TokenBucket(self.burst, now)
+
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return True
+
+        STORM_DROPPED_EVENTS.inc()
+        self._quarantine(port, now)
+        return False
+
+    def quarantined(self, port: str) -> bool:
+        """ Whether the port's events are to be dropped, counting them if so. Only a dict lookup otherwise. """
+        if port in self._quarantined:
+            STORM_DROPPED_EVENTS.inc()
+            return True
+        return False
+
+    def _quarantine(self, port: str, now: float) -> None:
+        with self._lock:
+            self._quarantined[port] = now + self.quarantine
+            timer = self._timers[port] = threading.Timer(self.quarantine, self.release, (port,))
+            timer.daemon = True
+            timer.start()
+
+        QUARANTINES.inc()
+        logger.warning(f"Port {port} is plugging devices faster than {self.rate}/s, quarantined for "
+                       f"{self.quarantine}s")
+        if self.on_quarantine is not None:
+            self.on_quarantine(port)
+
+    def release(self, port: str) -> None:
+        """ End the port's quarantine, with a full bucket. """
+        with self._lock:
+            if self._quarantined.pop(port, None) is None:
+                return
+            timer = self._timers.pop(port, None)
+            if timer is not None:
+                timer.cancel()
+            self._buckets.pop(port, None)
+
+        logger.info(f"Port {port} released from quarantine")
+        if self.on_release is not None:
+            self.on_release(port)
+
+    def __contains__(self, port: str) -> bool:
+        return port in self._quarantined
+
+    def quarantined_ports(self) -> []:
+        return list(self._quarantined)
+
+    def publish(self) -> None:
+        """ Report the quarantined ports in the metrics, computed when they are rendered. """
+        QUARANTINED_PORTS.set_function(lambda: len(self._quarantined))
+
+    def stop(self) -> None:
+        """ Release every port, e.g. on shutdown, so none is left turned off. """
+        for port in self.quarantined_ports():
+            self.release(port)
@@ -8,6 +8,7 @@ class USBDevice:
     product_id: str
     serial: str
     device_node: str
+    sys_path: str = None
 
     def __post_init__(self):
         if not self.serial:
@@ -0,0 +1,22 @@
+import hmac
+
+TOKEN_FILE = 'data/fleet_token'  # Secret shared by the service and every host of the fleet, one line
+
+
+def read_token(path: str = TOKEN_FILE) -> str:
+    """ The shared secret in a token file. Raises OSError if it can't be read, ValueError if it's empty. """
+    with open(path, 'r') as file:
+        token = file.read().strip()
+    if not token:
+        raise ValueError(f"{path} is empty")
+    return token
+
+
+def authorization(token: str) -> str:
+    """ Authorization header value a host sends. """
+    return f'Bearer {token}'
+
+
+def authorized(header: str, token: str) -> bool:
+    """ Whether an Authorization header carries the token, compared in constant time. """
+    return header is not None and hmac.compare_digest(header.encode(), authorization(token).encode())
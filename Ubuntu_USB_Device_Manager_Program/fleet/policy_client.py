@@ -0,0 +1,295 @@
+import os
+import ssl
+import json
+import uuid
+import queue
+import threading
+import http.client
+from urllib.parse import urlsplit
+from loguru import logger
+from core.decision_journal import DecisionJournal
+from fleet.auth import authorization
+from ml_model.compact_model import ARTIFACT_FILE
+from ml_model.policy_table import PolicyTable
+from utils.metrics import REGISTRY
+
+FLEET_REQUESTS = REGISTRY.counter('usb_manager_fleet_requests_total', "Requests to the fleet policy service",
+                                  ('endpoint', 'outcome'))
+FLEET_CONNECTIONS = REGISTRY.counter('usb_manager_fleet_connections_total',
+                                     "Connections opened to the fleet policy service")
+FLEET_DECISIONS = REGISTRY.counter('usb_manager_fleet_decisions_total', "Decisions of other hosts folded in")
+FLEET_VERSION = REGISTRY.gauge('usb_manager_fleet_version', "Fleet decisions version the local cache is at")
+FLEET_ONLINE = REGISTRY.gauge('usb_manager_fleet_online', "1 if the last sync with the fleet policy service worked")
+FLEET_OUTBOX = REGISTRY.gauge('usb_manager_fleet_outbox', "Local decisions waiting to be sent to the service")
+
+CACHE_FILE = 'data/fleet_cache.json'  # Host id, version, model ETag and decisions not sent yet
+FLEET_JOURNAL_FILE = 'data/fleet_decisions.jsonl'  # Other hosts' decisions, replayed into the policy at startup
+
+# What a host's policy needs of another host's decision
+FLEET_RECORD_FIELDS = ('vendor_id', 'product_id', 'serial', 'decision', 'timestamp', 'host')
+
+# The service closed a kept-alive connection, retried once on a new one
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionResetError,
+                           BrokenPipeError)
+
+
+class ConnectionPool:
+    """ Persistent HTTP/1.1 or HTTPS connections to the service, reused across requests. """
+
+    def __init__(self, url: str, size: int = 2, timeout: float = 5, cafile: str = None) -> None:
+        url = urlsplit(url)
+        self.host = url.hostname
+        self.https = url.scheme == 'https'
+        self.port = url.port or (443 if self.https else 80)
+        self.timeout = timeout
+        self.ssl_context = ssl.create_default_context(cafile=cafile) if self.https else None
+        self._idle = queue.LifoQueue(size)
+
+    def _connect(self) -> http.client.HTTPConnection:
+        FLEET_CONNECTIONS.inc()
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.ssl_context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method: str, path: str, body: bytes = None, headers: {} = None) -> ():
+        """ Send a request, returns (status, headers, body). Raises OSError or http.client.HTTPException when the
+        service can't be reached. """
+        try:
+            connection, reused = self._idle.get_nowait(), True
+        except queue.Empty:
+            connection, reused = self._connect(), False
+
+        try:
+            try:
+                connection.request(method, path, body, headers or {})
+                response = connection.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                connection.close()
+                connection = self._connect()
+                connection.request(method, path, body, headers or {})
+                response = connection.getresponse()
+            content = response.read()
+        except BaseException:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self._idle.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+        return response.status, response.headers, content
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class FleetClient:
+    """ A host's side of fleet mode: a local cache of the fleet's decisions, synced in the background. """
+
+    SYNC_INTERVAL = 30  # Seconds between syncs, a local decision triggers one right away
+    MAX_PUSH = 500  # Decisions per POST
+
+    def __init__(self, url: str, token: str, policy: PolicyTable = None, cache_path: str = CACHE_FILE,
+                 journal: DecisionJournal = None, artifact_path: str = ARTIFACT_FILE,
+                 sync_interval: float = SYNC_INTERVAL, timeout: float = 5, cafile: str = None) -> None:
+        self.url = url
+        self.policy = policy or PolicyTable()  # The manager consults it after its own, as its fallback
+        self.host = None  # This host's id, set by load()
+        self.cache_path = cache_path
+        self.journal = journal or DecisionJournal(FLEET_JOURNAL_FILE, legacy_path=None)
+        self.artifact_path = artifact_path
+        self.sync_interval = sync_interval
+        self.pool = ConnectionPool(url, timeout=timeout, cafile=cafile)
+        self.headers = {'Authorization': authorization(token)}
+
+        self.version = 0  # Fleet decisions version the cache is at
+        self.etag = None  # Of the fleet model last written to artifact_path
+        self.online = None  # Unknown until the first sync
+        self._outbox = []  # Local decisions not acknowledged by the service yet
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._dirty = False  # The cache file is behind
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self) -> None:
+        """ Replay the cached fleet decisions into the policy table, and restore the host id, version and unsent
+        decisions. Called before the first sync. """
+        try:
+            with open(self.cache_path, 'r') as file:
+                cache = json.load(file)
+        except FileNotFoundError:
+            cache = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring the fleet cache {self.cache_path}: {e}")
+            cache = {}
+
+        self.host = cache.get('host')
+        if self.host is None:
+            self.host = uuid.uuid4().hex
+            self._dirty = True
+        self.version = cache.get('version', 0)
+        self.etag = cache.get('etag')
+        self._outbox = cache.get('outbox', [])
+
+        count = 0
+        for record in self.journal.records():
+            self.policy.record(record, record['decision'])
+            count += 1
+        FLEET_VERSION.set(self.version)
+        FLEET_OUTBOX.set_function(lambda: len(self._outbox))
+        logger.info(f"Fleet cache loaded: host {self.host}, version {self.version}, {count} decisions of other hosts, "
+                    f"{len(self._outbox)} to send")
+
+    def record(self, records: [{}]) -> None:
+        """ Queue local decision records for the service. Never waits for it. """
+        with self._lock:
+            self._outbox.extend(records)
+            self._dirty = True
+        self._wake.set()
+
+    def sync(self) -> bool:
+        """ Push, pull and fetch the model once, then save the cache. False if the service couldn't be reached. """
+        with self._sync_lock:
+            try:
+                self._push()
+                self._pull()
+                self._fetch_model()
+                online = True
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                online = False
+                error = e
+
+            if online != self.online:
+                if online:
+                    logger.info(f"Fleet policy service {self.url} reachable, at version {self.version}")
+                else:
+                    logger.warning(f"Fleet policy service {self.url} unreachable, working from the cache: {error}")
+            self.online = online
+            FLEET_ONLINE.set(int(online))
+            self._save()
+            return online
+
+    def _request(self, endpoint: str, method: str, path: str, body: {} = None, headers: {} = None) -> ():
+        headers = dict(self.headers, **(headers or {}))
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        try:
+            status, response_headers, content = self.pool.request(method, path, body, headers)
+        except (OSError, http.client.HTTPException):
+            FLEET_REQUESTS.labels(endpoint, 'error').inc()
+            raise
+        FLEET_REQUESTS.labels(endpoint, str(status)).inc()
+        return status, response_headers, content
+
+    def _push(self) -> None:
+        """ Send the queued decisions, in order, until none are left. """
+        while True:
+            with self._lock:
+                batch = self._outbox[:self.MAX_PUSH]
+            if not batch:
+                return
+
+            status, _, _ = self._request('push', 'POST', '/decisions', {'host': self.host, 'decisions': batch})
+            if status != 200:
+                raise http.client.HTTPException(f"POST /decisions returned {status}")
+            with self._lock:
+                del self._outbox[:len(batch)]
+                self._dirty = True
+
+    def _pull(self) -> None:
+        """ Fold in the other hosts' decisions since the cached version, a page at a time. """
+        while True:
+            status, _, content = self._request('pull', 'GET', f'/decisions?since={self.version}')
+            if status != 200:
+                raise http.client.HTTPException(f"GET /decisions returned {status}")
+            delta = json.loads(content)
+            if delta['reset']:
+                # The delta replays the service's whole history, start over rather than count it all twice
+                logger.warning(f"Fleet policy service no longer has version {self.version}, replaying its decisions")
+                self.journal.rotate(self.journal.end_offset(), archives=0)
+                self.policy.clear()
+
+            records = [{field: record.get(field) for field in FLEET_RECORD_FIELDS}
+                       for record in delta['decisions'] if record.get('host') != self.host]
+            if records:
+                self.journal.append(*records)
+                for record in records:
+                    self.policy.record(record, record['decision'])
+                FLEET_DECISIONS.inc(len(records))
+
+            if delta['version'] != self.version:
+                self.version = delta['version']
+                self._dirty = True
+                FLEET_VERSION.set(self.version)
+            if not delta['more']:
+                return
+
+    def _fetch_model(self) -> None:
+        """ Replace the local model artifact with the fleet's when it changed, the predictor reloads it by mtime. """
+        status, headers, content = self._request('model', 'GET', '/model',
+                                                 headers={'If-None-Match': self.etag} if self.etag else None)
+        if status in (304, 404):  # Unchanged, or no model trained yet
+            return
+        if status != 200:
+            raise http.client.HTTPException(f"GET /model returned {status}")
+
+        # The predictor may be polling the file, swap the new one in atomically
+        temp_path = f'{self.artifact_path}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(content)
+        os.replace(temp_path, self.artifact_path)
+        self.etag = headers.get('ETag')
+        self._dirty = True
+        logger.info(f"Fleet model {self.etag} installed")
+
+    def _save(self) -> None:
+        """ Write the cache state atomically, if it changed. """
+        with self._lock:
+            if not self._dirty:
+                return
+            cache = {'host': self.host, 'version': self.version, 'etag': self.etag, 'outbox': list(self._outbox)}
+            self._dirty = False
+
+        temp_path = f'{self.cache_path}.tmp'
+        try:
+            with open(temp_path, 'w') as file:
+                json.dump(cache, file)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            logger.error(f"Failed to write the fleet cache to {self.cache_path}: {e}")
+            with self._lock:
+                self._dirty = True  # Try again on the next sync
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='fleet-sync', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self.sync()
+            if self._stop.is_set():
+                return
+            self._wake.wait(self.sync_interval)
+            self._wake.clear()
+
+    def stop(self) -> None:
+        """ Sync a last time and stop, what couldn't be sent stays in the cache for the next run. """
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._save()
+        self.pool.close()
+        self.journal.close()
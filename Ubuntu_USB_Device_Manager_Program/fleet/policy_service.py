@@ -0,0 +1,223 @@
+import os
+import ssl
+import json
+import time
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+from core.decision_journal import DecisionJournal, get_journal
+from fleet.auth import TOKEN_FILE, read_token, authorized
+from ml_model.compact_model import ARTIFACT_FILE
+
+DEFAULT_PORT = 8650
+DEFAULT_HOST = '127.0.0.1'  # Listen on other interfaces explicitly, over TLS
+
+
+class PolicyService:
+    """ Aggregates the fleet's decisions in a journal and publishes them and the model as versioned snapshots. """
+
+    MAX_DELTA = 1000  # Decisions per response, a host far behind fetches several pages
+    TRAIN_INTERVAL = 300  # Seconds between trainings, if decisions came in meanwhile, None to never train
+
+    def __init__(self, journal: DecisionJournal = None, artifact_path: str = ARTIFACT_FILE,
+                 train_interval: float = TRAIN_INTERVAL, delay: float = 0.0) -> None:
+        self.journal = journal or get_journal()
+        self.artifact_path = artifact_path
+        self.train_interval = train_interval
+        self.delay = delay  # Added to every response, to test hosts against a slow service
+        self._model = (None, None, None)  # (artifact mtime, etag, content)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def add_decisions(self, host: str, decisions: [{}]) -> int:
+        """ Journal a host's decisions, tagged with the host. Returns the new version. """
+        records = [dict(decision, host=host) for decision in decisions]
+        with self._lock:
+            if records:
+                self.journal.append(*records)
+            return self.journal.end_offset()
+
+    def decisions_since(self, version: int) -> {}:
+        """ The decisions after a version, at most MAX_DELTA of them. A version the service doesn't know (its
+        journal was reset) gets everything again, with reset set. """
+        end = self.journal.end_offset()
+        reset = version > end
+        if reset:
+            version = 0
+
+        decisions = []
+        for record, offset in self.journal.records_with_offsets(version):
+            if 'decision' not in record:
+                continue
+            decisions.append(record)
+            version = offset
+            if len(decisions) == self.MAX_DELTA:
+                break
+        more = len(decisions) == self.MAX_DELTA
+        return {'version': version if more else max(version, end), 'decisions': decisions, 'more': more,
+                'reset': reset}
+
+    def model(self) -> ():
+        """ The published model artifact as (etag, content), (None, None) before the first training. """
+        try:
+            mtime = os.stat(self.artifact_path).st_mtime_ns
+        except FileNotFoundError:
+            return None, None
+
+        with self._lock:
+            if self._model[0] != mtime:
+                with open(self.artifact_path, 'rb') as file:
+                    content = file.read()
+                self._model = (mtime, hashlib.sha1(content).hexdigest(), content)
+            return self._model[1], self._model[2]
+
+    def start_training(self) -> None:
+        """ Retrain the fleet's model in the background every TRAIN_INTERVAL seconds, if anything changed. """
+        if self.train_interval is None:
+            return
+        threading.Thread(target=self._train, name='fleet-training', daemon=True).start()
+
+    def _train(self) -> None:
+        from ml_model.model import start_background_training
+
+        trained = None
+        while not self._stop.wait(self.train_interval):
+            version = self.journal.end_offset()
+            if version != trained:
+                start_background_training().join()
+                trained = version
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+class PolicyRequestHandler(BaseHTTPRequestHandler):
+    """ GET /decisions?since=<version>, POST /decisions, GET /model (with If-None-Match) and GET /health, each
+    with the fleet's token as a bearer token. HTTP/1.1, so the hosts keep their connections open between requests. """
+
+    protocol_version = 'HTTP/1.1'
+    service = None  # Set on the subclass made by make_server()
+    token = None  # Likewise
+
+    def _send(self, status: int, body: bytes = b'', headers: {} = None) -> None:
+        if self.service.delay:
+            time.sleep(self.service.delay)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, payload: {}) -> None:
+        self._send(200, json.dumps(payload).encode(), {'Content-Type': 'application/json'})
+
+    def _authorize(self) -> bool:
+        """ Answer 401 and drop the connection, whose request body is left unread, unless the token is right. """
+        if authorized(self.headers.get('Authorization'), self.token):
+            return True
+        self.close_connection = True
+        self._send(401, headers={'WWW-Authenticate': 'Bearer', 'Connection': 'close'})
+        return False
+
+    def do_GET(self) -> None:
+        if not self._authorize():
+            return
+        url = urlsplit(self.path)
+        if url.path == '/decisions':
+            try:
+                since = int(parse_qs(url.query).get('since', ['0'])[0])
+            except ValueError:
+                self._send(400)
+                return
+            self._send_json(self.service.decisions_since(since))
+        elif url.path == '/model':
+            etag, content = self.service.model()
+            if etag is None:
+                self._send(404)
+            elif self.headers.get('If-None-Match') == etag:
+                self._send(304, headers={'ETag': etag})
+            else:
+                self._send(200, content, {'Content-Type': 'application/json', 'ETag': etag})
+        elif url.path == '/health':
+            self._send_json({'version': self.service.journal.end_offset()})
+        else:
+            self._send(404)
+
+    def do_POST(self) -> None:
+        if not self._authorize():
+            return
+        if urlsplit(self.path).path != '/decisions':
+            self._send(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            version = self.service.add_decisions(request['host'], request['decisions'])
+        except (ValueError, KeyError, TypeError):
+            self._send(400)
+            return
+        self._send_json({'version': version})
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def make_server(service: PolicyService, token: str, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                ssl_context: ssl.SSLContext = None) -> ThreadingHTTPServer:
+    """ An HTTP server for the service, HTTPS given an SSL context. Port 0 picks a free one (server.server_address
+    has it). """
+    handler = type('BoundPolicyRequestHandler', (PolicyRequestHandler,), {'service': service, 'token': token})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    if ssl_context is not None:
+        # The handshake happens on the first read, in the connection's thread rather than the accepting one
+        server.socket = ssl_context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fleet policy service: aggregates the decisions of every host and "
+                                                 "publishes them and the model trained on them")
+    parser.add_argument('--directory', default='.', help="Data directory, holds data/ and ml_model/")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="Address to listen on, '' for every interface")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--token-file', default=TOKEN_FILE, help="Secret shared with the hosts, in the directory")
+    parser.add_argument('--certfile', help="Certificate chain to serve HTTPS with")
+    parser.add_argument('--keyfile', help="Its private key, if not in the certfile")
+    parser.add_argument('--train-interval', type=float, default=PolicyService.TRAIN_INTERVAL)
+    parser.add_argument('--delay', type=float, default=0.0, help="Seconds added to every response, for tests")
+    args = parser.parse_args()
+
+    # Same relative layout as a host, so the journal and training code run unchanged. Imports are done already
+    os.chdir(args.directory)
+    os.makedirs('data', exist_ok=True)
+    os.makedirs('ml_model', exist_ok=True)
+
+    try:
+        token = read_token(args.token_file)
+    except (OSError, ValueError) as e:
+        parser.error(f"Can't read the fleet token: {e}")
+    ssl_context = None
+    if args.certfile:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.certfile, args.keyfile)
+    elif args.host not in ('127.0.0.1', 'localhost', '::1'):
+        logger.warning(f"Serving plain HTTP on {args.host or 'every interface'}, the token and decisions are sent in "
+                       f"the clear, pass --certfile")
+
+    service = PolicyService(train_interval=args.train_interval, delay=args.delay)
+    service.start_training()
+    server = make_server(service, token, args.host, args.port, ssl_context)
+    logger.info(f"Fleet policy service listening on {server.server_address}, version {service.journal.end_offset()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        service.stop()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
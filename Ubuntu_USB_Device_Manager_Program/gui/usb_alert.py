@@ -2,9 +2,12 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
 
+# Responses of the multi-device dialog, on top of Allow (YES) and Block (NO)
+RESPONSE_APPLY = 1
+
 
 class USBAlertDialog(Gtk.Dialog):
-    def __init__(self, device_info: {}) -> None:
+    def __init__(self, devices_info: [{}]) -> None:
         super().__init__(title="USB Device Alert", flags=Gtk.DialogFlags.MODAL | Gtk.DialogFlags.DESTROY_WITH_PARENT)
 
         # Set dialog properties
@@ -14,23 +17,56 @@ class USBAlertDialog(Gtk.Dialog):
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
         vbox.set_border_width(10)  # Add padding around the box
 
-        # Create the label with the device information
-        label = Gtk.Label(label=f"USB Device Detected:\n\n"
-                                f"Vendor ID: {device_info['vendor_id']}\n"
-                                f"Product ID: {device_info['product_id']}\n"
-                                f"Serial: {device_info['serial']}\n\n"
-                                f"Do you want to allow or block this device?")
-
-        # Add the label to the vertical box
-        vbox.pack_start(label, expand=False, fill=False, padding=0)
-
-        # Add a checkbox for auto-allow with extra padding between the label and the checkbox
-        self.auto_allow_checkbox = Gtk.CheckButton(label="Automatically allow this type of device in the future")
-        vbox.pack_start(self.auto_allow_checkbox, expand=False, fill=False, padding=20)  # Add padding for space
-
-        # Add "Allow" and "Block" buttons to the dialog
-        self.add_button("Allow", Gtk.ResponseType.YES)
-        self.add_button("Block", Gtk.ResponseType.NO)
+        # One (allow radio button, block radio button, auto-allow checkbox) per device
+        self.rows = []
+
+        if len(devices_info) == 1:
+            device_info = devices_info[0]
+
+            # Create the label with the device information
+            label = Gtk.Label(label=f"USB Device Detected:\n\n"
+                                    f"Vendor ID: {device_info['vendor_id']}\n"
+                                    f"Product ID: {device_info['product_id']}\n"
+                                    f"Serial: {device_info['serial']}\n\n"
+                                    f"Do you want to allow or block this device?")
+
+            # Add the label to the vertical box
+            vbox.pack_start(label, expand=False, fill=False, padding=0)
+
+            # Add a checkbox for auto-allow with extra padding between the label and the checkbox
+            auto_allow_checkbox = Gtk.CheckButton(label="Automatically allow this type of device in the future")
+            vbox.pack_start(auto_allow_checkbox, expand=False, fill=False, padding=20)  # Add padding for space
+            self.rows.append((None, None, auto_allow_checkbox))
+
+            # Add "Allow" and "Block" buttons to the dialog
+            self.add_button("Allow", Gtk.ResponseType.YES)
+            self.add_button("Block", Gtk.ResponseType.NO)
+        else:
+            label = Gtk.Label(label=f"{len(devices_info)} USB Devices Detected.\n\n"
+                                    f"Choose whether to allow or block each device, or leave it for later:")
+            vbox.pack_start(label, expand=False, fill=False, padding=0)
+
+            # A row per device: its details, allow/block and auto-allow
+            grid = Gtk.Grid(row_spacing=6, column_spacing=12)
+            for row, device_info in enumerate(devices_info):
+                details = Gtk.Label(label=f"{device_info['vendor_id']}:{device_info['product_id']}  "
+                                          f"Serial: {device_info['serial']}", xalign=0)
+                later_button = Gtk.RadioButton(label="Later")
+                allow_button = Gtk.RadioButton(label="Allow", group=later_button)
+                block_button = Gtk.RadioButton(label="Block", group=later_button)
+                later_button.set_active(True)  # Nothing is decided for the user, so no keyboard is blocked
+                auto_allow_checkbox = Gtk.CheckButton(label="Auto-allow")
+
+                for column, widget in enumerate((details, allow_button, block_button, later_button,
+                                                 auto_allow_checkbox)):
+                    grid.attach(widget, column, row, 1, 1)
+                self.rows.append((allow_button, block_button, auto_allow_checkbox))
+            vbox.pack_start(grid, expand=False, fill=False, padding=10)
+
+            # Add "Allow all", "Block all" and "Apply" buttons to the dialog
+            self.add_button("Allow all", Gtk.ResponseType.YES)
+            self.add_button("Block all", Gtk.ResponseType.NO)
+            self.add_button("Apply", RESPONSE_APPLY)
 
         # Add the vbox containing the label and checkbox to the dialog's content area
         box = self.get_content_area()
@@ -39,27 +75,33 @@ class USBAlertDialog(Gtk.Dialog):
         # Show all widgets in the dialog
         self.show_all()
 
-    def is_auto_allow(self) -> bool:
-        """ Return whether the checkbox is active. """
-        return self.auto_allow_checkbox.get_active()
-
-
-def show_usb_alert(device_info: {}) -> []:
-    """ Shows a GTK dialog asking the user whether to allow or block the USB device, with an auto-allow option. """
-    dialog = USBAlertDialog(device_info)
+    def decisions(self, response: int) -> [()]:
+        """ Return a (decision, auto_allow) pair per device for the dialog's response, the decision is None for a
+        device left undecided. """
+        decisions = []
+        for allow_button, block_button, auto_allow_checkbox in self.rows:
+            if response == Gtk.ResponseType.YES:
+                decision = 'allow'
+            elif response == Gtk.ResponseType.NO:
+                decision = 'block'
+            elif response == RESPONSE_APPLY and allow_button is not None:
+                decision = 'allow' if allow_button.get_active() else 'block' if block_button.get_active() else None
+            else:
+                decision = None  # Dismissed, the devices are left as they are
+
+            auto_allow = auto_allow_checkbox.get_active()  # Check if auto-allow is selected
+            decisions.append((decision, auto_allow))
+        return decisions
+
+
+def show_usb_alerts(devices_info: [{}]) -> [()]:
+    """ Shows a single GTK dialog asking the user whether to allow or block each of the USB devices,
+    with a per-device auto-allow option. Returns a (decision, auto_allow) pair per device, None for undecided. """
+    dialog = USBAlertDialog(devices_info)
 
     # Run the dialog and block until a response is received
     response = dialog.run()
-
-    # Handle the response and close the dialog
-    if response == Gtk.ResponseType.YES:
-        decision = 'allow'
-    elif response == Gtk.ResponseType.NO:
-        decision = 'block'
-    else:
-        decision = 'block'  # Default to blocking if no valid response
-
-    auto_allow = dialog.is_auto_allow()  # Check if auto-allow is selected
+    decisions = dialog.decisions(response)
 
     # Explicitly destroy the dialog
     dialog.destroy()
@@ -68,4 +110,9 @@ def show_usb_alert(device_info: {}) -> []:
     while Gtk.events_pending():
         Gtk.main_iteration()
 
-    return decision, auto_allow
+    return decisions
+
+
+def show_usb_alert(device_info: {}) -> []:
+    """ Shows a GTK dialog asking the user whether to allow or block the USB device, with an auto-allow option. """
+    return show_usb_alerts([device_info])[0]
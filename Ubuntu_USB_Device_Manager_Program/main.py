@@ -1,9 +1,11 @@
 from loguru import logger
-from core.device_manager import USBDeviceManager
-from ml_model.model import train_model
-from gui.get_sudo_password import get_sudo_password_gui  # Import the GUI function
 
-if __name__ == "__main__":
+
+def main() -> None:
+    # Heavier modules are imported only once they're needed, GTK for the password and the popups,
+    # scikit-learn by the training process only
+    from gui.get_sudo_password import get_sudo_password_gui  # Import the GUI function
+
     # Prompt for the sudo password using the GUI
     sudo_password = get_sudo_password_gui()
 
@@ -12,9 +14,19 @@ if __name__ == "__main__":
         logger.error("No password provided. Exiting...")
         exit(1)
 
-    # Train the model when the program starts
-    train_model()
+    from core.device_manager import USBDeviceManager
+    from ml_model.model import start_background_training
 
-    # Start monitoring USB devices with the sudo password
     manager = USBDeviceManager(sudo_password)
+
+    # Retrain the model in the background, monitoring starts right away with the last saved one.
+    # In fleet mode the service trains on every host's decisions and the model comes from it
+    if manager.fleet is None:
+        start_background_training()
+
+    # Start monitoring USB devices with the sudo password
     manager.monitor_usb_devices()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import os
+import json
+from array import array
+from loguru import logger
+
+ARTIFACT_FILE = 'ml_model/model_artifact.json'
+ARTIFACT_FORMAT = 1  # Bumped whenever the layout below changes
+
+# The tree's features, in column order
+FEATURES = ('vendor_id', 'product_id', 'serial')
+
+# Features a device must have been seen with to be classified at all, a new vendor or product always gets a popup
+KNOWN_FEATURES = tuple(FEATURES.index(feature) for feature in ('vendor_id', 'product_id'))
+
+
+def export_model(model, vocabularies: [[]], path: str = ARTIFACT_FILE, trained_on: int = 0) -> None:
+    """ Write a fitted tree and its features' vocabularies to a versioned artifact readable without sklearn. """
+    tree = model.tree_
+    leaf_classes = model.classes_[tree.value[:, 0, :].argmax(axis=1)]
+
+    artifact = {
+        'format': ARTIFACT_FORMAT,
+        'trained_on': trained_on,  # Number of decisions the model was fitted on
+        'nodes': {
+            'left': tree.children_left.tolist(),
+            'right': tree.children_right.tolist(),
+            'feature': tree.feature.tolist(),
+            'threshold': tree.threshold.tolist(),
+            'leaf_class': [int(leaf_class) for leaf_class in leaf_classes],
+        },
+        'vocabularies': {feature: {str(value): code for code, value in enumerate(vocabulary)}
+                         for feature, vocabulary in zip(FEATURES, vocabularies)},
+    }
+
+    # Readers may be polling the file, swap the new one in atomically
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(artifact, file, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+
+class CompactModel:
+    """ Decision tree evaluator over the exported artifact, without scikit-learn, NumPy or pickle. """
+
+    def __init__(self, nodes: {}, vocabularies: {}, trained_on: int = 0) -> None:
+        # Array-backed node tables, compact and cheap to index
+        self.left = array('i', nodes['left'])
+        self.right = array('i', nodes['right'])
+        self.feature = array('i', nodes['feature'])
+        self.threshold = array('d', nodes['threshold'])
+        self.leaf_class = array('b', nodes['leaf_class'])
+        self.vocabularies = [vocabularies[feature] for feature in FEATURES]
+        self.trained_on = trained_on
+
+    @classmethod
+    def load(cls, path: str = ARTIFACT_FILE) -> 'CompactModel':
+        """ Load the artifact, None if it is missing or written by an incompatible version. """
+        try:
+            with open(path, 'r') as file:
+                artifact = json.load(file)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            logger.error(f"Model artifact {path} is corrupted.")
+            return None
+
+        if artifact.get('format') != ARTIFACT_FORMAT:
+            logger.error(f"Model artifact {path} has format {artifact.get('format')}, expected {ARTIFACT_FORMAT}.")
+            return None
+        return cls(artifact['nodes'], artifact['vocabularies'], artifact.get('trained_on', 0))
+
+    def encode(self, device_info: {}) -> ():
+        """ Encode the device's features, None for values the model has never seen. """
+        return tuple(vocabulary.get(device_info[feature])
+                     for feature, vocabulary in zip(FEATURES, self.vocabularies))
+
+    def predict_encoded(self, codes: ()) -> int:
+        """ Return the class of the encoded device, None if it depends on a value the model has never seen. """
+        if any(codes[index] is None for index in KNOWN_FEATURES):
+            return None
+
+        left, right, feature, threshold = self.left, self.right, self.feature, self.threshold
+
+        # The common case, every value is known: a straight walk down to one leaf
+        if None not in codes:
+            node = 0
+            while left[node] != -1:
+                node = left[node] if codes[feature[node]] <= threshold[node] else right[node]
+            return self.leaf_class[node]
+
+        classes = set()
+        pending = [0]
+        while pending:
+            node = pending.pop()
+            if left[node] == -1:
+                classes.add(self.leaf_class[node])
+                if len(classes) > 1:
+                    return None
+                continue
+
+            code = codes[feature[node]]
+            if code is None:
+                pending += (left[node], right[node])  # Unseen value, the split can go either way
+            else:
+                pending.append(left[node] if code <= threshold[node] else right[node])
+        return classes.pop()
+
+    def predict(self, device_info: {}) -> int:
+        """ Return the class of the device (1 allow, 0 block), None when it can't be told. """
+        return self.predict_encoded(self.encode(device_info))
+
+    def predict_batch(self, rows: [()]) -> [int]:
+        """ Classify many encoded devices. """
+        return [self.predict_encoded(codes) for codes in rows]
+
+    def __len__(self) -> int:
+        return len(self.left)
@@ -1,123 +1,204 @@
-import json
-import numpy as np
-from sklearn.tree import DecisionTreeClassifier
-import joblib
-from sklearn.preprocessing import LabelEncoder
+import os
+import multiprocessing
 from loguru import logger
+from core.decision_journal import get_journal
+from core.decision_counters import DecisionCounters
+from ml_model.compact_model import CompactModel, export_model, ARTIFACT_FILE, FEATURES
+from ml_model.online_model import OnlineModel
+from ml_model.policy_table import PolicyTable
+from ml_model.training_store import TrainingStore, COLUMNS
 
-MODEL_FILE = 'ml_model/saved_model.pkl'
-LOG_FILE = 'data/usb_device_logs.json'
+# Bumped every time train_model publishes a new model in this process
+_model_version = 0
 
 
-def train_model() -> None:
+def train_model(store: TrainingStore = None) -> None:
     """ Train the model on the logged USB device data. """
-    with open(LOG_FILE, 'r') as file:
-        logs = json.load(file)
+    global _model_version
 
-    if len(logs) == 0:
+    # Only training needs these, prediction runs from the compact artifact
+    import numpy as np
+    from sklearn.tree import DecisionTreeClassifier
+
+    # Fold the decisions logged since the last training into the columnar store, the rest is already encoded
+    store = store or TrainingStore()
+    store.compact(get_journal())
+
+    if len(store) == 0:
         logger.warning("No data to train the model.")
         return None
 
-    # Extract features and labels, skipping entries without 'decision'
-    vendor_ids = []
-    product_ids = []
-    serials = []
-    decisions = []
-
-    vendor_allow_count = {}  # Track how many times a vendor has been allowed
-
-    for log in logs:
-        if 'decision' not in log:
-            continue
-        vendor_id = log['vendor_id']
-        vendor_ids.append(vendor_id)
-        product_ids.append(log['product_id'])
-        serials.append(log['serial'])
-        decisions.append(1 if log['decision'] == 'allow' else 0)
-
-        # Increment the count for each vendor being allowed
-        if log['decision'] == 'allow':
-            if vendor_id not in vendor_allow_count:
-                vendor_allow_count[vendor_id] = 0
-            vendor_allow_count[vendor_id] += 1
+    # A zero-copy view of the memory-mapped rows: one column per feature code, then the label
+    table = np.frombuffer(store.columns(), dtype=np.int32).reshape(-1, len(COLUMNS))
+    X = table[:, :len(FEATURES)]
+    y = table[:, len(FEATURES)]
 
     # Check the balance of "allow" vs "block"
-    allow_count = decisions.count(1)
-    block_count = decisions.count(0)
+    allow_count = int(y.sum())
+    block_count = len(y) - allow_count
     logger.info(f"Training data: {allow_count} allow, {block_count} block")
 
-    # Encode features and train model as before
-    le_vendor = LabelEncoder()
-    le_product = LabelEncoder()
-    le_serial = LabelEncoder()
-
-    vendor_ids_encoded = le_vendor.fit_transform(vendor_ids)
-    product_ids_encoded = le_product.fit_transform(product_ids)
-    serials_encoded = le_serial.fit_transform(serials)
-
-    X = np.column_stack((vendor_ids_encoded, product_ids_encoded, serials_encoded))
-    y = np.array(decisions)
-
     model = DecisionTreeClassifier()
     model.fit(X, y)
 
-    # Save the trained model and encoders
-    joblib.dump(model, MODEL_FILE)
-    joblib.dump(le_vendor, 'ml_model/le_vendor.pkl')
-    joblib.dump(le_product, 'ml_model/le_product.pkl')
-    joblib.dump(le_serial, 'ml_model/le_serial.pkl')
-
-    logger.info("Model and encoders trained and saved.")
+    # Export it sklearn-free, with the store's vocabularies, which is what the predictor loads
+    export_model(model, store.vocabularies, ARTIFACT_FILE, trained_on=len(y))
+
+    # Let resident predictors know that a new model was published
+    _model_version += 1
+
+    logger.info("Model trained and saved.")
+
+
+def _train_in_background() -> None:
+    """ Entry point of the training process. """
+    os.nice(10)  # Never compete with the daemon for the CPU
+    train_model()
+
+
+def start_background_training() -> multiprocessing.Process:
+    """ Retrain in a separate process, so the daemon keeps handling devices with the last saved model meanwhile.
+    The new artifact is swapped in atomically, resident predictors pick it up on their next refresh. """
+    # spawn, since the daemon may already have threads running
+    process = multiprocessing.get_context('spawn').Process(target=_train_in_background, name='model-training',
+                                                           daemon=True)
+    process.start()
+    logger.info(f"Retraining the model in the background (pid {process.pid})")
+    return process
+
+
+class ModelPredictor:
+    """ Policy table, then online model, then the resident compact model, reloaded when it changes. """
+
+    MODEL_FILES = (ARTIFACT_FILE,)
+
+    def __init__(self, online_model: OnlineModel = None, policy: PolicyTable = None,
+                 counters: DecisionCounters = None) -> None:
+        self.online_model = online_model
+        self.policy = policy or PolicyTable()
+        self.model = None  # CompactModel, None until a model was trained
+
+        if counters is None:
+            counters = DecisionCounters()
+            counters.load()
+        self.counters = counters
+        self.policy.set_vendor_allow_count(counters.vendor_counts('auto_allow'))
+
+        self._model_mtimes = None
+        self._model_version = None
+
+        # Counters for confirming the resident cache is doing its job
+        self.loads = 0
+        self.reloads = 0
+        self.hits = 0
+
+    def _stat_mtimes(self, paths: ()) -> ():
+        """ Return the mtimes of the given files, None for missing ones. """
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def _load_model(self, mtimes: ()) -> None:
+        """ Load the compact model artifact. """
+        self.model = CompactModel.load(ARTIFACT_FILE)
+        if self.model is None:
+            logger.error("Model artifact not found.")
+
+        self._model_mtimes = mtimes
+        self._model_version = _model_version
+
+    def refresh(self) -> None:
+        """ Reload whatever changed on disk since the last call. """
+        model_mtimes = self._stat_mtimes(self.MODEL_FILES)
+
+        stale = model_mtimes != self._model_mtimes or _model_version != self._model_version
+        if stale:
+            self._load_model(model_mtimes)
+
+        if not stale:
+            self.hits += 1
+        elif self.loads == 0:
+            self.loads += 1
+        else:
+            self.reloads += 1
+            logger.info("Model files changed, reloaded them.")
+
+    def stats(self) -> {}:
+        """ Return the load/hit/reload counters. """
+        return {'loads': self.loads, 'hits': self.hits, 'reloads': self.reloads}
+
+    def predict(self, device_info: {}) -> '':
+        """ Predict whether a device should be allowed or blocked based on past data.
+        Returns 'allow', 'block' (only from the policy table) or None when the user should be asked. """
+        self.refresh()
+
+        verdict, features = self._decide_or_encode(device_info)
+        if features is None:
+            return verdict
+
+        # Model prediction (fallback if auto-allow threshold is not met)
+        prediction = self.model.predict_encoded(features)
+        return 'allow' if prediction == 1 else None
+
+    def predict_batch(self, devices: [{}]) -> ['']:
+        """ Predict many devices at once, e.g. everything attached at startup.
+        The devices that reach the tree are classified together, in one pass over the compact model. """
+        self.refresh()
+
+        predictions = [None] * len(devices)
+        rows = []
+        row_indexes = []
+        for index, device_info in enumerate(devices):
+            predictions[index], features = self._decide_or_encode(device_info)
+            if features is not None:
+                rows.append(features)
+                row_indexes.append(index)
+
+        if rows:
+            for index, prediction in zip(row_indexes, self.model.predict_batch(rows)):
+                predictions[index] = 'allow' if prediction == 1 else None
+        return predictions
+
+    def _decide_or_encode(self, device_info: {}) -> ():
+        """ Return (verdict, None) when the device is decided without the tree,
+        or (None, encoded features) when the tree has to classify it. """
+        # Explicit verdicts, including allowing a vendor once it has been auto-allowed 5 or more times
+        verdict = self.policy.lookup(device_info)
+        if verdict is not None:
+            logger.info(f"Policy table says {verdict} for USB device from vendor {device_info['vendor_id']}")
+            return verdict, None
+
+        # The online model has seen every decision, the tree only those made before the last training
+        if self.online_model is not None:
+            online_prediction = self.online_model.predict(device_info)
+            if online_prediction == 'allow':
+                return 'allow', None
+            if online_prediction == 'block':
+                return None, None  # Recently blocked, don't let a stale tree allow it
+
+        if self.model is None:
+            return None, None
+
+        # Values the model has never seen are encoded as None and handled by the model itself
+        features = self.model.encode(device_info)
+        if None in features:
+            unseen = [feature for feature, code in zip(FEATURES, features) if code is None]
+            logger.warning(f"{', '.join(unseen)} of {device_info['vendor_id']}:{device_info['product_id']} "
+                           f"not seen in training.")
+        return None, features
+
+
+_default_predictor = None
 
 
 def predict(device_info: {}) -> '':
     """ Predict whether a device should be allowed or blocked based on past data. """
-    try:
-        model = joblib.load(MODEL_FILE)
-        le_vendor = joblib.load('ml_model/le_vendor.pkl')
-        le_product = joblib.load('ml_model/le_product.pkl')
-        le_serial = joblib.load('ml_model/le_serial.pkl')
-    except FileNotFoundError:
-        logger.error("Model or encoders not found.")
-        return None
-
-    # Load vendor allow counts
-    try:
-        with open('data/vendor_allow_counts.json', 'r') as f:
-            vendor_allow_count = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        vendor_allow_count = {}
-
-    vendor_id = device_info['vendor_id']
-
-    # Automatically allow only if the vendor has been allowed 5 or more times
-    if vendor_allow_count.get(vendor_id, 0) >= 5:
-        logger.info(f"Automatically allowing USB device from vendor {vendor_id}")
-        return 'allow'
-
-    # Handle unseen values for LabelEncoders
-    try:
-        vendor_encoded = le_vendor.transform([device_info['vendor_id']])[0]
-    except ValueError:
-        logger.warning(f"Vendor ID {device_info['vendor_id']} not recognized by encoder.")
-        return None  # Prompt user for decision
-
-    try:
-        product_encoded = le_product.transform([device_info['product_id']])[0]
-    except ValueError:
-        logger.warning(f"Product ID {device_info['product_id']} not recognized by encoder.")
-        return None  # Prompt user for decision
-
-    try:
-        serial_encoded = le_serial.transform([device_info['serial']])[0]
-    except ValueError:
-        logger.warning(f"Serial {device_info['serial']} not recognized by encoder.")
-        return None  # Prompt user for decision
-
-    # Convert device info to features for the model
-    features = np.array([[vendor_encoded, product_encoded, serial_encoded]])
-
-    # Model prediction (fallback if auto-allow threshold is not met)
-    prediction = model.predict(features)
-    return 'allow' if prediction == 1 else None
+    global _default_predictor
 
+    if _default_predictor is None:
+        _default_predictor = ModelPredictor()
+    return _default_predictor.predict(device_info)
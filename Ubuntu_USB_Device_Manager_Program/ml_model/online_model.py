@@ -0,0 +1,144 @@
+import os
+import json
+import math
+import zlib
+import threading
+from array import array
+from loguru import logger
+from core.decision_journal import DecisionJournal
+from ml_model.training_store import TrainingStore
+
+CHECKPOINT_FILE = 'ml_model/online_model.json'
+
+
+class OnlineModel:
+    """ Logistic regression over hashed device features, updated in place after every decision.
+    Each update touches a fixed number of weights, so its cost doesn't grow with the history. """
+
+    N_WEIGHTS = 2 ** 16
+    LEARNING_RATE = 0.5
+    ALLOW_THRESHOLD = 0.9  # Auto-allow only above this probability
+    BLOCK_THRESHOLD = 0.1  # Below this probability the batch model's answer isn't trusted either
+    CHECKPOINT_EVERY = 20  # Decisions between checkpoints
+
+    def __init__(self, journal: DecisionJournal, checkpoint_file: str = CHECKPOINT_FILE) -> None:
+        self.journal = journal
+        self.checkpoint_file = checkpoint_file
+        self.weights = array('d', bytes(8 * self.N_WEIGHTS))
+        self.products = set()  # vendor:product pairs learned from, only those can be auto-allowed
+        self.updates = 0
+        self._since_checkpoint = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _features(device_info: {}) -> ():
+        """ Hash the device's vendor, vendor:product and vendor:product:serial into weight indexes. """
+        vendor = device_info['vendor_id']
+        product = f"{vendor}:{device_info['product_id']}"
+        serial = f"{product}:{device_info['serial']}"
+
+        # crc32 is stable across processes, unlike hash(), so checkpoints stay valid
+        return tuple(zlib.crc32(f'{name}={value}'.encode()) % OnlineModel.N_WEIGHTS
+                     for name, value in (('v', vendor), ('vp', product), ('vps', serial)))
+
+    def probability(self, device_info: {}) -> float:
+        """ Return the probability that the user would allow the device. """
+        score = sum(self.weights[index] for index in self._features(device_info))
+        return 1 / (1 + math.exp(-max(min(score, 30), -30)))
+
+    def predict(self, device_info: {}) -> '':
+        """ Return 'allow' or 'block' when the model is confident, None otherwise. """
+        probability = self.probability(device_info)
+        if probability >= self.ALLOW_THRESHOLD:
+            # The vendor's weight alone mustn't allow a product never decided on, e.g. a spoofed vendor id
+            if f"{device_info['vendor_id']}:{device_info['product_id']}" not in self.products:
+                return None
+            return 'allow'
+        if probability <= self.BLOCK_THRESHOLD:
+            return 'block'
+        return None
+
+    def _update(self, device_info: {}, decision: str) -> None:
+        """ Single SGD step on the log loss. """
+        features = self._features(device_info)
+        label = 1 if decision == 'allow' else 0
+        gradient = label - self.probability(device_info)
+
+        for index in features:
+            self.weights[index] += self.LEARNING_RATE * gradient
+        self.products.add(f"{device_info['vendor_id']}:{device_info['product_id']}")
+        self.updates += 1
+
+    def learn(self, device_info: {}, decision: str) -> None:
+        """ Fold a freshly logged decision into the model, checkpointing periodically. """
+        self.learn_batch([(device_info, decision)])
+
+    def learn_batch(self, decisions: [()]) -> None:
+        """ Fold (device information, decision) pairs logged together into the model. A checkpoint covers the
+        journal's end, so it is only taken once all of them are learned. """
+        with self._lock:
+            for device_info, decision in decisions:
+                self._update(device_info, decision)
+            self._since_checkpoint += len(decisions)
+
+            if self._since_checkpoint >= self.CHECKPOINT_EVERY:
+                self._checkpoint()
+
+    def checkpoint(self) -> None:
+        """ Save the weights together with the journal offset they cover. """
+        with self._lock:
+            self._checkpoint()
+
+    def _checkpoint(self) -> None:
+        state = {
+            'updates': self.updates,
+            'journal_offset': self.journal.end_offset(),
+            # Only a handful of weights are ever touched, so store them sparsely
+            'weights': {index: weight for index, weight in enumerate(self.weights) if weight},
+            'products': sorted(self.products),
+        }
+
+        temp_path = f'{self.checkpoint_file}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(state, file)
+        os.replace(temp_path, self.checkpoint_file)
+
+        self._since_checkpoint = 0
+
+    def resume(self, store: TrainingStore = None) -> None:
+        """ Load the last checkpoint and fold in only the decisions journaled after it.
+        Without a checkpoint, learn from the training store's rows and the journal past them, if given. """
+        offset = None
+        try:
+            with open(self.checkpoint_file, 'r') as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            logger.info("No online model checkpoint, learning from the whole journal")
+        except json.JSONDecodeError:
+            logger.error(f"Online model checkpoint {self.checkpoint_file} is corrupted, relearning")
+        else:
+            if 'products' not in state:
+                logger.info("Online model checkpoint predates the learned products, relearning")
+            else:
+                for index, weight in state['weights'].items():
+                    self.weights[int(index)] = weight
+                self.products = set(state['products'])
+                self.updates = state['updates']
+                offset = state['journal_offset']
+
+        if offset is None and store is not None:
+            history = store.history(self.journal)
+        else:
+            history = ((record, record['decision']) for record in self.journal.records(offset or 0)
+                       if 'decision' in record)
+
+        replayed = 0
+        with self._lock:
+            for device_info, decision in history:
+                self._update(device_info, decision)
+                replayed += 1
+
+            if replayed:
+                self._checkpoint()
+
+        logger.info(f"Online model resumed: {self.updates} updates, {replayed} replayed from the journal")
@@ -0,0 +1,112 @@
+import threading
+from loguru import logger
+from core.decision_journal import DecisionJournal
+from ml_model.training_store import TrainingStore
+
+
+class PolicyTable:
+    """ Explicit allow/block verdicts at the device, vendor:product and vendor level. """
+
+    PRODUCT_STREAK = 3  # Same decision this many times in a row for a (vendor, product) pair makes it a policy
+    VENDOR_BLOCK_STREAK = 5  # Blocks in a row, across the vendor's products, that block the whole vendor
+    VENDOR_ALLOW_COUNT = 5  # Auto-allow ticks (DecisionCounters 'auto_allow') that allow the whole vendor
+
+    def __init__(self) -> None:
+        self._exact = {}  # (vendor, product, serial) -> last decision
+        self._product = {}  # (vendor, product) -> decision, once its streak is long enough
+        self._vendor = {}  # vendor -> decision
+
+        # Running streaks the policies are compiled from: key -> (decision, decisions in a row)
+        self._product_streaks = {}
+        self._vendor_streaks = {}
+        self._vendor_allow_count = {}
+
+        self.fallback = None  # Table consulted only when this one has no verdict, e.g. the fleet's decisions
+
+        self._lock = threading.Lock()
+
+    def build(self, journal: DecisionJournal, store: TrainingStore = None) -> None:
+        """ Compile the table from every decision: the training store's rows and the journal past them if given,
+        the whole journal otherwise. """
+        if store is not None:
+            for device_info, decision in store.history(journal):
+                self.record(device_info, decision)
+        else:
+            for record in journal.records():
+                if 'decision' in record:
+                    self.record(record, record['decision'])
+        logger.info(f"Policy table built: {self.stats()}")
+
+    def record(self, device_info: {}, decision: str) -> None:
+        """ Fold a single decision into the table. """
+        vendor_id = device_info['vendor_id']
+        product = (vendor_id, device_info['product_id'])
+
+        with self._lock:
+            self._exact[product + (device_info.get('serial'),)] = decision
+
+            streak = self._bump(self._product_streaks, product, decision)
+            if streak >= self.PRODUCT_STREAK:
+                self._product[product] = decision
+            elif self._product.get(product) not in (None, decision):
+                del self._product[product]  # The user changed their mind, the pair is undecided again
+
+            streak = self._bump(self._vendor_streaks, vendor_id, decision)
+            self._update_vendor(vendor_id, blocked=decision == 'block' and streak >= self.VENDOR_BLOCK_STREAK)
+
+    def clear(self) -> None:
+        """ Forget every decision, e.g. before replaying them all again. The vendor allow counts are kept. """
+        with self._lock:
+            for table in (self._exact, self._product, self._vendor, self._product_streaks, self._vendor_streaks):
+                table.clear()
+            for vendor_id in self._vendor_allow_count:
+                self._update_vendor(vendor_id, blocked=False)
+
+    def set_vendor_allow_count(self, vendor_allow_count: {}) -> None:
+        """ Replace all the vendor allow counts, e.g. once they are loaded at startup. """
+        with self._lock:
+            changed = set(self._vendor_allow_count) | set(vendor_allow_count)
+            self._vendor_allow_count = dict(vendor_allow_count)
+            for vendor_id in changed:
+                self._update_vendor(vendor_id, blocked=self._vendor.get(vendor_id) == 'block')
+
+    def update_vendor_allow_count(self, vendor_id: str, count: int) -> None:
+        """ Set the allow count of a single vendor, after the user ticked auto-allow. """
+        with self._lock:
+            self._vendor_allow_count[vendor_id] = count
+            self._update_vendor(vendor_id, blocked=self._vendor.get(vendor_id) == 'block')
+
+    @staticmethod
+    def _bump(streaks: {}, key, decision: str) -> int:
+        """ Extend the key's streak if the decision matches it, restart it otherwise. """
+        previous, length = streaks.get(key, (None, 0))
+        length = length + 1 if previous == decision else 1
+        streaks[key] = (decision, length)
+        return length
+
+    def _update_vendor(self, vendor_id: str, blocked: bool) -> None:
+        """ Recompute the vendor wildcard, blocks from the journal win over the allow counts. """
+        if blocked:
+            self._vendor[vendor_id] = 'block'
+        elif self._vendor_allow_count.get(vendor_id, 0) >= self.VENDOR_ALLOW_COUNT:
+            self._vendor[vendor_id] = 'allow'
+        else:
+            self._vendor.pop(vendor_id, None)
+
+    def lookup(self, device_info: {}) -> '':
+        """ Return 'allow' or 'block' from the most specific matching entry, None when nothing matches. """
+        vendor_id = device_info['vendor_id']
+        product = (vendor_id, device_info['product_id'])
+
+        verdict = self._exact.get(product + (device_info.get('serial'),))
+        if verdict is None:
+            verdict = self._product.get(product)
+        if verdict is None:
+            verdict = self._vendor.get(vendor_id)
+        if verdict is None and self.fallback is not None:
+            verdict = self.fallback.lookup(device_info)
+        return verdict
+
+    def stats(self) -> {}:
+        """ Number of entries at each level. """
+        return {'exact': len(self._exact), 'product': len(self._product), 'vendor': len(self._vendor)}
@@ -0,0 +1,139 @@
+import os
+import json
+import mmap
+from array import array
+from loguru import logger
+from core.decision_journal import DecisionJournal
+from ml_model.compact_model import FEATURES
+
+STORE_DIRECTORY = 'ml_model/training_store'
+STORE_FORMAT = 1  # Bumped whenever the layout below changes, the store is then rebuilt from the journal
+
+# A row per decision: the dictionary codes of FEATURES, then the label (1 allow, 0 block), as native int32
+COLUMNS = FEATURES + ('label',)
+ROW_SIZE = array('i').itemsize * len(COLUMNS)
+
+KEEP_RECORDS = 1000  # Most recent decisions always kept in the raw journal, whether compacted or not
+
+
+class TrainingStore:
+    """ The decision history compacted into fixed-width rows of dictionary codes, for training. """
+
+    def __init__(self, directory: str = STORE_DIRECTORY) -> None:
+        self.directory = directory
+        self.columns_path = os.path.join(directory, 'columns.bin')
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+
+        self.rows = 0
+        self.journal_offset = 0  # Journal offset just past the last compacted record
+        self.vocabularies = [[] for _ in FEATURES]  # Code -> value, per feature
+        self._codes = [{} for _ in FEATURES]  # Value -> code, per feature
+        self._map = None
+        self.load()
+
+    def load(self) -> None:
+        """ Read the manifest, an empty store if there is none or it is from an incompatible version. """
+        try:
+            with open(self.manifest_path, 'r') as file:
+                manifest = json.load(file)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError:
+            logger.error(f"Training store manifest {self.manifest_path} is corrupted, rebuilding the store")
+            return
+        if manifest.get('format') != STORE_FORMAT:
+            logger.info(f"Training store has format {manifest.get('format')}, rebuilding it")
+            return
+
+        self.rows = manifest['rows']
+        self.journal_offset = manifest['journal_offset']
+        self.vocabularies = [manifest['vocabularies'][feature] for feature in FEATURES]
+        self._codes = [{value: code for code, value in enumerate(vocabulary)} for vocabulary in self.vocabularies]
+
+    def _encode(self, feature: int, value) -> int:
+        """ Dictionary-encode a value, appending it to the feature's vocabulary the first time it is seen. """
+        code = self._codes[feature].get(value)
+        if code is None:
+            code = self._codes[feature][value] = len(self.vocabularies[feature])
+            self.vocabularies[feature].append(value)
+        return code
+
+    def compact(self, journal: DecisionJournal) -> int:
+        """ Fold the decisions journaled since the last compaction into the store. Returns the rows added. """
+        os.makedirs(self.directory, exist_ok=True)
+        if self.rows == 0 and os.path.exists(self.columns_path):
+            os.unlink(self.columns_path)  # A rebuild, readers may still map the old file
+
+        rows = array('i')
+        offset = self.journal_offset
+        for record, offset in journal.records_with_offsets(self.journal_offset):
+            if 'decision' not in record:
+                continue
+            rows.extend(self._encode(feature, record.get(name)) for feature, name in enumerate(FEATURES))
+            rows.append(1 if record['decision'] == 'allow' else 0)
+
+        added = len(rows) // len(COLUMNS)
+        if offset == self.journal_offset:
+            return 0
+
+        with open(self.columns_path, 'ab') as file:
+            file.truncate(self.rows * ROW_SIZE)  # Drop the rows of a compaction that didn't commit
+            file.write(rows.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.rows += added
+        self.journal_offset = offset
+        self._write_manifest()
+        logger.info(f"Compacted {added} decisions into the training store, {self.rows} rows in total")
+        return added
+
+    def _write_manifest(self) -> None:
+        manifest = {
+            'format': STORE_FORMAT,
+            'rows': self.rows,
+            'journal_offset': self.journal_offset,
+            'vocabularies': {feature: vocabulary for feature, vocabulary in zip(FEATURES, self.vocabularies)},
+        }
+        temp_path = f'{self.manifest_path}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(manifest, file, separators=(',', ':'))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.manifest_path)
+
+    def columns(self) -> memoryview:
+        """ The committed rows as a flat int32 view of the memory-mapped file, nothing is copied or parsed.
+        numpy.frombuffer(store.columns(), dtype=numpy.int32).reshape(-1, len(COLUMNS)) makes it a matrix. """
+        if self.rows == 0:
+            return memoryview(array('i'))
+
+        if self._map is None or len(self._map) < self.rows * ROW_SIZE:
+            with open(self.columns_path, 'rb') as file:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)[:self.rows * ROW_SIZE].cast('i')
+
+    def decisions(self) -> ():
+        """ Stream the compacted decisions as (device info, decision) pairs, oldest first. """
+        columns = self.columns()
+        width = len(COLUMNS)
+        for row in range(self.rows):
+            start = row * width
+            device_info = {feature: vocabulary[columns[start + index]]
+                           for index, (feature, vocabulary) in enumerate(zip(FEATURES, self.vocabularies))}
+            yield device_info, 'allow' if columns[start + len(FEATURES)] else 'block'
+
+    def history(self, journal: DecisionJournal) -> ():
+        """ Every decision ever made, as (device info, decision) pairs: the compacted ones, then the journal's tail
+        past them. Complete even once the journal's old records were rotated out. """
+        yield from self.decisions()
+        for record in journal.records(self.journal_offset):
+            if 'decision' in record:
+                yield record, record['decision']
+
+    def rotate_journal(self, journal: DecisionJournal, keep_records: int = KEEP_RECORDS) -> int:
+        """ Retention: rotate the compacted records out of the raw journal, keeping the most recent ones. """
+        return journal.rotate(self.journal_offset, keep_records)
+
+    def __len__(self) -> int:
+        return self.rows
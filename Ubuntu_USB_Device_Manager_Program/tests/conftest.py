@@ -0,0 +1,5 @@
+import os
+import sys
+
+PROGRAM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROGRAM_DIR)  # The tests import the program like main.py does, from its directory
@@ -0,0 +1,63 @@
+import pytest
+from ml_model.compact_model import CompactModel, export_model
+
+VOCABULARIES = {'vendor_id': {'0781': 0, '046d': 1}, 'product_id': {'5567': 0, 'c52b': 1},
+                'serial': {'A': 0, 'B': 1}}
+
+
+def tree(feature: int, left_class: int, right_class: int) -> CompactModel:
+    """ A single split on a feature's code <= 0.5, then two leaves. """
+    return CompactModel({'left': [1, -1, -1], 'right': [2, -1, -1], 'feature': [feature, -2, -2],
+                         'threshold': [0.5, -2.0, -2.0], 'leaf_class': [0, left_class, right_class]}, VOCABULARIES)
+
+
+def device(vendor_id: str = '0781', product_id: str = '5567', serial: str = 'A') -> {}:
+    return {'vendor_id': vendor_id, 'product_id': product_id, 'serial': serial}
+
+
+def test_known_values_walk_to_one_leaf():
+    model = tree(2, 1, 0)
+
+    assert model.predict(device(serial='A')) == 1
+    assert model.predict(device(serial='B')) == 0
+
+
+def test_unseen_serial_needs_every_leaf_to_agree():
+    assert tree(2, 1, 0).predict(device(serial='NEW')) is None
+    assert tree(2, 1, 1).predict(device(serial='NEW')) == 1
+    assert tree(0, 1, 0).predict(device(serial='NEW')) == 1  # The split isn't on the serial
+
+
+@pytest.mark.parametrize('unseen', [device(vendor_id='dead'), device(product_id='beef'),
+                                    device(vendor_id='dead', product_id='beef', serial='NEW')])
+def test_unseen_vendor_or_product_is_never_classified(unseen):
+    # Even though every leaf says allow
+    assert tree(2, 1, 1).predict(unseen) is None
+    assert tree(0, 1, 1).predict(unseen) is None
+
+
+def test_export_round_trip(tmp_path):
+    np = pytest.importorskip('numpy')
+    tree_module = pytest.importorskip('sklearn.tree')
+
+    vocabularies = [['0781', '046d'], ['5567', 'c52b'], ['A', 'B', 'C']]
+    X = np.array([[0, 0, 0], [0, 0, 1], [1, 1, 2], [1, 0, 0], [0, 1, 2]], dtype=np.int32)
+    y = np.array([1, 1, 0, 0, 1], dtype=np.int32)
+    fitted = tree_module.DecisionTreeClassifier(random_state=0).fit(X, y)
+    path = str(tmp_path / 'model_artifact.json')
+
+    export_model(fitted, vocabularies, path, trained_on=len(y))
+    model = CompactModel.load(path)
+
+    assert model.trained_on == len(y)
+    rows = [tuple(int(code) for code in row) for row in X]
+    assert model.predict_batch(rows) == [int(label) for label in fitted.predict(X)]
+    assert model.predict(device('046d', 'c52b', 'C')) == 0
+
+
+def test_incompatible_artifact_is_not_loaded(tmp_path):
+    path = tmp_path / 'model_artifact.json'
+    path.write_text('{"format": 0}')
+
+    assert CompactModel.load(str(path)) is None
+    assert CompactModel.load(str(tmp_path / 'missing.json')) is None
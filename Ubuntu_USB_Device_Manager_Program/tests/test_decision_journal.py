@@ -0,0 +1,87 @@
+import os
+import json
+import pytest
+from core.decision_journal import DecisionJournal
+
+
+def record(index: int) -> {}:
+    return {'vendor_id': '0781', 'product_id': '5567', 'serial': f'{index:04d}', 'decision': 'allow'}
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = DecisionJournal(str(tmp_path / 'usb_device_logs.jsonl'), legacy_path=None)
+    yield journal
+    journal.close()
+
+
+def serials(records) -> []:
+    return [record['serial'] for record in records]
+
+
+def test_offsets_resume_after_each_record(journal):
+    journal.append(*[record(index) for index in range(5)])
+
+    pairs = list(journal.records_with_offsets())
+    assert serials(record for record, _ in pairs) == ['0000', '0001', '0002', '0003', '0004']
+    assert pairs[-1][1] == journal.end_offset()
+    assert serials(journal.records(pairs[1][1])) == ['0002', '0003', '0004']
+
+
+def test_rotate_keeps_logical_offsets(journal):
+    journal.append(*[record(index) for index in range(10)])
+    offsets = [offset for _, offset in journal.records_with_offsets()]
+    end = journal.end_offset()
+
+    rotated = journal.rotate(offsets[5])
+
+    assert rotated == offsets[5]
+    assert journal.end_offset() == end
+    assert serials(journal.records(offsets[7])) == ['0008', '0009']
+    assert [offset for _, offset in journal.records_with_offsets(offsets[5])] == offsets[6:]
+    with open(f'{journal.path}.1', 'r') as archive:
+        assert serials(json.loads(line) for line in archive) == ['0000', '0001', '0002', '0003', '0004', '0005']
+
+
+def test_offset_rotated_out_restarts_at_the_tail(journal):
+    journal.append(*[record(index) for index in range(10)])
+    offsets = [offset for _, offset in journal.records_with_offsets()]
+
+    journal.rotate(offsets[5])
+
+    assert serials(journal.records(offsets[2])) == ['0006', '0007', '0008', '0009']
+
+
+def test_appends_after_rotation_continue_the_offsets(journal):
+    journal.append(*[record(index) for index in range(4)])
+    journal.rotate(journal.end_offset(), keep_records=1)
+    end = journal.end_offset()
+
+    journal.append(record(4))
+
+    assert serials(journal.records()) == ['0003', '0004']
+    assert serials(journal.records(end)) == ['0004']
+    assert DecisionJournal(journal.path, legacy_path=None).end_offset() == journal.end_offset()
+
+
+def test_repeated_rotations_shift_the_archives(journal):
+    for batch in range(5):
+        journal.append(*[record(batch * 10 + index) for index in range(2)])
+        journal.rotate(journal.end_offset(), archives=3)
+
+    with open(f'{journal.path}.1', 'r') as newest, open(f'{journal.path}.3', 'r') as oldest:
+        assert serials(json.loads(line) for line in newest) == ['0040', '0041']
+        assert serials(json.loads(line) for line in oldest) == ['0020', '0021']
+    assert not os.path.exists(f'{journal.path}.4')
+    assert serials(journal.records()) == []
+
+
+def test_torn_last_line_is_skipped_and_repaired(journal):
+    journal.append(record(0))
+    with open(journal.path, 'ab') as file:
+        file.write(b'{"vendor_id": "07')
+    journal.close()
+
+    journal.append(record(1))
+
+    assert serials(journal.records()) == ['0000', '0001']
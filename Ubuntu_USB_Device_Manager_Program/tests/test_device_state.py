@@ -0,0 +1,82 @@
+from benchmark.event_replay import FakeUdevDevice
+from core.device_state import DeviceStateTable, SEEN, PENDING, ALLOWED, BLOCKED, REMOVED
+
+
+def event(action: str, seqnum: int, initialized: str = '5000000', port: int = 1) -> FakeUdevDevice:
+    return FakeUdevDevice(action, 'usb', 'usb_device', f'/sys/devices/usb1/1-{port}', '/dev/bus/usb/001/002',
+                          {'SEQNUM': str(seqnum), 'USEC_INITIALIZED': initialized})
+
+
+def test_repeated_add_is_a_duplicate():
+    table = DeviceStateTable()
+
+    assert table.add('1-1', event('add', 10)) is not None
+    assert table.add('1-1', event('add', 11)) is None
+    assert table.state_of('1-1') == SEEN
+
+
+def test_stale_add_after_remove_is_ignored():
+    table = DeviceStateTable()
+    table.add('1-1', event('add', 10))
+    table.remove('1-1', event('remove', 12))
+
+    # An add event older than the remove, e.g. held back while the device waited for the user
+    assert table.add('1-1', event('add', 11, '6000000')) is None
+    assert table.state_of('1-1') == REMOVED
+
+    assert table.add('1-1', event('add', 13, '7000000')) is not None
+    assert table.state_of('1-1') == SEEN
+
+
+def test_reenumeration_without_remove_is_a_new_device():
+    table = DeviceStateTable()
+    table.add('1-1', event('add', 10, '5000000'))
+    table.set_state('1-1', BLOCKED)
+
+    record = table.add('1-1', event('add', 11, '6000000'))
+
+    assert record is not None and record.initialized == '6000000'
+    assert table.state_of('1-1') == SEEN
+    assert table.count(BLOCKED) == 0 and table.count(SEEN) == 1
+
+
+def test_capacity_evicts_least_recently_updated():
+    table = DeviceStateTable(max_devices=3)
+    for port in range(1, 4):
+        table.add(f'1-{port}', event('add', port, port=port))
+    table.set_state('1-1', ALLOWED)  # Now the most recently updated
+
+    table.add('1-4', event('add', 4, port=4))
+
+    assert len(table) == 3
+    assert '1-2' not in table
+    assert all(key in table for key in ('1-1', '1-3', '1-4'))
+    assert table.count(SEEN) == 2 and table.count(ALLOWED) == 1
+
+
+def test_ttl_expires_only_devices_that_are_gone():
+    table = DeviceStateTable(ttl=0)
+    table.add('1-1', event('add', 1, port=1))
+    table.set_state('1-1', PENDING)
+    table.add('1-2', event('add', 2, port=2))
+    table.set_state('1-2', BLOCKED)
+    table.add('1-3', event('add', 3, port=3))
+    table.remove('1-3', event('remove', 4, port=3))
+
+    table.add('1-4', event('add', 5, port=4))
+
+    assert table.state_of('1-1') == PENDING
+    assert table.get('1-2') is None and table.get('1-3') is None
+    assert table.count(BLOCKED) == 0 and table.count(REMOVED) == 0
+
+
+def test_removed_device_keeps_its_state():
+    table = DeviceStateTable()
+    table.add('1-1', event('add', 1))
+    table.remove('1-1', event('remove', 2))
+
+    table.set_state('1-1', ALLOWED)
+
+    assert table.state_of('1-1') == REMOVED
+    assert table.remove('1-1', event('remove', 3)) is None
+    assert '1-1' not in table
@@ -0,0 +1,62 @@
+from benchmark.event_replay import SyntheticDevice
+from core.device_topology import DeviceTopology
+
+
+def seeded(*devices: SyntheticDevice) -> DeviceTopology:
+    topology = DeviceTopology()
+    topology.seed(event for device in devices for event in device.add_events())
+    return topology
+
+
+def test_partitions_and_parents():
+    device = SyntheticDevice(1, ('0781', '5567'), 'ABC', 2, partitions=2)
+    topology = seeded(device)
+
+    assert topology.usb_device_by_node(device.device_node).sys_path == device.sys_path
+    partitions = topology.partitions_of(device.sys_path)
+    assert [node.device_node for node in partitions] == [f'{device.disk_node}1', f'{device.disk_node}2']
+    assert topology.usb_parent_of(partitions[0].sys_path).sys_path == device.sys_path
+    assert [node.device_node for node in topology.filesystems_of(device.sys_path)] == \
+        [f'{device.disk_node}1', f'{device.disk_node}2']
+
+
+def test_whole_disk_filesystem():
+    device = SyntheticDevice(1, ('0781', '5567'), 'ABC', 2, partitions=0)
+    topology = seeded(device)
+
+    assert topology.partitions_of(device.sys_path) == []
+    assert [node.device_node for node in topology.filesystems_of(device.sys_path)] == [device.disk_node]
+
+
+def test_remove_forgets_block_devices():
+    device = SyntheticDevice(1, ('0781', '5567'), 'ABC', 2, partitions=1)
+    other = SyntheticDevice(2, ('046d', 'c52b'), 'DEF', 3, partitions=1)
+    topology = seeded(device, other)
+
+    for event in device.remove_events():
+        topology.update(event)
+
+    assert topology.usb_device_by_node(device.device_node) is None
+    assert topology.block_devices_of(device.sys_path) == []
+    assert len(topology.partitions_of(other.sys_path)) == 1
+
+
+def test_reused_device_node():
+    # The kernel hands the node out again, the remove of its previous owner must not drop the new one
+    device = SyntheticDevice(1, ('0781', '5567'), 'ABC', 2)
+    replacement = SyntheticDevice(2, ('046d', 'c52b'), 'DEF', 2)
+    topology = seeded(device, replacement)
+
+    topology.remove(device.sys_path)
+
+    assert topology.usb_device_by_node(replacement.device_node).sys_path == replacement.sys_path
+
+
+def test_block_device_of_unknown_usb_device_is_ignored():
+    device = SyntheticDevice(1, ('0781', '5567'), 'ABC', 2)
+    topology = DeviceTopology()
+
+    disk = [event for event in device.add_events() if event.subsystem == 'block'][0]
+
+    assert topology.add(disk) is None
+    assert len(topology) == 0
@@ -0,0 +1,19 @@
+from utils.metrics import MetricsRegistry, TextfileExporter
+
+
+def test_textfile_exporter_leaves_the_final_values(tmp_path):
+    registry = MetricsRegistry()
+    registry.counter('usb_manager_test_total', "Test counter").inc(3)
+    exporter = TextfileExporter(str(tmp_path / 'usb_manager.prom'), registry=registry)
+
+    exporter.stop()
+
+    assert 'usb_manager_test_total 3' in (tmp_path / 'usb_manager.prom').read_text()
+
+
+def test_textfile_exporter_stop_survives_an_unwritable_path(tmp_path):
+    exporter = TextfileExporter(str(tmp_path / 'missing' / 'usb_manager.prom'), registry=MetricsRegistry())
+
+    exporter.stop()  # Logged, so the rest of the shutdown still runs
+
+    assert not (tmp_path / 'missing').exists()
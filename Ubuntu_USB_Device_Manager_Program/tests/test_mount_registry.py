@@ -0,0 +1,30 @@
+from core.mount_registry import MountEntry, MountRegistry
+
+NODE = '/dev/bus/usb/001/002'
+
+
+def entry(sys_path: str, block_device: str, mount_point: str) -> MountEntry:
+    return MountEntry(NODE, sys_path, block_device, mount_point, 'ABC', '0781', '5567', 0.0)
+
+
+def test_reused_device_node_never_pops_another_devices_mounts(tmp_path):
+    registry = MountRegistry(str(tmp_path / 'mount_registry.json'))
+    mounted = entry('/sys/devices/usb1/1-1', '/dev/sdb1', '/media/usb/ABC-1')
+    registry.add(mounted)
+
+    # A device at another port got the node after it, and was removed without having been mounted
+    assert registry.pop(NODE, '/sys/devices/usb1/1-2') == []
+    assert len(registry) == 1
+
+    assert registry.pop(NODE, '/sys/devices/usb1/1-1') == [mounted]
+    assert len(registry) == 0
+
+
+def test_device_node_lookup_when_the_sysfs_path_is_unknown(tmp_path):
+    registry = MountRegistry(str(tmp_path / 'mount_registry.json'))
+    mounts = [entry('/sys/devices/usb1/1-1', f'/dev/sdb{index}', f'/media/usb/ABC-{index}') for index in (1, 2)]
+    registry.add(*mounts)
+
+    assert registry.entries_of(NODE) == mounts
+    assert registry.pop(NODE) == mounts
+    assert registry.entries_of(NODE, '/sys/devices/usb1/1-1') == []
@@ -0,0 +1,49 @@
+import pytest
+from core.decision_counters import DecisionCounters
+from core.decision_journal import DecisionJournal
+from ml_model.model import ModelPredictor
+from ml_model.online_model import OnlineModel
+from ml_model.policy_table import PolicyTable
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = DecisionJournal(str(tmp_path / 'usb_device_logs.jsonl'), legacy_path=None)
+    yield journal
+    journal.close()
+
+
+def device(product_id: str, serial: str) -> {}:
+    return {'vendor_id': '046d', 'product_id': product_id, 'serial': serial}
+
+
+def trusted_vendor(journal, checkpoint_file: str) -> OnlineModel:
+    """ 30 allows across three products of the vendor. """
+    model = OnlineModel(journal, checkpoint_file)
+    model.learn_batch([(device(f'000{index % 3 + 1}', f'S{index}'), 'allow') for index in range(30)])
+    return model
+
+
+def test_unseen_product_of_a_trusted_vendor_is_not_allowed(journal, tmp_path):
+    model = trusted_vendor(journal, str(tmp_path / 'online_model.json'))
+    unseen = device('ffff', 'new')
+
+    assert model.probability(unseen) >= model.ALLOW_THRESHOLD  # The vendor's weight alone gets it there
+    assert model.predict(unseen) is None
+    assert model.predict(device('0002', 'new')) == 'allow'  # A new unit of a known product still is
+
+    predictor = ModelPredictor(model, PolicyTable(), DecisionCounters(str(tmp_path / 'counters.json')))
+    predictor.refresh = lambda: None  # No compact model trained
+    assert predictor.predict(unseen) is None
+
+
+def test_learned_products_survive_a_checkpoint(journal, tmp_path):
+    checkpoint_file = str(tmp_path / 'online_model.json')
+    trusted_vendor(journal, checkpoint_file).checkpoint()
+
+    resumed = OnlineModel(journal, checkpoint_file)
+    resumed.resume()
+
+    assert resumed.products == {'046d:0001', '046d:0002', '046d:0003'}
+    assert resumed.predict(device('ffff', 'new')) is None
+    assert resumed.predict(device('0001', 'new')) == 'allow'
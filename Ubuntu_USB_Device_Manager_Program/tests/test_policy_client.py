@@ -0,0 +1,50 @@
+import json
+import pytest
+from core.decision_journal import DecisionJournal
+from fleet.policy_client import FleetClient
+from fleet.policy_service import PolicyService
+
+
+def decision(product_id: str, serial: str) -> {}:
+    return {'vendor_id': '0781', 'product_id': product_id, 'serial': serial, 'decision': 'allow', 'timestamp': 0}
+
+
+def service(path) -> PolicyService:
+    """ A service whose journal has two allows of 0781:5567 and one of 0781:5581, from another host. """
+    service = PolicyService(DecisionJournal(str(path), legacy_path=None), train_interval=None)
+    service.add_decisions('other', [decision('5567', 'A'), decision('5567', 'B'), decision('5581', 'C')])
+    return service
+
+
+@pytest.fixture
+def client(tmp_path):
+    client = FleetClient('http://127.0.0.1:1', 'token', cache_path=str(tmp_path / 'fleet_cache.json'),
+                         journal=DecisionJournal(str(tmp_path / 'fleet_decisions.jsonl'), legacy_path=None))
+    client.load()
+    yield client
+    client.journal.close()
+
+
+def serve(client: FleetClient, service: PolicyService) -> None:
+    """ Answer the client's pulls from the service directly, no HTTP involved. """
+    def request(endpoint, method, path, body=None, headers=None):
+        return 200, {}, json.dumps(service.decisions_since(int(path.split('since=')[1]))).encode()
+    client._request = request
+
+
+def test_reset_pull_replaces_the_fleet_decisions(client, tmp_path):
+    serve(client, service(tmp_path / 'first.jsonl'))
+    client._pull()
+    pulled = len(list(client.journal.records()))
+
+    # Each reset service replays the same three decisions from version 0
+    for attempt in range(2):
+        reset_service = service(tmp_path / f'reset{attempt}.jsonl')
+        client.version = reset_service.journal.end_offset() + 1  # A version this service doesn't know
+        serve(client, reset_service)
+        client._pull()
+
+        assert len(list(client.journal.records())) == pulled == 3
+        assert client.policy.stats() == {'exact': 3, 'product': 0, 'vendor': 0}
+        # Counted twice, the two allows of 5567 would have made a streak allowing any unit of it
+        assert client.policy.lookup(decision('5567', 'NEW')) is None
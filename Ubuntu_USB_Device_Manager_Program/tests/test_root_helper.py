@@ -0,0 +1,141 @@
+import io
+import os
+import sys
+import json
+import subprocess
+import pytest
+from utils import root_process_launcher
+from utils.root_helper import handle_request, serve
+from utils.root_process_launcher import RootHelperProcess, RootProcessLauncher, HELPER_SCRIPT
+
+
+def operation(code: str, input_data: str = None) -> {}:
+    operation = {'argv': [sys.executable, '-c', code]}
+    if input_data is not None:
+        operation['input'] = input_data
+    return operation
+
+
+def test_serve_announces_itself_then_answers_each_line():
+    stdin = io.StringIO(json.dumps({'operations': [operation('print("hi")')]}) + '\n' + 'not json\n')
+    stdout = io.StringIO()
+
+    serve(stdin, stdout, 'abc123')
+
+    lines = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    assert lines[0] == {'ready': 'abc123'}
+    assert lines[1]['results'] == [{'returncode': 0, 'stdout': 'hi\n', 'stderr': ''}]
+    assert 'error' in lines[2]
+    assert len(lines) == 3
+
+
+def test_batch_stops_at_the_first_failure():
+    operations = [operation('pass'), operation('raise SystemExit(3)'), operation('pass')]
+
+    assert [result['returncode'] for result in handle_request({'operations': operations})['results']] == [0, 3]
+    assert [result['returncode'] for result in
+            handle_request({'operations': operations, 'stop_on_error': False})['results']] == [0, 3, 0]
+
+
+def test_parallel_batch_keeps_the_order():
+    operations = [operation(f'import time; time.sleep({0.2 - index * 0.05}); print({index})') for index in range(4)]
+
+    results = handle_request({'operations': operations, 'parallel': True})['results']
+
+    assert [result['stdout'] for result in results] == ['0\n', '1\n', '2\n', '3\n']
+
+
+def test_missing_program():
+    result = handle_request({'operations': [{'argv': ['/nonexistent/program']}]})['results'][0]
+
+    assert result['returncode'] == 127
+
+
+def test_launcher_round_trips_and_restarts_the_helper():
+    helper = RootHelperProcess(None, argv=[sys.executable, HELPER_SCRIPT])
+    launcher = RootProcessLauncher(helper=helper)
+    try:
+        assert launcher.execute('echo hello').stdout == 'hello\n'
+        assert launcher.execute_with_input('cat', 'data').stdout == 'data\n'
+        with pytest.raises(subprocess.CalledProcessError):
+            launcher.execute('false')
+
+        helper._process.kill()
+        helper._process.wait()
+        assert launcher.execute('echo again').stdout == 'again\n'
+    finally:
+        launcher.close()
+
+
+def test_helper_that_does_not_announce_itself_is_refused():
+    # e.g. sudo asking for a password on what would be the helper's stdout
+    helper = RootHelperProcess(None, argv=[sys.executable, '-c', 'print("Password:"); input()'])
+
+    with pytest.raises(PermissionError):
+        helper.request({'operations': []})
+    assert helper._process is None
+
+
+def test_password_only_goes_to_a_separate_sudo(monkeypatch):
+    runs = []
+
+    def run(argv, **kwargs):
+        runs.append((argv, kwargs.get('input')))
+        return subprocess.CompletedProcess(argv, 1, '', 'Sorry, try again.')
+    monkeypatch.setattr(root_process_launcher.subprocess, 'run', run)
+    monkeypatch.setattr(root_process_launcher.subprocess, 'Popen', lambda *args, **kwargs: pytest.fail("spawned"))
+    helper = RootHelperProcess('wrong', argv=['sudo', '-n', sys.executable, HELPER_SCRIPT])
+
+    with pytest.raises(PermissionError):
+        helper.request({'operations': []})
+    assert runs == [(['sudo', '-S', '-p', '', '-v'], 'wrong\n')]
+
+
+# A sudo that keeps no timestamp (Defaults timestamp_timeout=0): -n always fails, -S reads the password byte by
+# byte like sudo does, so nothing past its line is taken from the helper's stdin
+FAKE_SUDO = """#!{python}
+import os, sys
+args = sys.argv[1:]
+if args[0] == '-n':
+    sys.stderr.write('sudo: a password is required\\n')
+    sys.exit(1)
+password = b''
+while not password.endswith(b'\\n'):
+    byte = os.read(0, 1)
+    if not byte:
+        break
+    password += byte
+if password != b'secret\\n':
+    sys.stderr.write('Sorry, try again.\\n')
+    sys.exit(1)
+args = args[3:]  # -S -p ''
+if args == ['-v']:
+    sys.exit(0)
+os.execv(args[0], args)
+"""
+
+
+@pytest.fixture
+def sudo_without_timestamp(tmp_path, monkeypatch):
+    sudo = tmp_path / 'sudo'
+    sudo.write_text(FAKE_SUDO.format(python=sys.executable))
+    sudo.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+
+def test_helper_gets_the_password_when_sudo_keeps_no_timestamp(sudo_without_timestamp):
+    launcher = RootProcessLauncher(helper=RootHelperProcess('secret', argv=['sudo', '-n', sys.executable,
+                                                                          HELPER_SCRIPT]))
+    try:
+        # Had the password line reached the helper, this would read its error answer to it
+        assert launcher.execute('echo hello').stdout == 'hello\n'
+    finally:
+        launcher.close()
+
+
+def test_no_password_and_no_timestamp_is_refused(sudo_without_timestamp):
+    helper = RootHelperProcess(None, argv=['sudo', '-n', sys.executable, HELPER_SCRIPT])
+
+    with pytest.raises(PermissionError):
+        helper.request({'operations': []})
+    assert helper._process is None
@@ -0,0 +1,105 @@
+import os
+import pytest
+from benchmark.event_replay import SyntheticDevice, USB_ROOT, build_fake_sysfs, read_authorized
+from core import enforcement
+from core.enforcement import SysfsAuthorizedEnforcer, blocking_rule
+from core.usb_device import USBDevice
+from utils.root_process_launcher import RootProcessLauncher, FakeRootHelper
+from utils.udev_rule_set import UdevRuleSet
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+    devices = [SyntheticDevice(port, ('0781', f'{port:04x}'), f'S{port}', port + 1) for port in (1, 2)]
+    events = [event for device in devices for event in device.add_events()]
+    root = build_fake_sysfs(str(tmp_path / 'sys'), events)
+    usb_devices = [USBDevice(device.vendor_id, device.product_id, device.serial, device.device_node, device.sys_path)
+                   for device in devices]
+    return root, events, usb_devices
+
+
+def make_enforcer(tmp_path, root: str, authorized_default: bool = False) -> ():
+    helper = FakeRootHelper()
+    launcher = RootProcessLauncher(helper=helper)
+    blacklist = UdevRuleSet(launcher, str(tmp_path / '99-usb-blacklist.rules'))
+    enforced = []
+    enforcer = SysfsAuthorizedEnforcer(launcher, blacklist, authorized_default, root, on_enforced=enforced.extend)
+    return enforcer, helper, enforced
+
+
+def hub_default(root: str) -> str:
+    with open(os.path.join(root, os.path.relpath(USB_ROOT, '/sys'), 'authorized_default'), 'r') as file:
+        return file.read().strip()
+
+
+def test_block_deauthorizes_directly(tmp_path, sysfs):
+    root, events, (device, other) = sysfs
+    enforcer, helper, enforced = make_enforcer(tmp_path, root)
+
+    assert enforcer.block(device)
+
+    assert read_authorized(root, events) == {device.sys_path: '0', other.sys_path: '1'}
+    assert blocking_rule(device) in enforcer.blacklist.rules
+    assert enforced == [device.sys_path]
+
+    # The rule only persists the block, nothing is re-triggered
+    enforcer.flush()
+    assert [operation['argv'][:2] for operation in helper.operations] == \
+        [['tee', f'{enforcer.blacklist.path}.tmp'], ['mv', f'{enforcer.blacklist.path}.tmp'], ['udevadm', 'control']]
+
+
+def test_authorized_default(tmp_path, sysfs):
+    root, events, (device, other) = sysfs
+    enforcer, _, enforced = make_enforcer(tmp_path, root, authorized_default=True)
+    for path in read_authorized(root, events):
+        with open(os.path.join(root, os.path.relpath(path, '/sys'), 'authorized'), 'w') as file:
+            file.write('0')  # Plugged in while new devices start unauthorized
+
+    enforcer.start()
+    assert hub_default(root) == '0'
+
+    enforcer.allow([device])
+    assert read_authorized(root, events) == {device.sys_path: '1', other.sys_path: '0'}
+    assert enforced == [device.sys_path]
+
+    enforcer.stop()
+    assert hub_default(root) == '-1'
+
+
+def test_allow_without_authorized_default_writes_nothing(tmp_path, sysfs):
+    root, events, (device, _) = sysfs
+    enforcer, _, enforced = make_enforcer(tmp_path, root)
+
+    enforcer.start()
+    enforcer.allow([device])
+
+    assert hub_default(root) == '-1'
+    assert set(read_authorized(root, events).values()) == {'1'}
+    assert enforced == [device.sys_path]
+
+
+def test_refused_write_goes_through_the_root_helper(tmp_path, sysfs, monkeypatch):
+    root, _, (device, other) = sysfs
+    enforcer, helper, enforced = make_enforcer(tmp_path, root)
+
+    def refuse(path, mode='r'):
+        raise PermissionError(13, 'Permission denied', path)
+    monkeypatch.setattr(enforcement, 'open', refuse, raising=False)
+
+    assert enforcer.block(device)
+    assert enforcer.block(other)
+
+    authorized = [enforcer._path(usb_device.sys_path, 'authorized') for usb_device in (device, other)]
+    assert [(operation['argv'], operation['input']) for operation in helper.operations] == \
+        [(['tee', path], '0\n') for path in authorized]
+    assert enforced == [device.sys_path, other.sys_path]
+
+
+def test_block_of_unplugged_device_only_adds_its_rule(tmp_path, sysfs):
+    root, _, _ = sysfs
+    enforcer, _, enforced = make_enforcer(tmp_path, root)
+    gone = USBDevice('0781', '5567', 'GONE', '/dev/bus/usb/001/099', f'{USB_ROOT}/1-9')
+
+    assert not enforcer.block(gone)
+    assert blocking_rule(gone) in enforcer.blacklist.rules  # Blocked when it is plugged in again
+    assert enforced == []
@@ -0,0 +1,47 @@
+from benchmark.event_replay import SyntheticDevice
+from core.device_topology import DeviceTopology
+from core.enforcement import UdevRuleEnforcer, blocking_rule
+from core.usb_device import USBDevice
+from utils.root_process_launcher import RootProcessLauncher, FakeRootHelper
+from utils.udev_rule_set import UdevRuleSet
+
+
+def make_enforcer(tmp_path, *devices: SyntheticDevice) -> ():
+    topology = DeviceTopology()
+    topology.seed(event for device in devices for event in device.add_events())
+    helper = FakeRootHelper()
+    blacklist = UdevRuleSet(RootProcessLauncher(helper=helper), str(tmp_path / '99-usb-blacklist.rules'))
+    enforced = []
+    return UdevRuleEnforcer(blacklist, topology, on_enforced=enforced.extend), topology, helper, enforced
+
+
+def usb_device(device: SyntheticDevice) -> USBDevice:
+    return USBDevice(device.vendor_id, device.product_id, device.serial, device.device_node, device.sys_path)
+
+
+def test_block_re_triggers_only_the_device(tmp_path):
+    device = SyntheticDevice(1, ('0781', '5567'), 'ABC', 2)
+    enforcer, _, helper, enforced = make_enforcer(tmp_path, device)
+
+    assert enforcer.block(usb_device(device))
+    enforcer.flush()
+
+    assert blocking_rule(usb_device(device)) in enforcer.blacklist.rules
+    assert ['udevadm', 'trigger', device.sys_path] in [operation['argv'] for operation in helper.operations]
+    assert enforced == [device.sys_path]
+
+
+def test_block_after_unplug_still_adds_the_rule(tmp_path):
+    # The user clicked Block after the device's remove event was handled
+    device = SyntheticDevice(1, ('0781', '5567'), 'ABC', 2)
+    enforcer, topology, helper, enforced = make_enforcer(tmp_path, device)
+    for event in device.remove_events():
+        topology.update(event)
+
+    assert not enforcer.block(usb_device(device))
+    enforcer.flush()
+
+    assert blocking_rule(usb_device(device)) in enforcer.blacklist.rules
+    assert [operation['argv'][:2] for operation in helper.operations] == \
+        [['tee', f'{enforcer.blacklist.path}.tmp'], ['mv', f'{enforcer.blacklist.path}.tmp'], ['udevadm', 'control']]
+    assert enforced == []
@@ -1,36 +1,28 @@
-import subprocess
 from loguru import logger
 from utils.root_process_launcher import RootProcessLauncher
-from core.device_utils import update_udev_rules
+from utils.udev_rule_set import UdevRuleSet, AUTOMOUNT_RULES_FILE
+
+DISABLE_AUTOMOUNT_RULE = 'ACTION=="add", SUBSYSTEM=="block", ENV{UDISKS_IGNORE}="1"'
 
 
 def disable_auto_mount(root_process_launcher: RootProcessLauncher) -> None:
     """ Disable auto-mounting """
-    disable_command = 'ACTION=="add", SUBSYSTEM=="block", ENV{UDISKS_IGNORE}="1"'
-    tee_command = 'tee -a /etc/udev/rules.d/99-disable-usb-automount.rules'
-    try:
-        # Pass the sudo password and run the echo command to append to the file
-        root_process_launcher.execute_with_input(tee_command, disable_command)
+    rules = UdevRuleSet(root_process_launcher, AUTOMOUNT_RULES_FILE)
+    rules.add(DISABLE_AUTOMOUNT_RULE)
 
-        # Reload udev rules and trigger them to apply changes
-        update_udev_rules(root_process_launcher)
+    # The rule only matters for block devices added from now on, so a reload is enough, no trigger
+    if rules.flush():
         logger.info(f"Auto-mount disabled successfully")
-
-    except subprocess.CalledProcessError as e:
+    else:
         logger.error(f"Failed to disable automount")
 
 
 def enable_auto_mount(root_process_launcher: RootProcessLauncher) -> None:
     """ Enable auto-mounting """
-    truncate_command = 'truncate -s 0 /etc/udev/rules.d/99-disable-usb-automount.rules'
-    try:
-        # Pass the sudo password and run the echo command to append to the file
-        root_process_launcher.execute(truncate_command)
+    rules = UdevRuleSet(root_process_launcher, AUTOMOUNT_RULES_FILE)
+    rules.clear()
 
-        # Reload udev rules and trigger them to apply changes
-        update_udev_rules(root_process_launcher)
+    if rules.flush():
         logger.info(f"Auto-mount enable successfully")
-
-    except subprocess.CalledProcessError as e:
+    else:
         logger.error(f"Failed to enable automount")
-
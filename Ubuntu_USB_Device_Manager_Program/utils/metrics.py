@@ -0,0 +1,249 @@
+import os
+import bisect
+import threading
+import socketserver
+from loguru import logger
+
+# Seconds, from sub-millisecond lookups up to a user thinking about a popup
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names: (), values: (), extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    """ A metric family, with one child per combination of label values. """
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels: ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self._children[()] = self._new_child()  # Report 0 before the first sample
+
+    def labels(self, *values):
+        """ The child for the given label values, created on first use. """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> [str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self._children.items()):
+            lines += child.render(self.name, self.label_names, values)
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        # += on an int attribute is effectively atomic under the GIL, good enough for counters
+        self.value += amount
+
+    def render(self, name: str, label_names: (), values: ()) -> [str]:
+        return [f'{name}{_format_labels(label_names, values)} {self.value}']
+
+
+class Counter(_Metric):
+    """ Monotonically increasing count. """
+    kind = 'counter'
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self) -> None:
+        self.value = 0
+        self.function = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function) -> None:
+        """ Compute the value when the metrics are rendered, e.g. a queue's depth. """
+        self.function = function
+
+    def render(self, name: str, label_names: (), values: ()) -> [str]:
+        value = self.function() if self.function is not None else self.value
+        return [f'{name}{_format_labels(label_names, values)} {value}']
+
+
+class Gauge(_Metric):
+    """ Value that goes up and down. """
+    kind = 'gauge'
+
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def set_function(self, function) -> None:
+        self.labels().set_function(function)
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'lock')
+
+    def __init__(self, buckets: ()) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def render(self, name: str, label_names: (), values: ()) -> [str]:
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            bucket_labels = _format_labels(label_names, values, 'le="' + str(bound) + '"')
+            lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(label_names, values)} {total}')
+        lines.append(f'{name}_count{_format_labels(label_names, values)} {count}')
+        return lines
+
+
+class Histogram(_Metric):
+    """ Distribution of observed values over fixed buckets. """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: (), buckets: ()) -> None:
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labels)
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+
+class MetricsRegistry:
+    """ Collection of metrics, rendered in the Prometheus text exposition format. """
+
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labels: () = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: () = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: () = (), buckets: () = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+# The process-wide registry every module registers its metrics in
+REGISTRY = MetricsRegistry()
+
+
+class TextfileExporter:
+    """ Periodically writes the metrics for node_exporter's textfile collector, atomically. """
+
+    def __init__(self, path: str, interval: float = 15, registry: MetricsRegistry = REGISTRY) -> None:
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-textfile', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def write(self) -> None:
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(self.registry.render())
+        os.replace(temp_path, self.path)
+
+    def _write_logged(self) -> None:
+        try:
+            self.write()
+        except OSError as e:
+            logger.error(f"Failed to write metrics to {self.path}: {e}")
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._write_logged()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._write_logged()  # Leave the final values behind, never failing the shutdown it is part of
+
+
+class UnixSocketExporter:
+    """ Serves the metrics over HTTP on a Unix socket, e.g. curl --unix-socket data/metrics.sock http://localhost/ """
+
+    def __init__(self, path: str, registry: MetricsRegistry = REGISTRY) -> None:
+        self.path = path
+        self.registry = registry
+        self._server = None
+
+    def start(self) -> None:
+        registry = self.registry
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                self.rfile.readline()  # Any request gets the metrics
+                body = registry.render().encode()
+                self.wfile.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                                 b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Left over from a previous run
+        self._server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='metrics-socket', daemon=True).start()
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            os.unlink(self.path)
@@ -0,0 +1,46 @@
+import pyudev
+from loguru import logger
+from utils.root_process_launcher import RootProcessLauncher
+from utils.udev_rule_set import UdevRuleSet, MONITOR_TAG_RULES_FILE
+
+# udev tag of the block devices of USB devices, the block monitor's kernel-side filter lets nothing else through
+MONITOR_TAG = 'usb_device_manager'
+MONITOR_TAG_RULE = f'SUBSYSTEM=="block", ENV{{ID_BUS}}=="usb", TAG+="{MONITOR_TAG}"'
+
+# Actions each stream is read for. The socket filters can't match actions, the reader drops the rest
+HANDLED_ACTIONS = {
+    'usb': ('add', 'remove'),
+    'block': ('add', 'change', 'remove'),  # change: e.g. a card inserted in a reader, or a disk reformatted
+}
+
+
+def tag_usb_block_devices(root_process_launcher: RootProcessLauncher) -> bool:
+    """ Install the rule tagging the block devices of USB devices. Returns whether the block monitor can filter on
+    the tag, which is only true for events processed once the rule is in place. """
+    rules = UdevRuleSet(root_process_launcher, MONITOR_TAG_RULES_FILE)
+    rules.add(MONITOR_TAG_RULE)
+
+    # Tags are set when udev processes an event, a reload is enough
+    if rules.flush():
+        logger.info(f"USB block devices tagged {MONITOR_TAG}")
+        return True
+    logger.error(f"Failed to tag USB block devices, the block monitor will be woken by every block device")
+    return False
+
+
+def untag_usb_block_devices(root_process_launcher: RootProcessLauncher) -> None:
+    """ Remove the tagging rule. """
+    rules = UdevRuleSet(root_process_launcher, MONITOR_TAG_RULES_FILE)
+    rules.clear()
+    if not rules.flush():
+        logger.error(f"Failed to remove {MONITOR_TAG_RULES_FILE}")
+
+
+def filter_monitors(usb_monitor: pyudev.Monitor, block_monitor: pyudev.Monitor, tagged: bool) -> None:
+    """ Install the kernel-side filters of the USB and block streams. """
+    usb_monitor.filter_by(subsystem='usb', device_type='usb_device')
+
+    block_monitor.filter_by(subsystem='block', device_type='disk')
+    block_monitor.filter_by(subsystem='block', device_type='partition')
+    if tagged:
+        block_monitor.filter_by_tag(MONITOR_TAG)
@@ -0,0 +1,61 @@
+# Long-lived helper that runs the manager's privileged operations.
+# It is started once through sudo by RootProcessLauncher with a nonce as its argument, announces itself with
+#     {"ready": "<nonce>"}
+# and then reads one JSON request per line on stdin:
+#     {"operations": [{"argv": [...], "input": "..."}, ...], "stop_on_error": true, "parallel": false}
+# and answers each request with one JSON line on stdout:
+#     {"results": [{"returncode": 0, "stdout": "...", "stderr": "..."}, ...]}
+import sys
+import json
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_PARALLEL = 16  # Operations of a parallel request running at once
+
+
+def run_operation(operation: {}) -> {}:
+    """ Run a single operation and capture its exit status and output. """
+    try:
+        completed = subprocess.run(operation['argv'], input=operation.get('input'), capture_output=True, text=True)
+    except OSError as e:
+        return {'returncode': 127, 'stdout': '', 'stderr': str(e)}
+
+    return {'returncode': completed.returncode, 'stdout': completed.stdout, 'stderr': completed.stderr}
+
+
+def handle_request(request: {}) -> {}:
+    """ Run a batch of operations, in order or in parallel, stopping at the first failure if asked to. """
+    operations = request['operations']
+    if request.get('parallel') and len(operations) > 1:
+        with ThreadPoolExecutor(min(len(operations), MAX_PARALLEL)) as executor:
+            return {'results': list(executor.map(run_operation, operations))}
+
+    results = []
+    for operation in operations:
+        result = run_operation(operation)
+        results.append(result)
+
+        if result['returncode'] != 0 and request.get('stop_on_error', True):
+            break
+
+    return {'results': results}
+
+
+def serve(stdin, stdout, nonce: str = None) -> None:
+    """ Announce the helper with the nonce, then answer requests until stdin is closed. """
+    if nonce is not None:
+        stdout.write(json.dumps({'ready': nonce}) + '\n')
+        stdout.flush()
+
+    for line in stdin:
+        try:
+            response = handle_request(json.loads(line))
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            response = {'error': f'Malformed request: {e}'}
+
+        stdout.write(json.dumps(response) + '\n')
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    serve(sys.stdin, sys.stdout, sys.argv[1] if len(sys.argv) > 1 else None)
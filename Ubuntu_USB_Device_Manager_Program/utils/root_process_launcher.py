@@ -1,25 +1,208 @@
+import os
+import sys
+import json
+import secrets
 import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from loguru import logger
+from utils.root_helper import handle_request
+from utils.metrics import REGISTRY
+
+HELPER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'root_helper.py')
+AUTH_TIMEOUT = 10  # Seconds sudo gets to check the password
+
+# Labelled by the first command's program (mount, umount, tee...), which names what the request was for
+REQUEST_SECONDS = REGISTRY.histogram('usb_manager_root_helper_request_seconds',
+                                     "Round trip of a request to the root helper, including waiting for it",
+                                     ('command',))
+OPERATIONS = REGISTRY.counter('usb_manager_root_helper_operations_total', "Commands run by the root helper",
+                              ('command', 'result'))
+
+
+@dataclass
+class CommandResult:
+    """ Exit status and output of a command run by the root helper. """
+    command: str
+    returncode: int
+    stdout: str
+    stderr: str
+
+
+class RootHelperProcess:
+    """ The root helper process, started once (through sudo -n unless already root) and kept alive for the session. """
+
+    def __init__(self, sudo_password: str, argv: [] = None) -> None:
+        self.sudo_password = sudo_password
+        if argv is None:
+            argv = [sys.executable, HELPER_SCRIPT] if os.geteuid() == 0 else ['sudo', '-n', sys.executable,
+                                                                               HELPER_SCRIPT]
+        self.argv = argv
+        self._process = None
+
+    def _authenticate(self) -> None:
+        """ Validate the sudo credentials, with the password if there is one. Raises PermissionError. """
+        if self.argv[0] != 'sudo':
+            return
+        if self.sudo_password is not None:
+            argv, password = ['sudo', '-S', '-p', '', '-v'], f'{self.sudo_password}\n'
+        else:
+            argv, password = ['sudo', '-n', '-v'], None  # Only works without a password or with cached credentials
+        try:
+            completed = subprocess.run(argv, input=password, capture_output=True, text=True, timeout=AUTH_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            raise PermissionError("sudo didn't answer, is the sudo password correct?")
+        if completed.returncode != 0:
+            raise PermissionError(f"sudo refused the credentials, is the sudo password correct? "
+                                  f"{completed.stderr.strip()}")
+
+    def _start(self) -> None:
+        """ Authenticate, then start the helper. Raises PermissionError. """
+        self._authenticate()
+        if self._spawn(self.argv):
+            return
+
+        # sudo kept no credentials from the check (timestamp_timeout=0, tickets per tty): sudo -n needs a password,
+        # so sudo -S does read it, and the line never reaches the helper
+        if self.argv[:2] == ['sudo', '-n'] and self.sudo_password is not None:
+            logger.warning("sudo -n can't start the root helper, passing it the sudo password")
+            if self._spawn(['sudo', '-S', '-p', ''] + self.argv[2:], f'{self.sudo_password}\n'):
+                return
+        raise PermissionError("Failed to start the root helper, is the sudo password correct?")
+
+    def _spawn(self, argv: [], password: str = None) -> bool:
+        """ Start the helper and wait for it to announce itself, returns whether it did. """
+        nonce = secrets.token_hex(8)
+        self._process = subprocess.Popen(argv + [nonce], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL, text=True, bufsize=1)
+        if password is not None:
+            try:
+                self._process.stdin.write(password)
+                self._process.stdin.flush()
+            except BrokenPipeError:
+                pass  # sudo already gave up
+
+        # The first line must be the helper's, with this start's nonce, before any request is sent. A sudo still
+        # waiting for a password is killed rather than waited for
+        timer = threading.Timer(AUTH_TIMEOUT, self._process.kill)
+        timer.start()
+        try:
+            line = self._process.stdout.readline()
+        finally:
+            timer.cancel()
+        try:
+            ready = json.loads(line).get('ready') if line else None
+        except (ValueError, AttributeError):
+            ready = None
+        if ready != nonce:
+            self.close()
+            return False
+        logger.info("Root helper started")
+        return True
+
+    def _send(self, request: {}) -> {}:
+        """ Write one request line and read back one response line, None if the helper died. """
+        try:
+            self._process.stdin.write(json.dumps(request) + '\n')
+            self._process.stdin.flush()
+            line = self._process.stdout.readline()
+        except (BrokenPipeError, ValueError):
+            return None
+        return json.loads(line) if line else None
+
+    def request(self, request: {}) -> {}:
+        """ Send a request, restarting the helper once if it went away. """
+        if self._process is None:
+            self._start()
+
+        response = self._send(request)
+        if response is None:
+            logger.warning("Root helper exited, restarting it")
+            self._start()
+            response = self._send(request)
+            if response is None:
+                raise ConnectionError("Root helper exited while handling the request")
+        return response
+
+    def close(self) -> None:
+        """ Close the helper's stdin, which makes it exit. """
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self._process.wait()
+            self._process = None
+
+
+class FakeRootHelper:
+    """ Unprivileged stand-in for the root helper, for tests and benchmarks.
+    Records every operation and, unless told to actually run them, reports them as successful. """
+
+    def __init__(self, run: bool = False) -> None:
+        self.run = run
+        self.operations = []
+
+    def request(self, request: {}) -> {}:
+        self.operations.extend(request['operations'])
+        if self.run:
+            return handle_request(request)
+        return {'results': [{'returncode': 0, 'stdout': '', 'stderr': ''} for _ in request['operations']]}
+
+    def close(self) -> None:
+        pass
 
 
 class RootProcessLauncher:
     """ Launching processes with root privileges """
 
-    def __init__(self, sudo_password: str) -> None:
-        self.sudo_password = sudo_password
+    def __init__(self, sudo_password: str = None, helper=None) -> None:
+        self.helper = helper or RootHelperProcess(sudo_password)
+        self._lock = threading.Lock()  # One request in flight at a time
 
-    def execute(self, command: str) -> None:
+    def execute(self, command: str, check: bool = True) -> CommandResult:
         """ Execute command with sudo, so it could run in root privileges """
-        sudo_command = ['sudo', '-S']
-        sudo_command += command.split()  # Preparing command with sudo
-
-        subprocess.Popen(sudo_command, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL) \
-            .communicate(input=f'{self.sudo_password}\n'.encode())
+        return self.execute_batch([command], check)[0]
 
-    def execute_with_input(self, command: str, input_data: str) -> None:
+    def execute_with_input(self, command: str, input_data: str, check: bool = True) -> CommandResult:
         """ Execute command with sudo, so it could run in root privileges. And inserting input after.
         For Example - inserting text to a file with root privileges """
-        sudo_command = ['sudo', '-S']
-        sudo_command += command.split() # Preparing command with sudo
+        return self.execute_batch([(command, input_data)], check)[0]
+
+    def execute_batch(self, commands: [], check: bool = True, stop_on_error: bool = True,
+                      parallel: bool = False) -> [CommandResult]:
+        """ Execute several commands, strings or (command, input_data) tuples, in one round trip to the root helper.
+        Stops at the first failure unless stop_on_error is False, parallel runs them all concurrently. """
+        operations = []
+        for command in commands:
+            command, input_data = command if isinstance(command, tuple) else (command, None)
+            operation = {'argv': command.split()}  # Preparing command for the helper
+            if input_data is not None:
+                operation['input'] = f'{input_data}\n'
+            operations.append(operation)
+
+        started = time.monotonic()
+        with self._lock:
+            response = self.helper.request({'operations': operations, 'stop_on_error': stop_on_error,
+                                            'parallel': parallel})
+        REQUEST_SECONDS.labels(operations[0]['argv'][0] if operations else '').observe(time.monotonic() - started)
+
+        if 'error' in response:
+            raise ValueError(response['error'])
+
+        results = []
+        for command, result in zip(commands, response['results']):
+            command = command[0] if isinstance(command, tuple) else command
+            results.append(CommandResult(command, result['returncode'], result['stdout'], result['stderr']))
+            OPERATIONS.labels(command.split()[0], 'ok' if result['returncode'] == 0 else 'failed').inc()
+
+        if check and results and results[-1].returncode != 0:
+            failed = results[-1]
+            raise subprocess.CalledProcessError(failed.returncode, failed.command, failed.stdout, failed.stderr)
+        return results
 
-        subprocess.Popen(sudo_command, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL) \
-            .communicate(input=f'{self.sudo_password}\n{input_data}\n'.encode())
+    def close(self) -> None:
+        """ Stop the root helper. """
+        with self._lock:
+            self.helper.close()
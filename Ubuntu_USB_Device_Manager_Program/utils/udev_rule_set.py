@@ -0,0 +1,97 @@
+import subprocess
+import threading
+from loguru import logger
+from utils.root_process_launcher import RootProcessLauncher
+
+BLACKLIST_RULES_FILE = '/etc/udev/rules.d/99-usb-blacklist.rules'
+AUTOMOUNT_RULES_FILE = '/etc/udev/rules.d/99-disable-usb-automount.rules'
+MONITOR_TAG_RULES_FILE = '/etc/udev/rules.d/61-usb-device-manager-monitor.rules'  # After 60-persistent-storage
+
+RULES_FILE_HEADER = '# Managed by USB Device Manager, changes will be overwritten'
+
+
+class UdevRuleSet:
+    """ A udev rules file kept as a set, rewritten atomically with coalesced, scoped re-triggers. """
+
+    COALESCE_WINDOW = 0.5  # Seconds to wait for more changes before flushing
+
+    def __init__(self, root_process_launcher: RootProcessLauncher, path: str) -> None:
+        self.root_process_launcher = root_process_launcher
+        self.path = path
+        self.rules = self._read()
+        self._dirty = False
+        self._pending_sys_paths = set()  # Devices to re-trigger on the next flush
+        self.on_applied = None  # Called with the devices each flush re-triggered
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _read(self) -> set:
+        """ Load the existing rules, the rules directory is world-readable. """
+        try:
+            with open(self.path, 'r') as file:
+                return {line.strip() for line in file if line.strip() and not line.startswith('#')}
+        except FileNotFoundError:
+            return set()
+
+    def add(self, rule: str, sys_path: str = None) -> bool:
+        """ Add a rule and schedule a flush that re-triggers only the given device. Returns whether it was new. """
+        with self._lock:
+            new = rule not in self.rules
+            if new:
+                self.rules.add(rule)
+                self._dirty = True
+            if sys_path:
+                self._pending_sys_paths.add(sys_path)
+
+            if (self._dirty or self._pending_sys_paths) and self._timer is None:
+                self._timer = threading.Timer(self.COALESCE_WINDOW, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+            return new
+
+    def clear(self) -> None:
+        """ Remove every rule. Takes effect on the next flush. """
+        with self._lock:
+            if self.rules:
+                self.rules.clear()
+                self._dirty = True
+
+    def render(self) -> str:
+        """ The file's content: a header and the sorted rules. """
+        return '\n'.join([RULES_FILE_HEADER] + sorted(self.rules))
+
+    def flush(self) -> bool:
+        """ Write the file if it changed, reload udev and trigger the pending devices, in a single round trip.
+        Returns whether everything was applied. """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            commands = []
+            if self._dirty:
+                temp_path = f'{self.path}.tmp'
+                commands += [(f'tee {temp_path}', self.render()), f'mv {temp_path} {self.path}',
+                             'udevadm control --reload']
+            if self._pending_sys_paths:
+                # Re-evaluate only the affected devices instead of every device on the system
+                commands.append('udevadm trigger ' + ' '.join(sorted(self._pending_sys_paths)))
+
+            if not commands:
+                return True
+
+            try:
+                self.root_process_launcher.execute_batch(commands)
+            except subprocess.CalledProcessError as e:
+                logger.error(f"Failed to update {self.path}: {e} {e.stderr}")
+                return False
+
+            logger.info(f"Updated {self.path}: {len(self.rules)} rules, "
+                        f"{len(self._pending_sys_paths)} devices re-triggered")
+            applied = sorted(self._pending_sys_paths)
+            self._dirty = False
+            self._pending_sys_paths.clear()
+
+        if applied and self.on_applied is not None:
+            self.on_applied(applied)
+        return True